@@ -0,0 +1,154 @@
+"""
+Per-user activity bitmaps.
+
+Every local day with a Streak record sets one bit in the user's
+StreakActivityBitmap row for that year. Loading a user's rows is a single small
+query (46 bytes per year), after which streak lengths, active-day counts and
+calendars are answered with integer bit operations instead of Streak range scans.
+
+Within Python a user's history is one integer in which bit ``date.toordinal()
+- base`` is set for every active day.
+"""
+import logging
+from datetime import date, timedelta
+
+from django.db import transaction
+
+from .models import StreakActivityBitmap, Streak
+
+logger = logging.getLogger(__name__)
+
+BITMAP_BYTES = 46
+
+
+def _set_bit(bits, day):
+    index = day.timetuple().tm_yday - 1
+    bits[index // 8] |= 1 << (index % 8)
+
+
+def mark_active_days(entries):
+    """
+    Set the bits for ``entries``, an iterable of (user_id, date), creating the year rows as needed.
+    Costs three queries however many users and days are marked.
+    """
+    by_row = {}
+    for user_id, day in entries:
+        by_row.setdefault((user_id, day.year), []).append(day)
+    if not by_row:
+        return
+
+    with transaction.atomic():
+        StreakActivityBitmap.objects.bulk_create(
+            [StreakActivityBitmap(user_id=user_id, year=year) for user_id, year in by_row],
+            ignore_conflicts=True
+        )
+        user_ids = {user_id for user_id, _ in by_row}
+        years = {year for _, year in by_row}
+        changed = []
+        for bitmap in StreakActivityBitmap.objects.select_for_update().filter(user_id__in=user_ids, year__in=years):
+            days = by_row.get((bitmap.user_id, bitmap.year))
+            if not days:
+                continue
+            bits = bytearray(bitmap.bits)
+            for day in days:
+                _set_bit(bits, day)
+            if bytes(bits) != bytes(bitmap.bits):
+                bitmap.bits = bytes(bits)
+                changed.append(bitmap)
+        StreakActivityBitmap.objects.bulk_update(changed, ['bits'])
+
+
+class ActivityHistory:
+    """A user's active days as one integer, loaded with a single query."""
+
+    def __init__(self, user_id):
+        rows = list(StreakActivityBitmap.objects.filter(user_id=user_id).values_list('year', 'bits'))
+        self.base = date(min((year for year, _ in rows), default=date.today().year), 1, 1).toordinal()
+        self.bits = 0
+        for year, bits in rows:
+            offset = date(year, 1, 1).toordinal() - self.base
+            self.bits |= int.from_bytes(bytes(bits), 'little') << offset
+
+    def _position(self, day):
+        return day.toordinal() - self.base
+
+    def _range_mask(self, start, end):
+        """Mask of the bits from ``start`` to ``end`` inclusive, clipped to the loaded history."""
+        low = max(self._position(start), 0)
+        high = self._position(end) + 1
+        if high <= low:
+            return 0
+        return ((1 << (high - low)) - 1) << low
+
+    def is_active(self, day):
+        position = self._position(day)
+        return position >= 0 and bool(self.bits >> position & 1)
+
+    def run_ending(self, day):
+        """Number of consecutive active days ending on ``day``."""
+        position = self._position(day)
+        if position < 0 or not self.bits >> position & 1:
+            return 0
+        # Inverted bits below ``day``: the highest set bit is the most recent inactive day
+        below = ~self.bits & ((1 << position) - 1)
+        return position - below.bit_length() + 1
+
+    def current_streak(self, today):
+        """The live streak: the run ending today, or yesterday if today has no activity yet."""
+        return self.run_ending(today) or self.run_ending(today - timedelta(days=1))
+
+    def highest_streak(self):
+        """Length of the longest run of active days."""
+        runs = self.bits
+        length = 0
+        while runs:
+            runs &= runs >> 1
+            length += 1
+        return length
+
+    def active_days(self, start, end):
+        """Number of active days from ``start`` to ``end`` inclusive."""
+        return bin(self.bits & self._range_mask(start, end)).count('1')
+
+    def calendar(self, start, end):
+        """(date, run length ending that day) for every active day from ``start`` to ``end``."""
+        days = []
+        run = self.run_ending(start - timedelta(days=1))
+        day = start
+        while day <= end:
+            run = run + 1 if self.is_active(day) else 0
+            if run:
+                days.append((day, run))
+            day += timedelta(days=1)
+        return days
+
+
+def rebuild_activity_bitmaps(user_ids=None):
+    """
+    Rebuild the bitmaps from the Streak records.
+
+    Args:
+        user_ids (list, optional): Restrict the rebuild to these users. Defaults to every user.
+
+    Returns:
+        int: Number of bitmap rows written.
+    """
+    streaks = Streak.objects.all()
+    bitmaps = StreakActivityBitmap.objects.all()
+    if user_ids is not None:
+        streaks = streaks.filter(user_id__in=user_ids)
+        bitmaps = bitmaps.filter(user_id__in=user_ids)
+
+    rows = {}
+    for user_id, day in streaks.values_list('user_id', 'date').iterator():
+        _set_bit(rows.setdefault((user_id, day.year), bytearray(BITMAP_BYTES)), day)
+
+    with transaction.atomic():
+        bitmaps.delete()
+        StreakActivityBitmap.objects.bulk_create([
+            StreakActivityBitmap(user_id=user_id, year=year, bits=bytes(bits))
+            for (user_id, year), bits in rows.items()
+        ], batch_size=1000)
+
+    logger.info(f"Rebuilt {len(rows)} activity bitmaps")
+    return len(rows)
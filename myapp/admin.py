@@ -1,7 +1,9 @@
 from django.contrib import admin
 from .models import (CustomUser, Company, Membership, Invitation, Xp, Streak, WorkoutActivity, DailySteps, 
-                     Purchase, Prize, Draw, DrawEntry, DrawWinner, League, LeagueInstance, UserLeague, Clap,
-                       UserFollowing, Feed, Gem, DrawImage, Notif, ActiveSession)
+                     Purchase, Prize, Draw, DrawTicketBlock, DrawParticipant, DrawWinner, League, LeagueInstance, UserLeague, Clap,
+                       UserFollowing, Feed, Gem, DrawImage, Notif, ActiveSession, XpTotal, XpDailyTotal,
+                       IngestionReceipt, StreakActivityBitmap, GemTransaction, LeagueResult,
+                       CompanyLeagueConfig)
 # Register your models here.
 
 # Customizing the display and functionality of the CustomUser model in the admin interface
@@ -55,6 +57,32 @@ class XpAdmin(admin.ModelAdmin):
     list_per_page = 20
 
 
+@admin.register(XpTotal)
+class XpTotalAdmin(admin.ModelAdmin):
+    list_display = ('user', 'total_xp', 'steps_xp', 'workout_xp')
+    search_fields = ('user__email', 'user__username')
+    ordering = ('-total_xp',)
+    list_per_page = 20
+
+
+@admin.register(XpDailyTotal)
+class XpDailyTotalAdmin(admin.ModelAdmin):
+    list_display = ('user', 'date', 'total_xp', 'steps_xp', 'workout_xp')
+    search_fields = ('user__email', 'user__username')
+    list_filter = ('date',)
+    ordering = ('-date',)
+    list_per_page = 20
+
+
+@admin.register(IngestionReceipt)
+class IngestionReceiptAdmin(admin.ModelAdmin):
+    list_display = ('user', 'endpoint', 'sync_key', 'status_code', 'created_at')
+    search_fields = ('user__email', 'sync_key')
+    list_filter = ('endpoint', 'created_at')
+    ordering = ('-created_at',)
+    list_per_page = 20
+
+
 # Customizing the display and functionality of the Streak model in the admin interface
 @admin.register(Streak)
 class StreakAdmin(admin.ModelAdmin):
@@ -64,6 +92,23 @@ class StreakAdmin(admin.ModelAdmin):
     ordering = ('user', 'timeStamp')
     list_per_page = 20
 
+@admin.register(GemTransaction)
+class GemTransactionAdmin(admin.ModelAdmin):
+    list_display = ('user', 'kind', 'amount', 'balance_after', 'gem_date', 'created_at')
+    search_fields = ('user__email', 'user__username')
+    list_filter = ('kind', 'created_at')
+    ordering = ('-created_at',)
+    list_per_page = 20
+
+
+@admin.register(StreakActivityBitmap)
+class StreakActivityBitmapAdmin(admin.ModelAdmin):
+    list_display = ('user', 'year')
+    search_fields = ('user__email', 'user__username')
+    list_filter = ('year',)
+    ordering = ('user', 'year')
+    list_per_page = 20
+
 # Customizing the display and functionality of the DailySteps model in the admin interface
 @admin.register(DailySteps)
 class DailyStepsAdmin(admin.ModelAdmin):
@@ -122,15 +167,22 @@ class DrawImageAdmin(admin.ModelAdmin):
     list_per_page = 20
 
 
-# Customizing the display and functionality of the DrawEntry model in the admin interface
-@admin.register(DrawEntry)
-class DrawEntryAdmin(admin.ModelAdmin):
-    list_display = ('id','user', 'draw', 'timestamp')
+# Customizing the display and functionality of the DrawTicketBlock model in the admin interface
+@admin.register(DrawTicketBlock)
+class DrawTicketBlockAdmin(admin.ModelAdmin):
+    list_display = ('id','user', 'draw', 'quantity', 'offset', 'timestamp')
     search_fields = ('user__email', 'draw__draw_name')
     list_filter = ('timestamp',)
     ordering = ('draw', 'user')
     list_per_page = 20
 
+@admin.register(DrawParticipant)
+class DrawParticipantAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'draw', 'entry_count')
+    search_fields = ('user__email', 'draw__draw_name')
+    ordering = ('draw', 'user')
+    list_per_page = 20
+
 # Customizing the display and functionality of the DrawWinner model in the admin interface
 @admin.register(DrawWinner)
 class DrawWinnerAdmin(admin.ModelAdmin):
@@ -152,7 +204,7 @@ class LeagueAdmin(admin.ModelAdmin):
 # Customizing the display and functionality of the LeagueInstance model in the admin interface
 @admin.register(LeagueInstance)
 class LeagueInstanceAdmin(admin.ModelAdmin):
-    list_display = ('id', 'league', 'league_start', 'league_end', 'company', 'is_active', 'max_participants')  # Fields to display
+    list_display = ('id', 'league', 'league_start', 'league_end', 'company', 'is_active', 'participant_count', 'max_participants')  # Fields to display
     search_fields = ('id','league__name', 'company__name')  # Search by league name
     list_filter = ('company', 'league_start', 'league_end', 'is_active')  # Filter options
     ordering = ('league_start',)  # Ordering of the list
@@ -168,6 +220,23 @@ class UserLeagueAdmin(admin.ModelAdmin):
     list_per_page = 20  # Pagination
 
 
+@admin.register(CompanyLeagueConfig)
+class CompanyLeagueConfigAdmin(admin.ModelAdmin):
+    list_display = ('company', 'member_count', 'highest_level', 'lowest_order', 'highest_order', 'updated_at')
+    search_fields = ('company__name',)
+    ordering = ('company',)
+    list_per_page = 20
+
+
+@admin.register(LeagueResult)
+class LeagueResultAdmin(admin.ModelAdmin):
+    list_display = ('user', 'league_instance', 'league', 'company', 'rank', 'participants', 'status', 'gems_obtained', 'xp')
+    search_fields = ('user__email', 'user__username', 'league_instance__id')
+    list_filter = ('status', 'league', 'company')
+    ordering = ('-league_end', 'league_instance', 'rank')
+    list_per_page = 20
+
+
 @admin.register(UserFollowing)
 class UserFollowingAdmin(admin.ModelAdmin):
     list_display = ('follower', 'following', 'followed_at')  # Display these fields in the list view
@@ -1,11 +1,42 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from urllib.parse import parse_qs
 import json
 import logging
 
 
 logger = logging.getLogger(__name__)
 
+
+def wants_ranking_deltas(scope):
+    """League sockets opened with ?protocol=delta get a snapshot and then only ranking deltas."""
+    return parse_qs(scope.get('query_string', b'').decode()).get('protocol') == ['delta']
+
+
+@database_sync_to_async
+def published_rankings_message(league_instance, user_id):
+    """The rankings delta clients currently hold, as the snapshot message sent on connect."""
+    from myapp.ranking_service import published_rankings, with_user_rank
+    seq, snapshot = published_rankings(league_instance)
+    return dict(with_user_rank(snapshot, user_id), type='rankings_snapshot', seq=seq)
+
+
+def league_update_for(event, user_id):
+    """
+    The ``send_league_update`` payload for one socket's user, or None when it is not meant for them.
+
+    Next-league updates are sent once per destination instance with the moved users'
+    ranks in ``user_ranks``; each user only receives their own destination's rankings,
+    with their rank as ``user_rank``.
+    """
+    user_ranks = event.get('user_ranks')
+    if user_ranks is None:
+        return event['data']
+    if str(user_id) not in user_ranks:
+        return None
+    return dict(event['data'], user_rank=user_ranks[str(user_id)])
+
+
 class TestConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         user = self.scope["user"]
@@ -52,7 +83,11 @@ class GlobalLeagueConsumer(AsyncWebsocketConsumer):
         
         # Use the league_instance ID for the group name
         self.league_instance_id = user_global_league.league_instance.id
-        self.group_name = f'global_league_{self.league_instance_id}'
+        self.delta_protocol = wants_ranking_deltas(self.scope)
+        if self.delta_protocol:
+            self.group_name = f'global_league_delta_{self.league_instance_id}'
+        else:
+            self.group_name = f'global_league_{self.league_instance_id}'
         
         # Join the group
         await self.channel_layer.group_add(self.group_name, self.channel_name)
@@ -60,10 +95,15 @@ class GlobalLeagueConsumer(AsyncWebsocketConsumer):
         # Accept the WebSocket connection
         await self.accept()
 
+        # Joined before reading the snapshot, so no delta after it can be missed
+        if self.delta_protocol:
+            message = await published_rankings_message(user_global_league.league_instance, user.id)
+            await self.send(text_data=json.dumps(message))
+
     @database_sync_to_async
     def get_user_global_league(self, user):
         from myapp.models import UserLeague
-        return UserLeague.objects.filter(user=user, league_instance__is_active=True, league_instance__company=None).select_related('league_instance').first()
+        return UserLeague.objects.filter(user=user, league_instance__is_active=True, league_instance__company=None).select_related('league_instance__league').first()
 
     async def disconnect(self, close_code):
         # Ensure group_name is set before trying to leave the group
@@ -73,6 +113,11 @@ class GlobalLeagueConsumer(AsyncWebsocketConsumer):
 
     async def send_league_update(self, event):
         # print(f"Sending league update: {event['data']}")
+        data = league_update_for(event, self.scope['user'].id)
+        if data is not None:
+            await self.send(text_data=json.dumps(data))
+
+    async def send_league_delta(self, event):
         await self.send(text_data=json.dumps(event['data']))
 
 
@@ -93,17 +138,25 @@ class CompanyLeagueConsumer(AsyncWebsocketConsumer):
         
         # Add the user to the WebSocket group for their company league
         self.league_id = user_company_league.league_instance.id
-        self.group_name = f'company_league_{self.league_id}'
+        self.delta_protocol = wants_ranking_deltas(self.scope)
+        if self.delta_protocol:
+            self.group_name = f'company_league_delta_{self.league_id}'
+        else:
+            self.group_name = f'company_league_{self.league_id}'
         await self.channel_layer.group_add(self.group_name, self.channel_name)
         # print(f"{self.group_name} - Connected to company league group")
 
         # Accept the WebSocket connection
         await self.accept()
 
+        if self.delta_protocol:
+            message = await published_rankings_message(user_company_league.league_instance, user.id)
+            await self.send(text_data=json.dumps(message))
+
     @database_sync_to_async
     def get_user_company_league(self, user):
         from myapp.models import UserLeague
-        return UserLeague.objects.filter(user=user, league_instance__is_active=True, league_instance__company__isnull=False).select_related('league_instance').first()
+        return UserLeague.objects.filter(user=user, league_instance__is_active=True, league_instance__company__isnull=False).select_related('league_instance__league').first()
 
     async def disconnect(self, close_code):
         # Ensure group_name is set and not empty before attempting to use it 
@@ -111,6 +164,11 @@ class CompanyLeagueConsumer(AsyncWebsocketConsumer):
             await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
     async def send_league_update(self, event):
+        data = league_update_for(event, self.scope['user'].id)
+        if data is not None:
+            await self.send(text_data=json.dumps(data))
+
+    async def send_league_delta(self, event):
         await self.send(text_data=json.dumps(event['data']))
 
 
@@ -286,8 +344,8 @@ class DrawConsumer(AsyncWebsocketConsumer):
 
     @database_sync_to_async
     def user_has_entry(self, draw_id):
-        from  myapp.models import DrawEntry
-        return DrawEntry.objects.filter(draw_id=draw_id, user=self.user).exists()
+        from  myapp.models import DrawTicketBlock
+        return DrawTicketBlock.objects.filter(draw_id=draw_id, user=self.user).exists()
 
 
 class CustomGlobalLeagueConsumer(AsyncWebsocketConsumer):
@@ -0,0 +1,262 @@
+"""
+Gem balance ledger.
+
+A user's available gems are the XP and manual gems on their Gem rows minus
+``gems_spent``. Instead of aggregating the Gem rows on every read, each change
+appends a GemTransaction and moves CustomUser.gem_balance by the same amount in
+the same transaction. get_gem_balance() is the single way to read a balance;
+reconcile_gem_ledger() checks the ledger and column against the Gem rows.
+"""
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from functools import partial
+
+from django.db import transaction
+from django.db.models import F, Q, Sum
+from django.utils import timezone
+
+from .models import CustomUser, Gem, GemTransaction
+
+logger = logging.getLogger(__name__)
+
+
+class InsufficientGems(Exception):
+    """Raised by spend_gems() when the balance does not cover the cost."""
+
+    def __init__(self, balance, cost):
+        super().__init__(f"Balance of {balance} gems does not cover {cost} gems")
+        self.balance = balance
+        self.cost = cost
+
+
+def get_gem_balance(user, refresh=True):
+    """
+    Return the user's available gems, never negative.
+
+    Args:
+        user (CustomUser): The user.
+        refresh (bool): Read the column from the database. Pass False when ``user``
+            was just loaded and its ``gem_balance`` is current.
+    """
+    if refresh:
+        balance = CustomUser.objects.filter(pk=user.pk).values_list('gem_balance', flat=True).first() or 0
+    else:
+        balance = user.gem_balance
+    return max(0, balance)
+
+
+def _apply(user_id, entries):
+    """Append ledger ``entries`` of (kind, amount, gem_date) and move the balance column by their total."""
+    entries = [entry for entry in entries if entry[1]]
+    if not entries:
+        return None
+
+    with transaction.atomic():
+        total = sum(amount for _, amount, _ in entries)
+        CustomUser.objects.filter(pk=user_id).update(gem_balance=F('gem_balance') + total)
+        balance = CustomUser.objects.filter(pk=user_id).values_list('gem_balance', flat=True).get()
+
+        # Entries are written oldest first so balance_after reads as a running balance
+        running = balance - total
+        transactions = []
+        for kind, amount, gem_date in entries:
+            running += amount
+            transactions.append(GemTransaction(
+                user_id=user_id, kind=kind, amount=amount, balance_after=running, gem_date=gem_date
+            ))
+        GemTransaction.objects.bulk_create(transactions)
+    return balance
+
+
+def record_gem_row_change(gem, old, new):
+    """
+    Record the change to a Gem row's XP and manual gems; called by Gem.save() while
+    it holds the row lock. ``old`` and ``new`` map ``xp_gem`` and ``manual_gem`` to the
+    stored values before and after the save; ``old`` is empty for a new row.
+    """
+    return _apply(gem.user_id, [
+        ('xp', (new['xp_gem'] or 0) - (old.get('xp_gem') or 0), gem.date),
+        ('manual', (new['manual_gem'] or 0) - (old.get('manual_gem') or 0), gem.date),
+    ])
+
+
+def spend_gems(user, cost):
+    """
+    Spend ``cost`` gems: raise ``gems_spent`` and lower the balance, refusing to go below zero.
+
+    Must run inside the caller's transaction so a later failure undoes the spend.
+    Updates ``user.gems_spent`` and ``user.gem_balance`` in memory as well.
+
+    Raises:
+        InsufficientGems: If the user's balance is lower than ``cost``.
+    """
+    locked = CustomUser.objects.select_for_update().only('gem_balance', 'gems_spent').get(pk=user.pk)
+    if locked.gem_balance < cost:
+        raise InsufficientGems(max(0, locked.gem_balance), cost)
+
+    CustomUser.objects.filter(pk=user.pk).update(gems_spent=F('gems_spent') + cost)
+    user.gem_balance = _apply(user.pk, [('spend', -cost, None)])
+    user.gems_spent = locked.gems_spent + cost
+    return user.gem_balance
+
+
+def credit_manual_gems(amounts, gem_date):
+    """
+    Add manual gems for many users at once, as add_manual_gem() does for one.
+
+    The day's Gem rows are upserted and raised with bulk operations, and the balances
+    and ledger are updated in the same transaction. No per-row websocket update is
+    sent; callers broadcast the new balances themselves.
+
+    Args:
+        amounts (dict): user id -> gems to add. Zero amounts are skipped.
+        gem_date (date): The day the gems are credited to.
+    """
+    amounts = {user_id: amount for user_id, amount in amounts.items() if amount}
+    if not amounts:
+        return
+
+    with transaction.atomic():
+        Gem.objects.bulk_create([Gem(user_id=user_id, date=gem_date) for user_id in amounts], ignore_conflicts=True)
+        gems = list(Gem.objects.select_for_update().filter(user_id__in=list(amounts), date=gem_date))
+        for gem in gems:
+            gem.manual_gem = (gem.manual_gem or 0) + amounts[gem.user_id]
+            gem.copy_manual_gem = (gem.copy_manual_gem or 0) + amounts[gem.user_id]
+        Gem.objects.bulk_update(gems, ['manual_gem', 'copy_manual_gem'], batch_size=1000)
+
+        users = list(CustomUser.objects.select_for_update().filter(pk__in=list(amounts)).only('id', 'gem_balance'))
+        for user in users:
+            user.gem_balance += amounts[user.id]
+        CustomUser.objects.bulk_update(users, ['gem_balance'], batch_size=1000)
+        GemTransaction.objects.bulk_create([
+            GemTransaction(user_id=user.id, kind='manual', amount=amounts[user.id], balance_after=user.gem_balance,
+                           gem_date=gem_date)
+            for user in users
+        ], batch_size=1000)
+
+
+def _timezones_at_week_start(timezones, now):
+    """Return the timezones whose local time is in the first hour of Monday, with their local time."""
+    local_times = {tz: now.astimezone(tz) for tz in timezones}
+    return {tz: local for tz, local in local_times.items() if local.weekday() == 0 and local.hour == 0}
+
+
+def reset_weekly_gems(now=None, batch_size=2000):
+    """
+    Weekly gem reset for every user whose local Monday midnight just passed.
+
+    Only users with gems or gems spent are selected, so repeated runs within the
+    hour and users with nothing to reset cost nothing. Per batch, the Gem rows are
+    zeroed and the previous day's rows upserted in bulk. Balances and gems spent
+    are zeroed and the removed gems recorded in the ledger. Each reset user then
+    gets one websocket gem update after commit.
+
+    Returns:
+        int: Number of users reset.
+    """
+    from .tasks import send_gem_update
+
+    now = now or timezone.now()
+    users = CustomUser.objects.exclude(timezone=None).exclude(is_superuser=True).exclude(is_staff=True)
+    timezones = set(users.order_by().values_list('timezone', flat=True).distinct())
+    at_week_start = _timezones_at_week_start(timezones, now)
+    if not at_week_start:
+        return 0
+
+    due = users.filter(timezone__in=list(at_week_start)).filter(~Q(gem_balance=0) | Q(gems_spent__gt=0))
+    reset = 0
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                due.filter(id__gt=last_id).order_by('id').select_for_update()
+                .only('id', 'timezone', 'gem_balance')[:batch_size]
+            )
+            if not batch:
+                break
+            last_id = batch[-1].id
+            user_ids = [user.id for user in batch]
+            previous_days = {user.id: at_week_start[user.timezone].date() - timedelta(days=1) for user in batch}
+
+            Gem.objects.filter(user_id__in=user_ids).filter(Q(xp_gem__gt=0) | Q(manual_gem__gt=0)).update(
+                xp_gem=0, manual_gem=0
+            )
+            Gem.objects.bulk_create(
+                [Gem(user_id=user_id, date=day) for user_id, day in previous_days.items()],
+                ignore_conflicts=True
+            )
+            CustomUser.objects.filter(id__in=user_ids).update(gems_spent=0, gem_balance=0)
+            GemTransaction.objects.bulk_create([
+                GemTransaction(user_id=user.id, kind='reset', amount=-user.gem_balance, balance_after=0,
+                               gem_date=previous_days[user.id])
+                for user in batch if user.gem_balance
+            ])
+
+            channel_messages = [
+                {'user_id': user_id, 'gem_count': 0, 'channel_name': f'gem_{user_id}'} for user_id in user_ids
+            ]
+            transaction.on_commit(partial(send_gem_update.delay, channel_messages))
+        reset += len(batch)
+
+    logger.info(f"Weekly gem reset for {reset} users")
+    return reset
+
+
+def _balances_from_gem_rows(user_ids=None):
+    """Balance per user as derived from the Gem rows and gems_spent."""
+    users = CustomUser.objects.all()
+    gems = Gem.objects.all()
+    if user_ids is not None:
+        users = users.filter(pk__in=user_ids)
+        gems = gems.filter(user_id__in=user_ids)
+
+    expected = {
+        user_id: -spent for user_id, spent in users.values_list('id', 'gems_spent')
+    }
+    for row in gems.values('user_id').annotate(xp=Sum('xp_gem'), manual=Sum('manual_gem')).order_by():
+        expected[row['user_id']] = expected.get(row['user_id'], 0) + (row['xp'] or 0) + (row['manual'] or 0)
+    return expected
+
+
+def reconcile_gem_ledger(user_ids=None, fix=False):
+    """
+    Compare every user's balance column and ledger total with the balance derived from the Gem rows.
+
+    Args:
+        user_ids (list, optional): Restrict the check to these users. Defaults to every user.
+        fix (bool): Append an adjustment entry and correct the column for each mismatch.
+
+    Returns:
+        list: One dict per mismatched user with ``user_id``, ``expected``, ``balance`` and ``ledger``.
+    """
+    expected = _balances_from_gem_rows(user_ids)
+    columns = dict(CustomUser.objects.filter(pk__in=list(expected)).values_list('id', 'gem_balance'))
+    ledger = defaultdict(int)
+    transactions = GemTransaction.objects.all()
+    if user_ids is not None:
+        transactions = transactions.filter(user_id__in=user_ids)
+    for row in transactions.values('user_id').annotate(total=Sum('amount')).order_by():
+        ledger[row['user_id']] = row['total']
+
+    mismatches = []
+    for user_id, balance in expected.items():
+        if columns[user_id] == balance and ledger[user_id] == balance:
+            continue
+        mismatches.append({
+            'user_id': user_id,
+            'expected': balance,
+            'balance': columns[user_id],
+            'ledger': ledger[user_id],
+        })
+        if fix:
+            with transaction.atomic():
+                if ledger[user_id] != balance:
+                    GemTransaction.objects.create(
+                        user_id=user_id, kind='adjustment', amount=balance - ledger[user_id], balance_after=balance
+                    )
+                CustomUser.objects.filter(pk=user_id).update(gem_balance=balance)
+
+    if mismatches:
+        logger.warning(f"Gem ledger mismatches for {len(mismatches)} users{' (fixed)' if fix else ''}")
+    return mismatches
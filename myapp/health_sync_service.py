@@ -0,0 +1,244 @@
+import logging
+from datetime import timezone
+from zoneinfo import ZoneInfo
+
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.signals import post_save
+
+from .live_leaderboard import add_league_xp, is_live_leaderboard
+from .models import CustomUser, DailySteps, WorkoutActivity, Xp, UserLeague
+from .ranking_service import invalidate_ranking_snapshots
+from .serializers import DailyStepsSerializer, WorkoutActivitySerializer
+from .xp_pipeline import run_xp_pipeline
+from .xp_service import record_xp_batch, get_total_xp_all_time, apply_steps_to_rollup, apply_workouts_to_rollup
+
+logger = logging.getLogger(__name__)
+
+
+def _validate_items(items, serializer_class, context):
+    """
+    Validate every item of a batch with the single-item serializer.
+
+    Returns:
+        tuple: (valid, results) where ``valid`` is a list of (index, serializer) pairs
+        and ``results`` holds the per-item result entries, invalid ones already filled in.
+    """
+    valid = []
+    results = []
+    for index, item in enumerate(items):
+        serializer = serializer_class(data=item, context=context)
+        if serializer.is_valid():
+            valid.append((index, serializer))
+            results.append({'index': index, 'status': None})
+        else:
+            results.append({'index': index, 'status': 'invalid', 'errors': serializer.errors})
+    return valid, results
+
+
+def _to_utc(user, xp_date):
+    # Same conversion as the single-item serializers use for league XP
+    user_timezone = ZoneInfo(user.timezone.key)
+    return xp_date.replace(tzinfo=user_timezone).astimezone(timezone.utc)
+
+
+def _apply_steps(user, valid_steps, step_results, events):
+    """Collapse step items per day and write them with one bulk insert and one bulk update."""
+    # Only the highest step count of each day matters; lower ones are superseded
+    best_per_date = {}
+    for index, serializer in valid_steps:
+        data = serializer.validated_data
+        date = data['timestamp'].date()
+        current = best_per_date.get(date)
+        if current is None or data['step_count'] > current[1]['step_count']:
+            if current is not None:
+                step_results[current[0]].update(status='superseded', date=date)
+            best_per_date[date] = (index, data)
+        else:
+            step_results[index].update(status='superseded', date=date)
+
+    if not best_per_date:
+        return []
+
+    existing = {
+        steps.date: steps
+        for steps in DailySteps.objects.select_for_update().filter(user=user, date__in=best_per_date.keys())
+    }
+
+    to_create = []
+    to_update = []
+    for date, (index, data) in sorted(best_per_date.items()):
+        step_count = data['step_count']
+        timestamp = data['timestamp']
+        daily_steps = existing.get(date)
+
+        if daily_steps is None:
+            new_xp = round(step_count / 10, 1)
+            daily_steps = DailySteps(user=user, date=date, step_count=step_count, xp=new_xp, timestamp=timestamp)
+            to_create.append(daily_steps)
+            step_results[index].update(status='created', date=date, xp=new_xp)
+        elif step_count > daily_steps.step_count:
+            new_xp = round((step_count - daily_steps.step_count) / 10, 1)
+            daily_steps.step_count = step_count
+            daily_steps.xp = round(daily_steps.xp + new_xp, 1)
+            daily_steps.timestamp = max(daily_steps.timestamp, timestamp)
+            to_update.append(daily_steps)
+            step_results[index].update(status='updated', date=date, xp=new_xp)
+        else:
+            step_results[index].update(
+                status='unchanged',
+                date=date,
+                detail=f"Step count is less than or equal to the latest entry for this day, {daily_steps.step_count} steps."
+            )
+            continue
+
+        events.append({'date': date, 'timestamp': timestamp, 'xp': new_xp, 'source': 'steps'})
+
+    DailySteps.objects.bulk_create(to_create)
+    DailySteps.objects.bulk_update(to_update, ['step_count', 'xp', 'timestamp'])
+    apply_steps_to_rollup(user.id, to_create + to_update)
+    return [(steps, True) for steps in to_create] + [(steps, False) for steps in to_update]
+
+
+def _apply_workouts(user, valid_workouts, workout_results, events):
+    """Insert every new workout of the batch with one bulk insert."""
+    start_times = [serializer.validated_data['start_datetime'] for _, serializer in valid_workouts]
+    # Same rule as WorkoutActivitySerializer.create: a duplicate matches both start and end
+    existing = set(
+        WorkoutActivity.objects.filter(user=user, start_datetime__in=start_times)
+        .values_list('start_datetime', 'end_datetime')
+    )
+
+    to_create = []
+    created_indexes = []
+    for index, serializer in valid_workouts:
+        data = dict(serializer.validated_data)
+        start_datetime = data['start_datetime']
+        span = (start_datetime, data['end_datetime'])
+        if span in existing:
+            workout_results[index].update(
+                status='duplicate',
+                detail=WorkoutActivitySerializer.duplicate_message
+            )
+            continue
+        existing.add(span)
+
+        xp_earned = serializer.calculate_xp(data)
+        data['xp'] = xp_earned
+        to_create.append(WorkoutActivity(user=user, **data))
+        created_indexes.append(index)
+        workout_results[index].update(status='created', date=start_datetime.date(), xp=xp_earned)
+        events.append({'date': start_datetime.date(), 'timestamp': start_datetime, 'xp': xp_earned, 'source': 'workout'})
+
+    WorkoutActivity.objects.bulk_create(to_create)
+    apply_workouts_to_rollup(user.id, to_create)
+    for index, workout in zip(created_indexes, to_create):
+        workout_results[index]['id'] = workout.id
+    return to_create
+
+
+def _update_leagues(user, events):
+    """Add the batch XP to each active league membership with a single bulk update, or to the live boards."""
+    active_leagues = list(
+        UserLeague.objects.filter(user=user, league_instance__is_active=True)
+        .select_related('league_instance__company')
+    )
+    live = is_live_leaderboard()
+    for user_league in active_leagues:
+        league_start = user_league.league_instance.league_start
+        gained = sum(event['xp'] for event in events if _to_utc(user, event['timestamp']) >= league_start)
+        if live:
+            add_league_xp(user_league, gained)
+        elif user_league.league_instance.company is not None:
+            user_league.xp_company += gained
+        else:
+            user_league.xp_global += gained
+    if live:
+        return
+    UserLeague.objects.bulk_update(active_leagues, ['xp_company', 'xp_global'])
+    invalidate_ranking_snapshots(user_league.league_instance_id for user_league in active_leagues)
+
+
+def _run_cascade(user, last_xp_per_date, step_rows, workouts):
+    """
+    Run the XP-applied pipeline once for the whole batch instead of once per item.
+
+    Streaks and gems are per day, so those stages run for every affected day in
+    date order. The final day runs the full pipeline so league placement, ranking
+    broadcasts and streak reminders happen exactly once.
+    """
+    dates = sorted(last_xp_per_date)
+    for date in dates[:-1]:
+        run_xp_pipeline(last_xp_per_date[date], stages=('streak', 'gems'))
+
+    if dates:
+        run_xp_pipeline(last_xp_per_date[dates[-1]])
+
+    # Daily task progress listens on the activity models themselves
+    for daily_steps, created in step_rows:
+        post_save.send(sender=DailySteps, instance=daily_steps, created=created)
+    for workout in workouts:
+        post_save.send(sender=WorkoutActivity, instance=workout, created=True)
+
+    if step_rows:
+        total_daily_step_count = DailySteps.objects.filter(user=user).aggregate(
+            total_steps=Sum('step_count')
+        )['total_steps'] or 0
+        DailyStepsSerializer().check_dynamic_milestones(user, total_daily_step_count)
+
+
+def sync_health_data(request, steps, workouts):
+    """
+    Validate and store a batch of daily step totals and workouts for the requesting user.
+
+    Every item is validated with the same serializer as the single-item endpoints.
+    Valid items are written in one transaction with bulk inserts, then the
+    streak/gem/league/broadcast cascade runs once for the whole batch.
+
+    Args:
+        request: The incoming request; ``request.user`` owns the data.
+        steps (list): Raw daily step payloads, as accepted by ``/daily-steps/``.
+        workouts (list): Raw workout payloads, as accepted by ``/workout/``.
+
+    Returns:
+        dict: Per-item results for steps and workouts plus the resulting XP totals.
+    """
+    user = request.user
+    context = {'request': request}
+
+    valid_steps, step_results = _validate_items(steps, DailyStepsSerializer, context)
+    valid_workouts, workout_results = _validate_items(workouts, WorkoutActivitySerializer, context)
+
+    events = []
+    last_xp_per_date = {}
+    with transaction.atomic():
+        # Serialize concurrent syncs of the same user
+        CustomUser.objects.select_for_update().filter(pk=user.pk).first()
+
+        step_rows = _apply_steps(user, valid_steps, step_results, events)
+        new_workouts = _apply_workouts(user, valid_workouts, workout_results, events)
+
+        if events:
+            last_xp_per_date = record_xp_batch(user, events)
+            _update_leagues(user, events)
+
+    if events:
+        _run_cascade(user, last_xp_per_date, step_rows, new_workouts)
+
+    logger.info(
+        f"Health sync for user {user.id}: {len(steps)} step items, {len(workouts)} workouts, "
+        f"{len(events)} XP records written"
+    )
+
+    total_xp_all_time = get_total_xp_all_time(user)
+    return {
+        'steps': step_results,
+        'workouts': workout_results,
+        'xp': {
+            'days': [
+                {'date': date, 'totalXpToday': round(xp.totalXpToday, 1)}
+                for date, xp in sorted(last_xp_per_date.items())
+            ],
+            'totalXpAllTime': round(total_xp_all_time, 1),
+        },
+    }
@@ -0,0 +1,97 @@
+import logging
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IngestionReceipt
+
+logger = logging.getLogger(__name__)
+
+SYNC_KEY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+SYNC_KEY_MAX_LENGTH = IngestionReceipt._meta.get_field('sync_key').max_length
+
+
+def get_sync_key(request):
+    """Read the client sync key from the Idempotency-Key header or a ``sync_key`` body field."""
+    sync_key = request.META.get(SYNC_KEY_HEADER)
+    if not sync_key and hasattr(request.data, 'get'):
+        sync_key = request.data.get('sync_key')
+    return str(sync_key).strip() if sync_key else None
+
+
+def _replay(receipt, endpoint):
+    if receipt.endpoint != endpoint:
+        return Response(
+            {"error": "This sync key was already used for a different request."},
+            status=status.HTTP_409_CONFLICT
+        )
+    return Response(receipt.response, status=receipt.status_code)
+
+
+class _FailedRequest(Exception):
+    """Raised to roll back the claimed sync key when the wrapped request does not succeed."""
+
+    def __init__(self, response):
+        self.response = response
+
+
+def idempotent_ingestion(endpoint):
+    """
+    Make an ingestion POST handler idempotent on the client's sync key.
+
+    The key is claimed with a unique (user, sync_key) row in the same transaction
+    as the write, so a concurrent retry waits on the claim and then replays the
+    stored response. Successful responses are stored; unsuccessful ones release
+    the key so the client can retry. Requests without a key behave as before.
+    """
+    def decorator(view_method):
+        @wraps(view_method)
+        def wrapper(self, request, *args, **kwargs):
+            sync_key = get_sync_key(request)
+            if not sync_key:
+                return view_method(self, request, *args, **kwargs)
+            if len(sync_key) > SYNC_KEY_MAX_LENGTH:
+                return Response(
+                    {"error": f"Sync key cannot be longer than {SYNC_KEY_MAX_LENGTH} characters."},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            receipt = IngestionReceipt.objects.filter(user=request.user, sync_key=sync_key).first()
+            if receipt:
+                return _replay(receipt, endpoint)
+
+            try:
+                with transaction.atomic():
+                    receipt = IngestionReceipt.objects.create(user=request.user, sync_key=sync_key, endpoint=endpoint)
+                    response = view_method(self, request, *args, **kwargs)
+                    if not status.is_success(response.status_code):
+                        raise _FailedRequest(response)
+                    receipt.status_code = response.status_code
+                    receipt.response = response.data
+                    receipt.save(update_fields=['status_code', 'response'])
+            except _FailedRequest as failed:
+                return failed.response
+            except IntegrityError:
+                # Another request with the same key committed first
+                receipt = IngestionReceipt.objects.filter(user=request.user, sync_key=sync_key).first()
+                if receipt is None:
+                    raise
+                logger.info(f"Replaying {endpoint} result for user {request.user.id}, sync key {sync_key}")
+                return _replay(receipt, endpoint)
+
+            return response
+        return wrapper
+    return decorator
+
+
+def purge_ingestion_receipts(retention_days=None):
+    """Delete receipts older than the retention window. Returns the number deleted."""
+    retention_days = retention_days or getattr(settings, 'INGESTION_RECEIPT_RETENTION_DAYS', 7)
+    cutoff = timezone.now() - timedelta(days=retention_days)
+    deleted, _ = IngestionReceipt.objects.filter(created_at__lt=cutoff).delete()
+    return deleted
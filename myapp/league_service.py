@@ -1,463 +1,468 @@
-from django.db import transaction, IntegrityError
-from django.db.models import Count, F
-from .models import UserLeague, LeagueInstance, League
-from django.utils import timezone
+"""
+Set-based league settlement.
+
+When league instances expire, every participant is ranked, rewarded and moved
+to an instance of the next, previous or same league. settle_expired_leagues()
+does this for all expired instances at once: ranks and participant counts come
+from one window-function query, outcomes are decided in memory, target instances
+are filled from one capacity query (new instances are bulk-created when they run
+out), and memberships, gems, notifications, LeagueResult history and the XP reset
+are written with bulk operations. The number of queries depends on the number of
+batches and target leagues, not on the number of participants.
+
+The settlement tasks fan this out: settlement_shares() splits the expired
+instances into independent shares and settle_league_instances() settles one
+share, idempotently, on whichever worker picks it up.
+"""
+import logging
+from collections import defaultdict, namedtuple
 from datetime import timedelta
-from .utils import add_manual_gem
-import pytz
-
-
-
-
-def promote_user(user, gems_obtained, current_league_instance):
-    with transaction.atomic():
-        # Find the user's current active league
-        current_league = current_league_instance.league
+from functools import partial
 
-        add_manual_gem(user=user, manual_gem_count=gems_obtained, date=timezone.now().date())
+import pytz
+from django.db import transaction
+from django.db.models import Count, F, Max, Min, OuterRef, Q, Subquery, Window
+from django.db.models.functions import Coalesce, RowNumber
+from django.utils import timezone
 
-        # current_league = current_user_league.league_instance.league
-        next_league = League.objects.filter(order__gt=current_league.order).order_by('order').first()
-        print(f"In the promotion view, promoting user {user.username} from current league {current_league}")
+from .gem_service import credit_manual_gems
+from .live_leaderboard import checkpoint_leaderboards, discard_leaderboards, is_live_leaderboard
+from .models import (
+    Company, CompanyLeagueConfig, CustomUser, League, LeagueInstance, LeagueResult, Notif, UserLeague,
+)
+from .ranking_service import cache_ranking_snapshots, invalidate_ranking_snapshots
 
+logger = logging.getLogger(__name__)
 
-        if next_league:
-            print(f'Next league level exists {next_league.name}')
-            # Find or create an available LeagueInstance for the next league
-            next_league_instance = (
-                LeagueInstance.objects
-                .filter(league=next_league, is_active=True, company__isnull=True, league_end__gt=timezone.now())
-                .annotate(participant_count=Count('userleague'))
-                .filter(participant_count__lt=F('max_participants'))
-                .first()
-            )
-            
-            if not next_league_instance:
-                # Calculate the next midnight UK time
-                uk_tz = pytz.timezone('Europe/London')
-                now_uk = timezone.now().astimezone(uk_tz)
-                midnight_uk = (now_uk + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-                
-                # Convert UK midnight to UTC for storage
-                midnight_utc = midnight_uk.astimezone(pytz.utc)
-                print(f'No available league instance for next league {next_league.name}, creating...')
-                next_league_instance = LeagueInstance.objects.create(
-                    league=next_league,
-                    league_start=timezone.now(),
-                    league_end=midnight_utc,
-                    max_participants=10
-                )
-
-            # Attempt to create a new UserLeague entry for the user
-            try:
-                UserLeague.objects.create(user=user, league_instance=next_league_instance, xp_global=0)
-                print(f'user promoted to {next_league} successfully')
-                # current_league_instance.userleague_set.filter(user=user).delete()
-                return f"{user.username} has been promoted to {next_league.name}"
-            except IntegrityError:
-                return f"{user.username} is already in the target league instance."
+PROMOTION_SHARE = 0.30  # Top 30% are promoted
+DEMOTION_SHARE = 0.80  # Bottom 20% are demoted
+RETAIN_GEMS = 10
+NEW_INSTANCE_MAX_PARTICIPANTS = 10
+MIN_USERS_FOR_LEAGUE = 5  # Minimum users to create the first league
 
-        else:
-            print("user is at the highest league level")
-            # Handle users in the highest league by reassigning them to another instance of that league
-            highest_league_instance = (
-                LeagueInstance.objects
-                .filter(league=current_league, is_active=True, company__isnull=True, league_end__gt=timezone.now())
-                .exclude(id=current_league_instance.id)
-                .annotate(participant_count=Count('userleague'))
-                .filter(participant_count__lt=F('max_participants'))
-                .first()
-            )
+# move -> (status, notif_type, phrase used in the notification)
+OUTCOME_LABELS = {
+    'promote': ('Promoted', 'league_promotion', 'promoted to'),
+    'retain': ('Retained', 'league_retained', 'retained in'),
+    'demote': ('Demoted', 'league_demotion', 'demoted to'),
+}
 
-            if not highest_league_instance:
-                # Calculate the next midnight UK time
-                uk_tz = pytz.timezone('Europe/London')
-                now_uk = timezone.now().astimezone(uk_tz)
-                midnight_uk = (now_uk + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-                
-                # Convert UK midnight to UTC for storage
-                midnight_utc = midnight_uk.astimezone(pytz.utc)
-                print(f'No available league instance for highest league {current_league.name}, creating...')
-                highest_league_instance = LeagueInstance.objects.create(
-                    league=current_league,
-                    league_start=timezone.now(),
-                    league_end=midnight_utc,
-                    max_participants=10
-                )
-
-            try:
-                UserLeague.objects.create(user=user, league_instance=highest_league_instance, xp_global=0)
-                # current_league_instance.userleague_set.filter(user=user).delete()
-                print("user has been added to an instance of the highest instance")
-                return f"{user.username} has been reassigned within the highest league: {current_league.name}."
-            except IntegrityError:
-                return f"{user.username} is already in the target league instance."
-
-
-def demote_user(user, gems_obtained, current_league_instance):
-    with transaction.atomic():
-        
-        add_manual_gem(user=user, manual_gem_count=gems_obtained, date=timezone.now().date())
-
-        current_league = current_league_instance.league
-        previous_league = League.objects.filter(order__lt=current_league.order).order_by('-order').first()
-        print(f"In the demotion view, demoting user {user.username} from curren tleague {current_league}")
-
-        if previous_league:
-            print(f" there is a lower league {previous_league}")
-
-            # Find or create an available LeagueInstance for the previous league
-            previous_league_instance = (
-                LeagueInstance.objects
-                .filter(league=previous_league, is_active=True, company__isnull=True, league_end__gt=timezone.now())
-                .annotate(participant_count=Count('userleague'))
-                .filter(participant_count__lt=F('max_participants'))
-                .first()
-            )
+Outcome = namedtuple('Outcome', 'user_id rank move gems')
 
-            if not previous_league_instance:
-                # Calculate the next midnight UK time
-                uk_tz = pytz.timezone('Europe/London')
-                now_uk = timezone.now().astimezone(uk_tz)
-                midnight_uk = (now_uk + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-                
-                # Convert UK midnight to UTC for storage
-                midnight_utc = midnight_uk.astimezone(pytz.utc)
-                print(f'No available league instance for previous league {current_league.name}, creating...')
-                previous_league_instance = LeagueInstance.objects.create(
-                    league=previous_league,
-                    league_start=timezone.now(),
-                    league_end=midnight_utc,
-                    max_participants=10
-                )
-            try:
-                UserLeague.objects.create(user=user, league_instance=previous_league_instance, xp_global=0)
-                # Deactivate the current league membership by deleting the current UserLeague entry
-                # current_league_instance.userleague_set.filter(user=user).delete()
-                return f"{user.username} has been demoted to {previous_league.name}"
-            except IntegrityError:
-                return f"{user.username} is already in the target league instance."
 
+def get_highest_company_league_level(company):
+    if not company:
+        return 0
+    return company_league_configs([company.id])[company.id].highest_level
+
+
+def refresh_company_league_configs(company_ids):
+    """
+    Recompute the CompanyLeagueConfig of ``company_ids`` from their members and
+    active league instances, creating the missing ones.
+
+    Returns:
+        dict: company id -> CompanyLeagueConfig.
+    """
+    company_ids = {company_id for company_id in company_ids if company_id is not None}
+    if not company_ids:
+        return {}
+    league_count = League.objects.count()
+    members = dict(
+        Company.objects.filter(id__in=company_ids).annotate(member_count=Count('members'))
+        .values_list('id', 'member_count')
+    )
+    spans = {
+        row['company_id']: (row['lowest'], row['highest'])
+        for row in LeagueInstance.objects.filter(company_id__in=company_ids, is_active=True)
+        .values('company_id').annotate(lowest=Min('league__order'), highest=Max('league__order')).order_by()
+    }
+    now = timezone.now()
+    configs = []
+    for company_id, member_count in members.items():
+        lowest_order, highest_order = spans.get(company_id, (None, None))
+        configs.append(CompanyLeagueConfig(
+            company_id=company_id, member_count=member_count,
+            # One league per MIN_USERS_FOR_LEAGUE members
+            highest_level=min(member_count // MIN_USERS_FOR_LEAGUE, league_count),
+            lowest_order=lowest_order, highest_order=highest_order, updated_at=now,
+        ))
+    CompanyLeagueConfig.objects.bulk_create(
+        configs, update_conflicts=True, unique_fields=['company'],
+        update_fields=['member_count', 'highest_level', 'lowest_order', 'highest_order', 'updated_at'],
+    )
+    return {config.company_id: config for config in configs}
+
+
+def company_league_configs(company_ids):
+    """The CompanyLeagueConfig of each of ``company_ids``, computing the ones that do not exist yet."""
+    company_ids = set(company_ids)
+    configs = CompanyLeagueConfig.objects.in_bulk(company_ids, field_name='company_id')
+    missing = company_ids - set(configs)
+    if missing:
+        configs.update(refresh_company_league_configs(missing))
+    return configs
+
+
+def _next_uk_midnight(now):
+    uk_tz = pytz.timezone('Europe/London')
+    now_uk = now.astimezone(uk_tz)
+    midnight_uk = (now_uk + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return midnight_uk.astimezone(pytz.utc)
+
+
+def decide_outcome(rank, total, xp, is_highest, is_lowest):
+    """
+    Return the (move, gems) of the participant ranked ``rank`` of ``total`` with ``xp``.
+
+    ``move`` is 'promote', 'retain' or 'demote'. An instance that is both the highest
+    and the lowest league retains everyone.
+    """
+    promotion_threshold = int(total * PROMOTION_SHARE)
+    demotion_threshold = int(total * DEMOTION_SHARE)
+    promotion_gems = max(0, 20 - (rank - 1) * 2)
+
+    if is_highest and is_lowest:
+        return 'retain', RETAIN_GEMS if xp > 0 else 0
+    if is_highest:
+        # Highest league: users can only be retained or demoted
+        return ('retain', RETAIN_GEMS) if rank <= demotion_threshold else ('demote', 0)
+    if is_lowest:
+        if rank <= promotion_threshold:
+            return 'promote', promotion_gems
+        return 'retain', RETAIN_GEMS if xp > 0 else 0
+    if total <= 3:
+        return ('demote', 0) if xp == 0 else ('retain', RETAIN_GEMS)
+    if rank <= promotion_threshold:
+        return 'promote', promotion_gems
+    if rank <= demotion_threshold:
+        return 'retain', RETAIN_GEMS
+    return 'demote', 0
+
+
+def _target_league(move, league, leagues, company_level=None):
+    """
+    The league to move to. Company leagues are promoted at most to ``company_level``
+    and demoted no lower than it; when there is no such league the user stays.
+    """
+    if move == 'promote':
+        candidates = [l for l in leagues if l.order > league.order
+                      and (company_level is None or l.order <= company_level)]
+        return candidates[0] if candidates else league
+    if move == 'demote':
+        candidates = [l for l in leagues if l.order < league.order
+                      and (company_level is None or l.order >= company_level)]
+        return candidates[-1] if candidates else league
+    return league
+
+
+def _ranked_participants(instance_ids, xp_field):
+    """Every membership of the instances with its rank and the instance's participant count, in one query."""
+    partition = [F('league_instance_id')]
+    rows = (
+        UserLeague.objects.filter(league_instance_id__in=instance_ids)
+        .annotate(
+            rank=Window(RowNumber(), partition_by=partition,
+                        order_by=[F(xp_field).desc(), F('user__streak').desc(), F('id').asc()]),
+            participants=Window(Count('id'), partition_by=partition),
+        )
+        .values_list('league_instance_id', 'user_id', xp_field, 'rank', 'participants')
+    )
+    by_instance = defaultdict(list)
+    for instance_id, user_id, xp, rank, total in rows:
+        by_instance[instance_id].append((user_id, xp, rank, total))
+    for participants in by_instance.values():
+        participants.sort(key=lambda row: row[2])
+    return by_instance
+
+
+def place_users(placements, now=None):
+    """
+    Add users to active instances of their target (league, company) buckets.
+
+    Open instances are read by their maintained ``participant_count`` and locked
+    with SKIP LOCKED, so concurrent workers never fill the same slot: an instance
+    another worker is filling is skipped and, if nothing else is open, a new one is
+    created. Counters of the filled instances are raised in the same transaction.
+    Users already in one of the bucket's open instances are left where they are.
+
+    Args:
+        placements (dict): (league_id, company_id) -> list of user ids, in placement order.
+            ``company_id`` is None for global leagues.
+        now (datetime, optional): Only instances ending after ``now`` are filled.
+
+    Returns:
+        dict: user id -> LeagueInstance id.
+    """
+    placements = {key: list(user_ids) for key, user_ids in placements.items() if user_ids}
+    if not placements:
+        return {}
+    now = now or timezone.now()
+
+    buckets = Q()
+    for league_id, company_id in placements:
+        if company_id is None:
+            buckets |= Q(league_id=league_id, company__isnull=True)
         else:
-            print('there is no lower league level')
-            # Handle users in the lowest league by reassigning them to another instance of that league
-            lowest_league_instance = (
-                LeagueInstance.objects
-                .filter(league=current_league, is_active=True, company__isnull=True, league_end__gt=timezone.now())
-                .exclude(id=current_league_instance.id)
-                .annotate(participant_count=Count('userleague'))
-                .filter(participant_count__lt=F('max_participants'))
-                .first()
-            )
+            buckets |= Q(league_id=league_id, company_id=company_id)
 
-            if not lowest_league_instance:
-                # Calculate the next midnight UK time
-                uk_tz = pytz.timezone('Europe/London')
-                now_uk = timezone.now().astimezone(uk_tz)
-                midnight_uk = (now_uk + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-                
-                # Convert UK midnight to UTC for storage
-                midnight_utc = midnight_uk.astimezone(pytz.utc)
-                print("no lower league level instance so creating")
-                lowest_league_instance = LeagueInstance.objects.create(
-                    league=current_league,
-                    league_start=timezone.now(),
-                    league_end=midnight_utc,
-                    max_participants=10
-                )
-
-            try:
-                UserLeague.objects.create(user=user, league_instance=lowest_league_instance, xp_global=0)
-                # current_league_instance.userleague_set.filter(user=user).delete()
-                print(f"{user.username} has been reassigned to another lowest league instance")
-                return f"{user.username} has been reassigned within the lowest league: {current_league.name}."
-            except IntegrityError:
-                return f"{user.username} is already in the target league instance."
-
-
-def retain_user(user, gems_obtained, current_league_instance):
     with transaction.atomic():
-        # Get the user's current active league
-        current_league = current_league_instance.league
-        
-        add_manual_gem(user=user, manual_gem_count=gems_obtained, date=timezone.now().date())
-
-        # current_league = current_user_league.league_instance.league
-        print(f"In the retaining view, retaining user {user.username} in current league {current_league}")
-
-        # Find or create another active instance of the same league with available slots
-        # Find only leagues whose enddate is greater than time.now
-        retain_league_instance = (
-            LeagueInstance.objects
-            .filter(league=current_league, is_active=True, company__isnull=True, league_end__gt=timezone.now())
-            .exclude(id=current_league_instance.id)
-            .annotate(participant_count=Count('userleague'))
-            .filter(participant_count__lt=F('max_participants'))
-            .first()
+        open_instances = list(
+            LeagueInstance.objects.select_for_update(skip_locked=True)
+            .filter(buckets, is_active=True, league_end__gt=now, participant_count__lt=F('max_participants'))
+            .order_by('id')
+        )
+        free = defaultdict(list)
+        for instance in open_instances:
+            free[(instance.league_id, instance.company_id)].append(instance)
+
+        all_user_ids = [user_id for user_ids in placements.values() for user_id in user_ids]
+        assigned = dict(
+            UserLeague.objects.filter(user_id__in=all_user_ids, league_instance__in=open_instances)
+            .values_list('user_id', 'league_instance_id')
+        )
+        new_memberships = []
+        overflow = {}
+        for key, user_ids in placements.items():
+            remaining = [user_id for user_id in user_ids if user_id not in assigned]
+            for instance in free[key]:
+                while remaining and instance.participant_count < instance.max_participants:
+                    user_id = remaining.pop(0)
+                    new_memberships.append((user_id, instance))
+                    instance.participant_count += 1
+            if remaining:
+                overflow[key] = remaining
+        LeagueInstance.objects.bulk_update(
+            [instance for instance in open_instances if instance.participant_count], ['participant_count']
         )
 
-        if retain_league_instance:
-            print('Found an existing retain league instance:', retain_league_instance)
+        if overflow:
+            league_end = _next_uk_midnight(now)
+            new_instances = []
+            for (league_id, company_id), user_ids in overflow.items():
+                for i in range(0, len(user_ids), NEW_INSTANCE_MAX_PARTICIPANTS):
+                    chunk = user_ids[i:i + NEW_INSTANCE_MAX_PARTICIPANTS]
+                    instance = LeagueInstance(
+                        league_id=league_id, company_id=company_id, league_start=now, league_end=league_end,
+                        max_participants=NEW_INSTANCE_MAX_PARTICIPANTS, participant_count=len(chunk)
+                    )
+                    new_instances.append(instance)
+                    new_memberships.extend((user_id, instance) for user_id in chunk)
+            LeagueInstance.objects.bulk_create(new_instances)
+            refresh_company_league_configs({instance.company_id for instance in new_instances})
+
+        # bulk_create skips the post_save counter receiver; the counters were set above
+        UserLeague.objects.bulk_create(
+            [UserLeague(user_id=user_id, league_instance_id=instance.id) for user_id, instance in new_memberships],
+            batch_size=1000
+        )
+        invalidate_ranking_snapshots({instance.id for _, instance in new_memberships})
+    assigned.update((user_id, instance.id) for user_id, instance in new_memberships)
+    return assigned
+
+
+def sync_participant_counts(instance_ids=None):
+    """
+    Recompute ``participant_count`` from the memberships.
+
+    Args:
+        instance_ids (list, optional): Restrict the sync to these instances. Defaults to every instance.
+
+    Returns:
+        int: Number of instances whose counter was corrected.
+    """
+    memberships = (
+        UserLeague.objects.filter(league_instance=OuterRef('pk')).order_by()
+        .values('league_instance').annotate(total=Count('id')).values('total')
+    )
+    instances = LeagueInstance.objects.all()
+    if instance_ids is not None:
+        instances = instances.filter(id__in=instance_ids)
+    actual = Coalesce(Subquery(memberships), 0)
+    return instances.annotate(actual=actual).exclude(participant_count=F('actual')).update(participant_count=actual)
+
+
+def _new_report():
+    return {'instances': 0, 'participants': 0, 'promote': 0, 'retain': 0, 'demote': 0}
+
+
+def _expired_instances(company, now):
+    return LeagueInstance.objects.filter(
+        league_end__lte=now, is_active=True, settled_at__isnull=True, company__isnull=not company
+    )
+
+
+def _settle_claimed(instances, company, now, leagues, report):
+    """
+    Settle ``instances``, all global or all company ones, which the caller's
+    transaction has locked, and add the outcome to ``report``.
+    """
+    from .tasks import send_gem_update, send_next_league_update, send_status_update
+
+    xp_field = 'xp_company' if company else 'xp_global'
+    kind = 'company' if company else 'Global'
+    instance_ids = [instance.id for instance in instances]
+    participants = _ranked_participants(instance_ids, xp_field)
+    configs = company_league_configs({i.company_id for i in instances}) if company else {}
+
+    placements = defaultdict(list)
+    outcomes = {}
+    notifications = []
+    results = []
+    gems = {}
+    for instance in instances:
+        league = instance.league
+        if company:
+            config = configs[instance.company_id]
+            company_level = config.highest_level
+            is_highest, is_lowest = league.order == config.highest_order, league.order == config.lowest_order
         else:
-            # Calculate the next midnight UK time
-            uk_tz = pytz.timezone('Europe/London')
-            now_uk = timezone.now().astimezone(uk_tz)
-            midnight_uk = (now_uk + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-            
-            # Convert UK midnight to UTC for storage
-            midnight_utc = midnight_uk.astimezone(pytz.utc)
-            # Create a new league instance if none found
-            retain_league_instance = LeagueInstance.objects.create(
-                league=current_league,
-                league_start=timezone.now(),
-                league_end=midnight_utc,
-                max_participants=10
+            company_level = None
+            is_highest, is_lowest = league.order == 10, league.order == 1
+
+        instance_outcomes = []
+        for user_id, xp, rank, total in participants.get(instance.id, []):
+            move, gems_obtained = decide_outcome(rank, total, xp, is_highest, is_lowest)
+            instance_outcomes.append(Outcome(user_id, rank, move, gems_obtained))
+            target = _target_league(move, league, leagues, company_level)
+            placements[(target.id, instance.company_id)].append(user_id)
+            gems[user_id] = gems.get(user_id, 0) + gems_obtained
+
+            status, notif_type, phrase = OUTCOME_LABELS[move]
+            results.append(LeagueResult(
+                user_id=user_id, league_instance=instance, league=league, company_id=instance.company_id,
+                league_end=instance.league_end, rank=rank, participants=total, status=status,
+                gems_obtained=gems_obtained, xp=xp,
+            ))
+            notifications.append(Notif(
+                user_id=user_id, notif_type=notif_type,
+                content=f"You have been {phrase} {kind} League {11 - league.order} ({league.name})"
+            ))
+            report[move] += 1
+        outcomes[instance.id] = (instance_outcomes, is_highest, is_lowest)
+
+    # Cache the final standings for the league views before the XP is reset
+    cache_ranking_snapshots(instances, {i: (o[1], o[2]) for i, o in outcomes.items()})
+    place_users(placements, now)
+    credit_manual_gems(gems, now.date())
+    Notif.objects.bulk_create(notifications, batch_size=1000)
+    LeagueResult.objects.bulk_create(results, batch_size=1000)
+    UserLeague.objects.filter(league_instance_id__in=instance_ids).update(**{xp_field: 0})
+    LeagueInstance.objects.filter(id__in=instance_ids).update(is_active=False, settled_at=timezone.now())
+    if company:
+        # The settled instances no longer count towards the companies' league span
+        refresh_company_league_configs(configs)
+    if is_live_leaderboard():
+        discard_leaderboards(instance_ids)
+
+    balances = dict(
+        CustomUser.objects.filter(id__in=list(gems)).values_list('id', 'gem_balance')
+    )
+    for instance in instances:
+        instance_outcomes = outcomes[instance.id][0]
+        if not instance_outcomes:
+            continue
+        user_ids = [outcome.user_id for outcome in instance_outcomes]
+        channel_messages = [
+            {'user_id': user_id, 'gem_count': max(0, balances.get(user_id, 0)),
+             'channel_name': f'gem_{user_id}'}
+            for user_id in user_ids
+        ]
+        transaction.on_commit(partial(send_status_update.delay, user_ids, instance.id))
+        transaction.on_commit(partial(send_next_league_update.delay, instance.id))
+        transaction.on_commit(partial(send_gem_update.delay, channel_messages))
+
+    report['instances'] += len(instances)
+    report['participants'] += sum(len(outcomes[i][0]) for i in instance_ids)
+
+
+def settle_expired_leagues(company=False, now=None, batch_size=200):
+    """
+    Settle every expired, still active global (or company) league instance.
+
+    Instances are claimed in batches with SKIP LOCKED, so concurrent or retried runs
+    never settle an instance twice. Each batch is one transaction; the status, next
+    league and gem websocket updates are queued per instance after it commits.
+
+    Args:
+        company (bool): Settle company leagues instead of global ones.
+        now (datetime, optional): The current time. Defaults to timezone.now().
+        batch_size (int): Number of instances settled per transaction.
+
+    Returns:
+        dict: Number of ``instances`` and ``participants`` settled, and users per ``move``.
+    """
+    now = now or timezone.now()
+    kind = 'company' if company else 'Global'
+    leagues = list(League.objects.order_by('order'))
+    report = _new_report()
+
+    expired = _expired_instances(company, now)
+    if is_live_leaderboard():
+        # Rank the final XP: bring UserLeague up to date with the live boards first
+        checkpoint_leaderboards(expired.values_list('id', flat=True))
+
+    while True:
+        with transaction.atomic():
+            instances = list(
+                expired.select_for_update(skip_locked=True, of=('self',))
+                .select_related('league').order_by('id')[:batch_size]
             )
-            print('Created new retain league instance:', retain_league_instance)
-
-        # Double-check that the user is not already in the target league instance
-        if UserLeague.objects.filter(user=user, league_instance=retain_league_instance).exists():
-            print(f"{user.username} is already in the target league instance.")
-            return f"{user.username} is already in the target league instance."
-
-        # Attempt to create a new UserLeague entry for the user
-        try:
-            UserLeague.objects.create(user=user, league_instance=retain_league_instance, xp_global=0)
-            # Remove the user from the old league instance
-            # current_user_league.delete()
-            # current_league_instance.userleague_set.filter(user=user).delete()
-            print(f"{user.username} has been retained within the league: {current_league.name}.")
-            return f"{user.username} has been retained within the league: {current_league.name}."
-        except IntegrityError as e:
-            print('IntegrityError encountered:', e)
-            return f"{user.username} could not be added to the target league instance due to an IntegrityError."
+            if not instances:
+                break
+            _settle_claimed(instances, company, now, leagues, report)
 
+    logger.info(f"Settled {kind} leagues: {report}")
+    return report
 
 
+def settlement_shares(company=False, now=None):
+    """
+    Split the expired global (or company) instances into shares that can be settled
+    in parallel: one per global instance, and one per company for company instances,
+    whose league span and ceiling depend on all of the company's instances.
 
-MIN_USERS_FOR_LEAGUE = 5  # Minimum users to create the first league
-
-def get_highest_company_league_level(company):
+    Returns:
+        list: Lists of instance ids.
+    """
+    rows = _expired_instances(company, now or timezone.now()).order_by('id').values_list('id', 'company_id')
     if not company:
-        print("No company provided.")
-        return 0  # or a suitable default value
-    member_count = company.members.count()
-    # Determine highest level based on member count, e.g., 1 league per 5 members
-    max_level = min(member_count // MIN_USERS_FOR_LEAGUE, League.objects.count())  # Adjust division as needed
-    print(max_level)
-    return max_level
-
-
-def promote_company_user(user,gems_obtained, current_league_instance):
-    with transaction.atomic():
-        print(f'promoting the company user {user.username}')
-        current_league = current_league_instance.league
-        company = current_league_instance.company
-        if company is None:
-            print(f"No company associated with the league instance for user {user.username}")
-            return f"No company associated with the league instance for user {user.username}"
-
-
-        # Calculate the highest league level for the company
-        highest_company_level = get_highest_company_league_level(company)
-        print(f'highest company level {highest_company_level}')
-        next_league = League.objects.filter(order__gt=current_league.order, order__lte=highest_company_level).order_by('order').first()
-
-        add_manual_gem(user=user, manual_gem_count=gems_obtained, date=timezone.now().date())
-
-
-        if next_league:
-            print('found next league.',next_league)
-            next_league_instance = (
-                LeagueInstance.objects
-                .filter(league=next_league, is_active=True, company=company, league_end__gt=timezone.now())
-                .annotate(participant_count=Count('userleague'))
-                .filter(participant_count__lt=F('max_participants'))
-                .first()
-            )
-
-            if not next_league_instance:
-                # Calculate the next midnight UK time
-                uk_tz = pytz.timezone('Europe/London')
-                now_uk = timezone.now().astimezone(uk_tz)
-                midnight_uk = (now_uk + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-                
-                # Convert UK midnight to UTC for storage
-                midnight_utc = midnight_uk.astimezone(pytz.utc)
-                next_league_instance = LeagueInstance.objects.create(
-                    league=next_league,
-                    league_start=timezone.now(),
-                    league_end=midnight_utc,
-                    company=company,
-                    max_participants=10
-                )
-
-            try:
-                UserLeague.objects.create(user=user, league_instance=next_league_instance, xp_company=0)
-                # current_league_instance.userleague_set.filter(user=user).delete()
-                print('current league instance deleted')
-                return f"{user.username} has been promoted to {next_league.name}"
-            except IntegrityError:
-                return f"{user.username} is already in the target league instance."
-        else:
-            # If user is in the highest level, reassign to another instance within the same level
-            print('user is in the highest level, reassign to another instance within the same level')
-            current_instance = (
-                LeagueInstance.objects
-                .filter(league=current_league, is_active=True, company=company, league_end__gt=timezone.now())
-                .exclude(id=current_league_instance.id)
-                .annotate(participant_count=Count('userleague'))
-                .filter(participant_count__lt=F('max_participants'))
-                .first()
-            )
+        return [[instance_id] for instance_id, _ in rows]
+    shares = defaultdict(list)
+    for instance_id, company_id in rows:
+        shares[company_id].append(instance_id)
+    return list(shares.values())
+
+
+def settle_league_instances(instance_ids, now=None):
+    """
+    Settle the given instances if they have expired and are not settled yet.
+
+    Safe to repeat and to run concurrently: the instances are claimed with SKIP
+    LOCKED, and only while ``settled_at`` is empty, which is set in the same
+    transaction. A redelivered or overlapping call therefore settles nothing twice.
+
+    Returns:
+        dict: As settle_expired_leagues().
+    """
+    now = now or timezone.now()
+    instance_ids = list(instance_ids)
+    report = _new_report()
+    if is_live_leaderboard():
+        checkpoint_leaderboards(instance_ids)
+    leagues = list(League.objects.order_by('order'))
 
-            if not current_instance:
-                # Calculate the next midnight UK time
-                uk_tz = pytz.timezone('Europe/London')
-                now_uk = timezone.now().astimezone(uk_tz)
-                midnight_uk = (now_uk + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-                
-                # Convert UK midnight to UTC for storage
-                midnight_utc = midnight_uk.astimezone(pytz.utc)
-                current_instance = LeagueInstance.objects.create(
-                    league=current_league,
-                    league_start=timezone.now(),
-                    league_end=midnight_utc,
-                    company=company,
-                    max_participants=10
-                )
-
-            try:
-                UserLeague.objects.create(user=user, league_instance=current_instance, xp_company=0)
-                # current_league_instance.userleague_set.filter(user=user).delete()
-                print('current league instance deleted')
-                return f"{user.username} is reassigned within the highest league level: {current_league.name}."
-            except IntegrityError:
-                return f"{user.username} is already in the target league instance."
-
-
-
-def demote_company_user(user,gems_obtained,  current_league_instance):
     with transaction.atomic():
-        print('demoting compamy user')
-        current_league = current_league_instance.league
-        company = current_league_instance.company
-
-        # Calculate the highest league level for the company
-        highest_company_level = get_highest_company_league_level(company)
-        previous_league = League.objects.filter(order__lt=current_league.order, order__gte=highest_company_level).order_by('-order').first()
-
-        add_manual_gem(user=user, manual_gem_count=gems_obtained, date=timezone.now().date())
-
-        if previous_league:
-            # current_league_instance.userleague_set.filter(user=user).delete()
-
-            previous_league_instance = (
-                LeagueInstance.objects
-                .filter(league=previous_league, is_active=True, company=company, league_end__gt=timezone.now())
-                .annotate(participant_count=Count('userleague'))
-                .filter(participant_count__lt=F('max_participants'))
-                .first()
-            )
-
-            if not previous_league_instance:
-                # Calculate the next midnight UK time
-                uk_tz = pytz.timezone('Europe/London')
-                now_uk = timezone.now().astimezone(uk_tz)
-                midnight_uk = (now_uk + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-                
-                # Convert UK midnight to UTC for storage
-                midnight_utc = midnight_uk.astimezone(pytz.utc)
-                previous_league_instance = LeagueInstance.objects.create(
-                    league=previous_league,
-                    league_start=timezone.now(),
-                    league_end=midnight_utc,
-                    company=company,
-                    max_participants=10
-                )
-
-            UserLeague.objects.create(user=user, league_instance=previous_league_instance, xp_company=0)
-            return f"{user.username} has been demoted to {previous_league.name}"
-        else:
-            # Reassign within the lowest league instance if no lower league exists
-            lowest_league_instance = (
-                LeagueInstance.objects
-                .filter(league=current_league, is_active=True, company=company, league_end__gt=timezone.now())
-                .exclude(id=current_league_instance.id)
-                .annotate(participant_count=Count('userleague'))
-                .filter(participant_count__lt=F('max_participants'))
-                .first()
-            )
-
-            if not lowest_league_instance:
-                # Calculate the next midnight UK time
-                uk_tz = pytz.timezone('Europe/London')
-                now_uk = timezone.now().astimezone(uk_tz)
-                midnight_uk = (now_uk + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-                
-                # Convert UK midnight to UTC for storage
-                midnight_utc = midnight_uk.astimezone(pytz.utc)
-                lowest_league_instance = LeagueInstance.objects.create(
-                    league=current_league,
-                    league_start=timezone.now(),
-                    league_end=midnight_utc,
-                    company=company,
-                    max_participants=10
-                )
-
-            try:
-                UserLeague.objects.create(user=user, league_instance=lowest_league_instance, xp_company=0)
-                print(f"User {user.username} demoted to league {lowest_league_instance.league}")
-                # current_league_instance.userleague_set.filter(user=user).delete()
-                return f"{user.username} is reassigned within the lowest league: {current_league.name}."
-            except IntegrityError:
-                return f"{user.username} is already in the target league instance."
-            
-
-def retain_company_user(user,gems_obtained,  current_league_instance):
-    with transaction.atomic():
-        print('in the retain company view')
-        # Find the user's current active league instance associated with the company
-        current_league = current_league_instance.league
-        company = current_league_instance.company
-
-        add_manual_gem(user=user, manual_gem_count=gems_obtained, date=timezone.now().date())
-
-        # Find or create another active instance of the same league for the same company with available slots
-        retain_league_instance = (
-            LeagueInstance.objects
-            .filter(league=current_league, is_active=True, company=company, league_end__gt=timezone.now())
-            .exclude(id=current_league_instance.id)
-            .annotate(participant_count=Count('userleague'))
-            .filter(participant_count__lt=F('max_participants'))
-            .first()
+        claimed = list(
+            LeagueInstance.objects.select_for_update(skip_locked=True, of=('self',))
+            .filter(id__in=instance_ids, league_end__lte=now, is_active=True, settled_at__isnull=True)
+            .select_related('league').order_by('id')
         )
-        print(f'retaining user {user.email}')
-
-        # If no active instance with space is found, create a new one
-        if not retain_league_instance:
-            # Calculate the next midnight UK time
-            uk_tz = pytz.timezone('Europe/London')
-            now_uk = timezone.now().astimezone(uk_tz)
-            midnight_uk = (now_uk + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-            
-            # Convert UK midnight to UTC for storage
-            midnight_utc = midnight_uk.astimezone(pytz.utc)
-            retain_league_instance = LeagueInstance.objects.create(
-                league=current_league,
-                company=company,
-                league_start=timezone.now(),
-                league_end=midnight_utc,
-                max_participants=10
-            )
-
-            print('creating new current league as not found')
-
-        # Attempt to create a new UserLeague entry for the user
-        try:
-            UserLeague.objects.create(user=user, league_instance=retain_league_instance, xp_company=0)
-            print(f"User {user.username} reassigned to league {retain_league_instance.league}")
-            # current_league_instance.userleague_set.filter(user=user).delete()
-            return f"{user.username} has been retained within the company league: {current_league.name}."
-        except IntegrityError:
-            return f"{user.username} is already in the target company league instance."
\ No newline at end of file
+        for company in (False, True):
+            instances = [instance for instance in claimed if (instance.company_id is not None) == company]
+            if instances:
+                _settle_claimed(instances, company, now, leagues, report)
+
+    if report['instances']:
+        logger.info(f"Settled league instances {instance_ids}: {report}")
+    return report
@@ -0,0 +1,388 @@
+"""
+Live league leaderboards kept in sorted sets.
+
+With LEAGUE_XP_MODE = 'live', an XP event no longer saves the UserLeague row.
+Instead it is one atomic increment of the member's score in the instance's
+sorted set, plus the same amount in a pending hash. Rank, top-N and around-me
+queries are answered from the sorted set in O(log n), and the league views and
+ranking broadcasts rank active instances by it (see get_ranking_snapshot).
+checkpoint_leaderboards() periodically adds the pending amounts to UserLeague.xp_global / xp_company, so
+the database, the cached ranking snapshots and settlement stay behind the live
+board by at most one checkpoint interval. Settlement checkpoints the instances
+it is about to settle first, so it ranks the final XP.
+
+A board is built from the database, plus whatever is still pending, the first
+time it is read. It is rebuilt only when it is missing, for example after Redis
+lost it. Members with equal XP are ordered by the backend; the ranking snapshot
+breaks those ties on streak.
+"""
+import bisect
+import logging
+import threading
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+
+from .models import LeagueInstance, UserLeague
+from .ranking_service import invalidate_ranking_snapshots
+
+logger = logging.getLogger(__name__)
+
+DIRTY_KEY = 'leaderboard:dirty'
+
+# Count the XP as pending and move the score only if the board is loaded; a missing
+# board is rebuilt from the database plus the pending XP on its next read
+_INCR_SCRIPT = """
+redis.call('HINCRBY', KEYS[2], ARGV[1], ARGV[2])
+redis.call('SADD', KEYS[3], ARGV[3])
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('ZINCRBY', KEYS[1], ARGV[2], ARGV[1])
+end
+return false
+"""
+
+# Replace the board with the checkpointed XP plus the pending XP of every member
+_LOAD_SCRIPT = """
+redis.call('DEL', KEYS[1])
+for i = 1, #ARGV, 2 do
+    local pending = redis.call('HGET', KEYS[2], ARGV[i]) or '0'
+    redis.call('ZADD', KEYS[1], tonumber(ARGV[i + 1]) + tonumber(pending), ARGV[i])
+end
+return #ARGV / 2
+"""
+
+# Take checkpointed XP off the pending hash, keeping what arrived since it was read
+_ACK_SCRIPT = """
+for i = 2, #ARGV, 2 do
+    if redis.call('HINCRBY', KEYS[1], ARGV[i], -tonumber(ARGV[i + 1])) == 0 then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+end
+if redis.call('HLEN', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[2], ARGV[1])
+end
+return 0
+"""
+
+
+def _board_key(instance_id):
+    return f'leaderboard:{instance_id}'
+
+
+def _pending_key(instance_id):
+    return f'leaderboard:{instance_id}:pending'
+
+
+class RedisLeaderboard:
+    """Leaderboards shared by every web process and worker through Redis."""
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self._incr = self.client.register_script(_INCR_SCRIPT)
+        self._load = self.client.register_script(_LOAD_SCRIPT)
+        self._ack = self.client.register_script(_ACK_SCRIPT)
+
+    def incr(self, instance_id, user_id, amount):
+        self._incr(keys=[_board_key(instance_id), _pending_key(instance_id), DIRTY_KEY],
+                   args=[user_id, amount, instance_id])
+
+    def is_loaded(self, instance_id):
+        return bool(self.client.exists(_board_key(instance_id)))
+
+    def load(self, instance_id, scores):
+        args = [value for user_id, xp in scores.items() for value in (user_id, xp)]
+        self._load(keys=[_board_key(instance_id), _pending_key(instance_id)], args=args)
+
+    def rank(self, instance_id, user_id):
+        return self.client.zrevrank(_board_key(instance_id), user_id)
+
+    def range(self, instance_id, start, stop):
+        entries = self.client.zrevrange(_board_key(instance_id), start, stop, withscores=True)
+        return [(int(user_id), int(score)) for user_id, score in entries]
+
+    def dirty(self):
+        return {int(instance_id) for instance_id in self.client.smembers(DIRTY_KEY)}
+
+    def pending(self, instance_ids):
+        pipe = self.client.pipeline(transaction=False)
+        for instance_id in instance_ids:
+            pipe.hgetall(_pending_key(instance_id))
+        return {
+            instance_id: {int(user_id): int(amount) for user_id, amount in raw.items()}
+            for instance_id, raw in zip(instance_ids, pipe.execute()) if raw
+        }
+
+    def ack(self, deltas):
+        for instance_id, amounts in deltas.items():
+            args = [instance_id] + [value for user_id, amount in amounts.items() for value in (user_id, amount)]
+            self._ack(keys=[_pending_key(instance_id), DIRTY_KEY], args=args)
+
+    def restore(self, deltas):
+        pipe = self.client.pipeline()
+        for instance_id, amounts in deltas.items():
+            for user_id, amount in amounts.items():
+                pipe.hincrby(_pending_key(instance_id), user_id, amount)
+            pipe.sadd(DIRTY_KEY, instance_id)
+        pipe.execute()
+
+    def discard(self, instance_ids):
+        pipe = self.client.pipeline()
+        for instance_id in instance_ids:
+            pipe.delete(_board_key(instance_id), _pending_key(instance_id))
+            pipe.srem(DIRTY_KEY, instance_id)
+        pipe.execute()
+
+
+class LocalLeaderboard:
+    """
+    In-process stand-in for RedisLeaderboard. Each board is a score map plus a
+    sorted list, so it suits development, tests and single-process deployments.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._scores = {}
+        self._ordered = {}
+        self._pending = {}
+
+    def _move(self, instance_id, user_id, score):
+        scores, ordered = self._scores[instance_id], self._ordered[instance_id]
+        if user_id in scores:
+            del ordered[bisect.bisect_left(ordered, (-scores[user_id], user_id))]
+        scores[user_id] = score
+        bisect.insort(ordered, (-score, user_id))
+
+    def incr(self, instance_id, user_id, amount):
+        with self._lock:
+            pending = self._pending.setdefault(instance_id, {})
+            pending[user_id] = pending.get(user_id, 0) + amount
+            if instance_id in self._scores:
+                self._move(instance_id, user_id, self._scores[instance_id].get(user_id, 0) + amount)
+
+    def is_loaded(self, instance_id):
+        with self._lock:
+            return instance_id in self._scores
+
+    def load(self, instance_id, scores):
+        with self._lock:
+            self._scores[instance_id], self._ordered[instance_id] = {}, []
+            pending = self._pending.get(instance_id, {})
+            for user_id, xp in scores.items():
+                self._move(instance_id, user_id, xp + pending.get(user_id, 0))
+
+    def rank(self, instance_id, user_id):
+        with self._lock:
+            scores = self._scores.get(instance_id, {})
+            if user_id not in scores:
+                return None
+            return bisect.bisect_left(self._ordered[instance_id], (-scores[user_id], user_id))
+
+    def range(self, instance_id, start, stop):
+        with self._lock:
+            ordered = self._ordered.get(instance_id, [])
+            # stop is inclusive and -1 means the end, as with ZREVRANGE
+            end = None if stop == -1 else stop + 1
+            return [(user_id, -score) for score, user_id in ordered[start:end]]
+
+    def dirty(self):
+        with self._lock:
+            return set(self._pending)
+
+    def pending(self, instance_ids):
+        with self._lock:
+            return {
+                instance_id: dict(self._pending[instance_id])
+                for instance_id in instance_ids if self._pending.get(instance_id)
+            }
+
+    def ack(self, deltas):
+        with self._lock:
+            for instance_id, amounts in deltas.items():
+                pending = self._pending.get(instance_id, {})
+                for user_id, amount in amounts.items():
+                    pending[user_id] = pending.get(user_id, 0) - amount
+                    if not pending[user_id]:
+                        del pending[user_id]
+                if not pending:
+                    self._pending.pop(instance_id, None)
+
+    def restore(self, deltas):
+        with self._lock:
+            for instance_id, amounts in deltas.items():
+                pending = self._pending.setdefault(instance_id, {})
+                for user_id, amount in amounts.items():
+                    pending[user_id] = pending.get(user_id, 0) + amount
+
+    def discard(self, instance_ids):
+        with self._lock:
+            for instance_id in instance_ids:
+                self._scores.pop(instance_id, None)
+                self._ordered.pop(instance_id, None)
+                self._pending.pop(instance_id, None)
+
+
+_leaderboard = None
+
+
+def get_leaderboard():
+    """Return the configured leaderboard backend (LEADERBOARD_BACKEND: 'redis' or 'local')."""
+    global _leaderboard
+    if _leaderboard is None:
+        if settings.LEADERBOARD_BACKEND == 'redis':
+            _leaderboard = RedisLeaderboard(settings.LEADERBOARD_REDIS_URL)
+        else:
+            _leaderboard = LocalLeaderboard()
+    return _leaderboard
+
+
+def is_live_leaderboard():
+    return settings.LEAGUE_XP_MODE == 'live'
+
+
+def add_league_xp(user_league, xp):
+    """
+    Add ``xp`` to the member's live score once the current transaction commits, then
+    broadcast the instance's rankings.
+    """
+    # League XP is stored as whole points, as the direct UserLeague writes did
+    amount = int(xp)
+    if amount <= 0:
+        return
+    transaction.on_commit(partial(_add_and_broadcast, user_league, amount))
+
+
+def _add_and_broadcast(user_league, amount):
+    from .websocket_signals import broadcast_company_league_ranking_update, broadcast_global_league_ranking_update
+
+    get_leaderboard().incr(user_league.league_instance_id, user_league.user_id, amount)
+    # The XP pipeline queued its ranking broadcast before this increment, so that one
+    # still showed the previous scores
+    league_instance = user_league.league_instance
+    try:
+        if league_instance.company_id is None:
+            broadcast_global_league_ranking_update(user_league.user, league_instance)
+        else:
+            broadcast_company_league_ranking_update(user_league.user, league_instance)
+    except Exception as e:
+        logger.error(f"Live ranking broadcast for league {league_instance.id} failed: {e}")
+
+
+def _loaded_board(league_instance):
+    board = get_leaderboard()
+    if not board.is_loaded(league_instance.id):
+        xp_field = 'xp_company' if league_instance.company_id else 'xp_global'
+        board.load(league_instance.id, dict(
+            UserLeague.objects.filter(league_instance=league_instance).values_list('user_id', xp_field)
+        ))
+    return board
+
+
+def _entries(entries, first_rank):
+    return [{'rank': rank, 'user_id': user_id, 'xp': xp} for rank, (user_id, xp) in enumerate(entries, first_rank)]
+
+
+def live_scores(league_instance):
+    """user id -> live XP of every member on the instance's board."""
+    return dict(_loaded_board(league_instance).range(league_instance.id, 0, -1))
+
+
+def live_rank(league_instance, user_id):
+    """The user's 1-based live rank in the instance, or None if they are not a member."""
+    rank = _loaded_board(league_instance).rank(league_instance.id, user_id)
+    return None if rank is None else rank + 1
+
+
+def live_top(league_instance, count=10):
+    """The first ``count`` members of the instance as ``rank``, ``user_id`` and ``xp`` entries."""
+    return _entries(_loaded_board(league_instance).range(league_instance.id, 0, count - 1), 1)
+
+
+def live_around(league_instance, user_id, radius=2):
+    """The user's entry with up to ``radius`` members above and below it, or [] if they are not a member."""
+    board = _loaded_board(league_instance)
+    rank = board.rank(league_instance.id, user_id)
+    if rank is None:
+        return []
+    start = max(rank - radius, 0)
+    return _entries(board.range(league_instance.id, start, rank + radius), start + 1)
+
+
+def _apply_deltas(deltas, xp_field):
+    memberships = {
+        (instance_id, user_id): amount
+        for instance_id, amounts in deltas.items() for user_id, amount in amounts.items()
+    }
+    whens = [
+        When(league_instance_id=instance_id, user_id=user_id, then=Value(amount))
+        for (instance_id, user_id), amount in memberships.items()
+    ]
+    return UserLeague.objects.filter(
+        league_instance_id__in=list(deltas), user_id__in={user_id for _, user_id in memberships}
+    ).update(**{
+        xp_field: F(xp_field) + Case(*whens, default=Value(0), output_field=IntegerField())
+    })
+
+
+def checkpoint_leaderboards(instance_ids=None):
+    """
+    Add the pending live XP of active instances to their UserLeague rows.
+
+    Instances being checkpointed or settled by another worker are skipped and
+    keep their XP pending. Boards of instances that are no longer active are
+    dropped.
+
+    Args:
+        instance_ids (iterable, optional): Only checkpoint these instances. Defaults to
+            every instance with pending XP.
+
+    Returns:
+        dict: Number of ``instances`` and ``memberships`` checkpointed, and ``discarded`` boards.
+    """
+    board = get_leaderboard()
+    dirty = board.dirty()
+    if instance_ids is not None:
+        dirty &= set(instance_ids)
+    result = {'instances': 0, 'memberships': 0, 'discarded': 0}
+    if not dirty:
+        return result
+
+    acked = None
+    try:
+        with transaction.atomic():
+            instances = dict(
+                LeagueInstance.objects.select_for_update(skip_locked=True)
+                .filter(id__in=dirty, is_active=True).values_list('id', 'company_id')
+            )
+            deltas = board.pending(list(instances))
+            for company in (False, True):
+                kind = {i: d for i, d in deltas.items() if (instances[i] is not None) == company}
+                if kind:
+                    result['memberships'] += _apply_deltas(kind, 'xp_company' if company else 'xp_global')
+            # Acknowledged inside the transaction so no other checkpoint can apply them again
+            board.ack(deltas)
+            acked = deltas
+            invalidate_ranking_snapshots(deltas)
+    except Exception:
+        if acked:
+            board.restore(acked)
+        raise
+    result['instances'] = len(deltas)
+
+    inactive = set(LeagueInstance.objects.filter(id__in=dirty, is_active=False).values_list('id', flat=True))
+    if inactive:
+        board.discard(inactive)
+        result['discarded'] = len(inactive)
+
+    if result['instances']:
+        logger.info(f"Leaderboard checkpoint: {result}")
+    return result
+
+
+def discard_leaderboards(instance_ids):
+    """Drop the live boards of settled instances once the current transaction commits."""
+    instance_ids = list(instance_ids)
+    if instance_ids:
+        transaction.on_commit(lambda: get_leaderboard().discard(instance_ids))
@@ -0,0 +1,179 @@
+import random
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from myapp.league_service import refresh_company_league_configs, settle_league_instances, settlement_shares
+from myapp.models import Company, CustomUser, League, LeagueInstance, UserLeague
+from myapp.ranking_service import invalidate_ranking_snapshots
+
+# Share of the global population per league order: most users sit in the lower leagues
+ORDER_WEIGHTS = [20, 17, 14, 12, 10, 8, 7, 5, 4, 3]
+INACTIVE_SHARE = 0.15  # Users who earned no XP during the week
+WRITE_VERBS = ('INSERT', 'UPDATE', 'DELETE')
+
+
+class Counter:
+    """Database execute wrapper counting the queries run and the rows they wrote."""
+
+    def __init__(self):
+        self.queries = 0
+        self.rows_written = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        self.queries += 1
+        if sql.lstrip().upper().startswith(WRITE_VERBS):
+            self.rows_written += max(context['cursor'].rowcount, 0)
+        return result
+
+
+class Command(BaseCommand):
+    help = (
+        'Settle a synthetic population of global and company league instances and report the wall time, '
+        'queries, rows written and peak memory of each phase. Runs against the configured database inside '
+        'a transaction that is rolled back, so nothing is kept; the same seed always generates the same '
+        'population.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000, help='Number of generated users')
+        parser.add_argument('--companies', type=int, default=20, help='Number of generated companies')
+        parser.add_argument('--company-share', type=float, default=0.5,
+                            help='Fraction of the users who belong to a company')
+        parser.add_argument('--instance-size', type=int, default=30,
+                            help='Participants per generated league instance')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed of the generated population')
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG:
+            raise CommandError('The benchmark writes to the configured database; only run it with DEBUG=True')
+        if options['users'] < 1 or options['instance_size'] < 1:
+            raise CommandError('--users and --instance-size must be positive')
+
+        self.counter = Counter()
+        self.rows = []
+        vendor = connection.vendor
+        tracemalloc.start()
+        try:
+            with connection.execute_wrapper(self.counter), transaction.atomic():
+                instance_ids = self._run(options)
+                transaction.set_rollback(True)
+        finally:
+            tracemalloc.stop()
+        # The snapshots cached for the rolled back instances must not be served if their ids are reused
+        invalidate_ranking_snapshots(instance_ids)
+
+        self.stdout.write(f"Database: {vendor}, seed {options['seed']}, {options['users']} users, "
+                          f"{options['companies']} companies")
+        self.stdout.write(f"{'phase':<20}{'wall (s)':>10}{'queries':>10}{'rows':>10}{'peak (MiB)':>12}")
+        for phase, wall, queries, rows, peak in self.rows:
+            self.stdout.write(f'{phase:<20}{wall:>10.2f}{queries:>10}{rows:>10}{peak / 2 ** 20:>12.1f}')
+
+    @contextmanager
+    def _phase(self, name):
+        queries, rows = self.counter.queries, self.counter.rows_written
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        yield
+        wall = time.perf_counter() - start
+        self.rows.append((name, wall, self.counter.queries - queries, self.counter.rows_written - rows,
+                          tracemalloc.get_traced_memory()[1]))
+
+    def _run(self, options):
+        rng = random.Random(options['seed'])
+        now = timezone.now()
+
+        with self._phase('populate'):
+            global_ids, company_ids = self._populate(rng, now, options)
+
+        for company, instance_ids in ((False, global_ids), (True, company_ids)):
+            report = {}
+            with self._phase('company settlement' if company else 'global settlement'):
+                # Settle share by share, as the fanned out settlement tasks do
+                for share in settlement_shares(company=company, now=now):
+                    share = [instance_id for instance_id in share if instance_id in instance_ids]
+                    if share:
+                        for key, value in settle_league_instances(share, now=now).items():
+                            report[key] = report.get(key, 0) + value
+            self.stdout.write(f"{'Company' if company else 'Global'} settlement: {report}")
+        return global_ids | company_ids
+
+    def _populate(self, rng, now, options):
+        size = options['instance_size']
+        for order in range(1, 11):
+            League.objects.get_or_create(order=order, defaults={'name': f'League {order}'})
+        leagues = {league.order: league for league in League.objects.filter(order__in=range(1, 11)).order_by('order')}
+
+        password = make_password(None)
+        seed = options['seed']
+        users = CustomUser.objects.bulk_create([
+            CustomUser(username=f'bench-{seed}-{i}', email=f'bench-{seed}-{i}@bench.invalid', password=password,
+                       streak=rng.randint(0, 60))
+            for i in range(options['users'])
+        ], batch_size=1000)
+
+        companies = []
+        if options['companies'] > 0:
+            owners = CustomUser.objects.bulk_create([
+                CustomUser(username=f'bench-{seed}-owner-{i}', email=f'bench-{seed}-owner-{i}@bench.invalid',
+                           password=password, is_company_owner=True)
+                for i in range(options['companies'])
+            ])
+            companies = Company.objects.bulk_create([
+                Company(name=f'Bench company {i}', owner=owner, domain=f'https://bench{i}.invalid')
+                for i, owner in enumerate(owners)
+            ])
+
+        members = {company.id: [] for company in companies}
+        for user in users:
+            if companies and rng.random() < options['company_share']:
+                user.company_id = rng.choice(companies).id
+                members[user.company_id].append(user)
+        CustomUser.objects.bulk_update([u for u in users if u.company_id], ['company'], batch_size=1000)
+
+        def xp():
+            return 0 if rng.random() < INACTIVE_SHARE else int(rng.lognormvariate(5, 1))
+
+        # Global leagues: users spread over the orders, in full instances
+        by_order = {order: [] for order in leagues}
+        for user in users:
+            by_order[rng.choices(list(leagues), weights=ORDER_WEIGHTS)[0]].append(user)
+        groups = [(leagues[order], None, members_) for order, members_ in by_order.items()]
+
+        # Company leagues: each company's members over the levels its size allows
+        for company in companies:
+            company_members = members[company.id]
+            levels = max(len(company_members) // 5, 1)
+            by_level = {order: [] for order in range(1, min(levels, 10) + 1)}
+            for user in company_members:
+                by_level[rng.choice(list(by_level))].append(user)
+            groups += [(leagues[order], company, members_) for order, members_ in by_level.items()]
+
+        instances, chunks = [], []
+        for league, company, group_members in groups:
+            for i in range(0, len(group_members), size):
+                chunk = group_members[i:i + size]
+                instances.append(LeagueInstance(
+                    league=league, company=company, league_start=now - timedelta(days=7),
+                    league_end=now - timedelta(minutes=1), max_participants=size, participant_count=len(chunk),
+                ))
+                chunks.append(chunk)
+        instances = LeagueInstance.objects.bulk_create(instances, batch_size=1000)
+
+        UserLeague.objects.bulk_create([
+            UserLeague(user=user, league_instance=instance,
+                       **{'xp_company' if instance.company_id else 'xp_global': xp()})
+            for instance, chunk in zip(instances, chunks) for user in chunk
+        ], batch_size=1000)
+        refresh_company_league_configs(members)
+
+        global_ids = {instance.id for instance in instances if instance.company_id is None}
+        return global_ids, {instance.id for instance in instances} - global_ids
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from myapp.live_leaderboard import checkpoint_leaderboards
+
+
+class Command(BaseCommand):
+    help = 'Write the pending live league XP to UserLeague now'
+
+    def handle(self, *args, **kwargs):
+        result = checkpoint_leaderboards()
+        self.stdout.write(self.style.SUCCESS(
+            f"Checkpointed {result['memberships']} memberships in {result['instances']} league instances, "
+            f"dropped {result['discarded']} settled boards"
+        ))
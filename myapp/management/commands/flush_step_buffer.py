@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from myapp.step_buffer import flush_step_buffer, get_step_buffer
+
+
+class Command(BaseCommand):
+    help = 'Flush buffered step updates now and report how many writes were collapsed'
+
+    def handle(self, *args, **kwargs):
+        result = flush_step_buffer()
+        self.stdout.write(self.style.SUCCESS(
+            f"Received {result['received']} step updates, applied {result['applied']}, "
+            f"skipped {result['skipped']}, requeued {result['requeued']}, collapsed {result['collapsed']}"
+        ))
+
+        stats = get_step_buffer().stats()
+        self.stdout.write(
+            f"Since start: applied {stats.get('applied_total', 0)}, collapsed {stats.get('collapsed_total', 0)}"
+        )
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from myapp.activity_bitmap import rebuild_activity_bitmaps
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-user streak activity bitmaps from the Streak table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='user_ids',
+                            help='Only rebuild bitmaps for this user id (can be repeated)')
+
+    def handle(self, *args, **options):
+        rebuilt = rebuild_activity_bitmaps(user_ids=options['user_ids'])
+        self.stdout.write(self.style.SUCCESS(f'Successfully rebuilt {rebuilt} activity bitmaps'))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from myapp.xp_service import rebuild_xp_totals
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the materialized XP totals (XpTotal, XpDailyTotal) from the Xp table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='user_ids',
+                            help='Only rebuild totals for this user id (can be repeated)')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of users rebuilt per transaction')
+
+    def handle(self, *args, **options):
+        rebuilt = rebuild_xp_totals(user_ids=options['user_ids'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Successfully rebuilt XP totals for {rebuilt} users'))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from myapp.gem_service import reconcile_gem_ledger
+
+
+class Command(BaseCommand):
+    help = 'Verify the gem ledger and balances against the Gem rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='user_ids',
+                            help='Only check this user id (can be repeated)')
+        parser.add_argument('--fix', action='store_true',
+                            help='Record an adjustment and correct the balance for every mismatch')
+
+    def handle(self, *args, **options):
+        mismatches = reconcile_gem_ledger(user_ids=options['user_ids'], fix=options['fix'])
+        for mismatch in mismatches:
+            self.stdout.write(
+                f"User {mismatch['user_id']}: expected {mismatch['expected']}, "
+                f"balance {mismatch['balance']}, ledger {mismatch['ledger']}"
+            )
+        if not mismatches:
+            self.stdout.write(self.style.SUCCESS('Gem ledger matches the Gem rows for every user'))
+        elif options['fix']:
+            self.stdout.write(self.style.SUCCESS(f'Fixed {len(mismatches)} gem balances'))
+        else:
+            self.stdout.write(self.style.WARNING(f'Found {len(mismatches)} gem balance mismatches'))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from myapp.league_service import refresh_company_league_configs
+from myapp.models import Company
+
+
+class Command(BaseCommand):
+    help = 'Recompute the league configuration of every company, e.g. after the leagues were repopulated'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, action='append', dest='company_ids',
+                            help='Only refresh this company id (can be repeated)')
+
+    def handle(self, *args, **options):
+        company_ids = options['company_ids'] or Company.objects.values_list('id', flat=True)
+        configs = refresh_company_league_configs(company_ids)
+        self.stdout.write(self.style.SUCCESS(f'Refreshed the league configuration of {len(configs)} companies'))
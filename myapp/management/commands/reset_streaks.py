@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from myapp.streak_service import reset_missed_streaks
+
+
+class Command(BaseCommand):
+    help = 'Spend streak savers or reset streaks for users whose local day just ended without a streak day'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report which users would use a streak saver or be reset without writing')
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help='Number of users processed per transaction')
+
+    def handle(self, *args, **options):
+        report = reset_missed_streaks(dry_run=options['dry_run'], batch_size=options['batch_size'])
+        prefix = 'Would use' if options['dry_run'] else 'Used'
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {report['checked']} users. {prefix} {len(report['saved'])} streak savers "
+            f"and reset {len(report['reset'])} streaks."
+        ))
+        if options['verbosity'] > 1:
+            self.stdout.write(f"Saved: {report['saved']}")
+            self.stdout.write(f"Reset: {report['reset']}")
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from myapp.league_service import sync_participant_counts
+
+
+class Command(BaseCommand):
+    help = 'Recompute the participant counter of every league instance from its memberships'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--instance', type=int, action='append', dest='instance_ids',
+                            help='Only sync this league instance id (can be repeated)')
+
+    def handle(self, *args, **options):
+        corrected = sync_participant_counts(instance_ids=options['instance_ids'])
+        if corrected:
+            self.stdout.write(self.style.WARNING(f'Corrected the participant count of {corrected} league instances'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Participant counts match the memberships'))
@@ -0,0 +1,67 @@
+# Generated by Django 5.1.1 on 2026-10-18 04:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def populate_xp_totals(apps, schema_editor):
+    Xp = apps.get_model('myapp', 'Xp')
+    XpTotal = apps.get_model('myapp', 'XpTotal')
+    XpDailyTotal = apps.get_model('myapp', 'XpDailyTotal')
+    source_fields = {'steps': 'steps_xp', 'workout': 'workout_xp'}
+
+    all_time = {}
+    per_day = {}
+    rows = Xp.objects.values('user_id', 'date', 'source').annotate(total=Sum('xp_value')).order_by()
+    for row in rows:
+        for bucket in (all_time.setdefault(row['user_id'], {}),
+                       per_day.setdefault((row['user_id'], row['date']), {})):
+            bucket['total_xp'] = bucket.get('total_xp', 0.0) + row['total']
+            source_field = source_fields.get(row['source'])
+            if source_field:
+                bucket[source_field] = bucket.get(source_field, 0.0) + row['total']
+
+    XpTotal.objects.bulk_create(
+        [XpTotal(user_id=user_id, **totals) for user_id, totals in all_time.items()], batch_size=1000
+    )
+    XpDailyTotal.objects.bulk_create(
+        [XpDailyTotal(user_id=user_id, date=date, **totals) for (user_id, date), totals in per_day.items()],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0057_company_address_company_alternate_phone_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XpTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_xp', models.FloatField(default=0.0)),
+                ('steps_xp', models.FloatField(default=0.0)),
+                ('workout_xp', models.FloatField(default=0.0)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='xp_total', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='XpDailyTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('total_xp', models.FloatField(default=0.0)),
+                ('steps_xp', models.FloatField(default=0.0)),
+                ('workout_xp', models.FloatField(default=0.0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='xp_daily_totals', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'date')},
+            },
+        ),
+        migrations.RunPython(populate_xp_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.1 on 2026-10-18 04:05
+
+import django.core.serializers.json
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0058_xptotal_xpdailytotal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionReceipt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sync_key', models.CharField(max_length=100)),
+                ('endpoint', models.CharField(choices=[('daily_steps', 'Daily Steps'), ('workout', 'Workout'), ('health_sync', 'Health Sync')], max_length=20)),
+                ('status_code', models.PositiveSmallIntegerField(default=0)),
+                ('response', models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ingestion_receipts', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_at'], name='myapp_inges_created_192cfb_idx')],
+                'unique_together': {('user', 'sync_key')},
+            },
+        ),
+    ]
@@ -0,0 +1,94 @@
+# Generated by Django 5.1.1 on 2026-10-18 04:13
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncDate
+
+
+def populate_rollup_fields(apps, schema_editor):
+    DailySteps = apps.get_model('myapp', 'DailySteps')
+    WorkoutActivity = apps.get_model('myapp', 'WorkoutActivity')
+    XpDailyTotal = apps.get_model('myapp', 'XpDailyTotal')
+
+    per_day = {}
+    for row in DailySteps.objects.values('user_id', 'date', 'step_count', 'timestamp'):
+        per_day[(row['user_id'], row['date'])] = {
+            'step_count': row['step_count'],
+            'steps_timestamp': row['timestamp'],
+        }
+
+    workout_rows = (
+        WorkoutActivity.objects
+        .annotate(day=TruncDate('start_datetime'))
+        .values('user_id', 'day')
+        .annotate(
+            workout_count=Count('id'),
+            movement_xp=Sum('xp', filter=Q(activity_type='movement')),
+            mindfulness_xp=Sum('xp', filter=Q(activity_type='mindfulness')),
+        )
+        .order_by()
+    )
+    for row in workout_rows:
+        per_day.setdefault((row['user_id'], row['day']), {}).update(
+            workout_count=row['workout_count'],
+            movement_xp=row['movement_xp'] or 0.0,
+            mindfulness_xp=row['mindfulness_xp'] or 0.0,
+        )
+
+    existing = {
+        (row.user_id, row.date): row
+        for row in XpDailyTotal.objects.filter(user_id__in={user_id for user_id, _ in per_day})
+    }
+    to_create = []
+    to_update = []
+    for (user_id, date), values in per_day.items():
+        row = existing.get((user_id, date))
+        if row is None:
+            to_create.append(XpDailyTotal(user_id=user_id, date=date, **values))
+            continue
+        for field, value in values.items():
+            setattr(row, field, value)
+        to_update.append(row)
+
+    XpDailyTotal.objects.bulk_create(to_create, batch_size=1000)
+    XpDailyTotal.objects.bulk_update(
+        to_update,
+        ['step_count', 'steps_timestamp', 'workout_count', 'movement_xp', 'mindfulness_xp'],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0059_ingestionreceipt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xpdailytotal',
+            name='mindfulness_xp',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='xpdailytotal',
+            name='movement_xp',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='xpdailytotal',
+            name='step_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='xpdailytotal',
+            name='steps_timestamp',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='xpdailytotal',
+            name='workout_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(populate_rollup_fields, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.1.1 on 2026-10-18 04:21
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def populate_activity_bitmaps(apps, schema_editor):
+    Streak = apps.get_model('myapp', 'Streak')
+    StreakActivityBitmap = apps.get_model('myapp', 'StreakActivityBitmap')
+
+    rows = {}
+    for user_id, day in Streak.objects.values_list('user_id', 'date').iterator():
+        bits = rows.setdefault((user_id, day.year), bytearray(46))
+        index = day.timetuple().tm_yday - 1
+        bits[index // 8] |= 1 << (index % 8)
+
+    StreakActivityBitmap.objects.bulk_create(
+        [StreakActivityBitmap(user_id=user_id, year=year, bits=bytes(bits)) for (user_id, year), bits in rows.items()],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0060_xp_daily_rollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StreakActivityBitmap',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField()),
+                ('bits', models.BinaryField(default=b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='activity_bitmaps', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'year')},
+            },
+        ),
+        migrations.RunPython(populate_activity_bitmaps, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.1.1 on 2026-10-18 04:27
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def populate_gem_balances(apps, schema_editor):
+    CustomUser = apps.get_model('myapp', 'CustomUser')
+    Gem = apps.get_model('myapp', 'Gem')
+    GemTransaction = apps.get_model('myapp', 'GemTransaction')
+
+    balances = {user_id: -spent for user_id, spent in CustomUser.objects.values_list('id', 'gems_spent')}
+    for row in Gem.objects.values('user_id').annotate(xp=Sum('xp_gem'), manual=Sum('manual_gem')).order_by():
+        balances[row['user_id']] += (row['xp'] or 0) + (row['manual'] or 0)
+
+    # Open every ledger with the balance carried over from the Gem rows
+    opening = {user_id: balance for user_id, balance in balances.items() if balance}
+    GemTransaction.objects.bulk_create([
+        GemTransaction(user_id=user_id, kind='adjustment', amount=balance, balance_after=balance)
+        for user_id, balance in opening.items()
+    ], batch_size=1000)
+    users = []
+    for user_id, balance in opening.items():
+        users.append(CustomUser(id=user_id, gem_balance=balance))
+    CustomUser.objects.bulk_update(users, ['gem_balance'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0061_streakactivitybitmap'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='gem_balance',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='GemTransaction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('xp', 'XP Gems'), ('manual', 'Manual Gems'), ('spend', 'Spend'), ('reset', 'Reset'), ('adjustment', 'Adjustment')], max_length=20)),
+                ('amount', models.IntegerField()),
+                ('balance_after', models.IntegerField()),
+                ('gem_date', models.DateField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='gem_transactions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'created_at'], name='myapp_gemtr_user_id_d087cb_idx')],
+            },
+        ),
+        migrations.RunPython(populate_gem_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.1 on 2026-10-18 04:55
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_participant_counts(apps, schema_editor):
+    LeagueInstance = apps.get_model('myapp', 'LeagueInstance')
+    UserLeague = apps.get_model('myapp', 'UserLeague')
+
+    memberships = (
+        UserLeague.objects.filter(league_instance=OuterRef('pk')).order_by()
+        .values('league_instance').annotate(total=Count('id')).values('total')
+    )
+    LeagueInstance.objects.update(participant_count=Coalesce(Subquery(memberships), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0062_gem_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='leagueinstance',
+            name='participant_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(populate_participant_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.1.1 on 2026-10-18 05:24
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0063_league_participant_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeagueResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('league_end', models.DateTimeField()),
+                ('rank', models.PositiveIntegerField()),
+                ('participants', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('Promoted', 'Promoted'), ('Retained', 'Retained'), ('Demoted', 'Demoted')], max_length=10)),
+                ('gems_obtained', models.PositiveIntegerField(default=0)),
+                ('xp', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('company', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='myapp.company')),
+                ('league', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='myapp.league')),
+                ('league_instance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='results', to='myapp.leagueinstance')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='league_results', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'company', '-league_end'], name='myapp_leagu_user_id_74d070_idx')],
+                'unique_together': {('user', 'league_instance')},
+            },
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.1.1 on 2026-10-18 05:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Max, Min
+from django.utils import timezone
+
+# league_service.MIN_USERS_FOR_LEAGUE when this migration was written
+MIN_USERS_FOR_LEAGUE = 5
+
+
+def populate_company_league_configs(apps, schema_editor):
+    Company = apps.get_model('myapp', 'Company')
+    CompanyLeagueConfig = apps.get_model('myapp', 'CompanyLeagueConfig')
+    League = apps.get_model('myapp', 'League')
+    LeagueInstance = apps.get_model('myapp', 'LeagueInstance')
+
+    league_count = League.objects.count()
+    spans = {
+        row['company_id']: (row['lowest'], row['highest'])
+        for row in LeagueInstance.objects.filter(company__isnull=False, is_active=True)
+        .values('company_id').annotate(lowest=Min('league__order'), highest=Max('league__order')).order_by()
+    }
+    now = timezone.now()
+    configs = []
+    for company_id, member_count in Company.objects.annotate(member_count=Count('members')).values_list(
+            'id', 'member_count'):
+        lowest_order, highest_order = spans.get(company_id, (None, None))
+        configs.append(CompanyLeagueConfig(
+            company_id=company_id, member_count=member_count,
+            highest_level=min(member_count // MIN_USERS_FOR_LEAGUE, league_count),
+            lowest_order=lowest_order, highest_order=highest_order, updated_at=now,
+        ))
+    CompanyLeagueConfig.objects.bulk_create(configs, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0064_league_result'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompanyLeagueConfig',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('member_count', models.PositiveIntegerField(default=0)),
+                ('highest_level', models.PositiveIntegerField(default=0)),
+                ('lowest_order', models.PositiveIntegerField(blank=True, null=True)),
+                ('highest_order', models.PositiveIntegerField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('company', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='league_config', to='myapp.company')),
+            ],
+        ),
+        migrations.RunPython(populate_company_league_configs, migrations.RunPython.noop),
+    ]
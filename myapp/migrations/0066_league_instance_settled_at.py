@@ -0,0 +1,26 @@
+# Generated by Django 5.1.1 on 2026-10-18 05:45
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def mark_settled_instances(apps, schema_editor):
+    # Instances settled before this field existed must never be claimed again
+    LeagueInstance = apps.get_model('myapp', 'LeagueInstance')
+    LeagueInstance.objects.filter(is_active=False).update(settled_at=F('league_end'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0065_company_league_config'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='leagueinstance',
+            name='settled_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(mark_settled_instances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.1.1 on 2026-10-18 06:04
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def convert_draw_entries(apps, schema_editor):
+    """Turn each run of consecutive entries of one user in a draw into one ticket block."""
+    DrawEntry = apps.get_model('myapp', 'DrawEntry')
+    DrawTicketBlock = apps.get_model('myapp', 'DrawTicketBlock')
+    # Keep the purchase time of the converted entries
+    DrawTicketBlock._meta.get_field('timestamp').auto_now_add = False
+
+    blocks = []
+    draw_id = user_id = None
+    offset = 0
+    for entry_draw_id, entry_user_id, timestamp in DrawEntry.objects.order_by('draw_id', 'id').values_list(
+            'draw_id', 'user_id', 'timestamp').iterator(chunk_size=10000):
+        if entry_draw_id != draw_id:
+            draw_id, user_id, offset = entry_draw_id, None, 0
+        if entry_user_id == user_id:
+            blocks[-1].quantity += 1
+        else:
+            user_id = entry_user_id
+            blocks.append(DrawTicketBlock(draw_id=draw_id, user_id=user_id, quantity=1, offset=offset,
+                                          timestamp=timestamp))
+        offset += 1
+    DrawTicketBlock.objects.bulk_create(blocks, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0066_league_instance_settled_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DrawTicketBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('offset', models.PositiveIntegerField()),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('draw', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ticket_blocks', to='myapp.draw')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='draw_ticket_blocks', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='drawticketblock',
+            index=models.Index(fields=['draw', 'user'], name='myapp_drawt_draw_id_ab8cb6_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='drawticketblock',
+            constraint=models.UniqueConstraint(fields=('draw', 'offset'), name='unique_draw_ticket_offset'),
+        ),
+        migrations.RunPython(convert_draw_entries, migrations.RunPython.noop),
+        migrations.DeleteModel(
+            name='DrawEntry',
+        ),
+    ]
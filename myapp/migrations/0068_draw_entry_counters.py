@@ -0,0 +1,52 @@
+# Generated by Django 5.1.1 on 2026-10-18 06:11
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def count_draw_entries(apps, schema_editor):
+    Draw = apps.get_model('myapp', 'Draw')
+    DrawTicketBlock = apps.get_model('myapp', 'DrawTicketBlock')
+    DrawParticipant = apps.get_model('myapp', 'DrawParticipant')
+
+    draws = []
+    for draw_id, total in DrawTicketBlock.objects.values('draw_id').annotate(total=Sum('quantity')).values_list(
+            'draw_id', 'total').order_by():
+        draws.append(Draw(id=draw_id, entry_count=total))
+    Draw.objects.bulk_update(draws, ['entry_count'], batch_size=1000)
+
+    DrawParticipant.objects.bulk_create([
+        DrawParticipant(draw_id=draw_id, user_id=user_id, entry_count=total)
+        for draw_id, user_id, total in DrawTicketBlock.objects.values('draw_id', 'user_id')
+        .annotate(total=Sum('quantity')).values_list('draw_id', 'user_id', 'total').order_by()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0067_draw_ticket_blocks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='draw',
+            name='entry_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='DrawParticipant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entry_count', models.PositiveIntegerField(default=0)),
+                ('draw', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='participants', to='myapp.draw')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='draw_participations', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('draw', 'user')},
+            },
+        ),
+        migrations.RunPython(count_draw_entries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.1 on 2026-10-18 07:25
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0068_draw_entry_counters'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='workoutactivity',
+            unique_together={('user', 'start_datetime', 'end_datetime')},
+        ),
+    ]
@@ -1,22 +1,138 @@
-from django.db import models
+from django.db import DatabaseError, models, router, transaction
+from django.db.models.signals import post_save, pre_save
 from django.contrib.auth.models import AbstractUser
 from timezone_field import TimeZoneField
 import pytz
 import random
-from django.db.models import Sum
+from django.db.models import F, Sum
+from django.db.models.functions import Greatest
 from django.utils.timezone import now
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 import logging
 
+from .ws_coalescer import send_state_update
+
 
 logger = logging.getLogger(__name__)
 # Create your models here.
 
 
 TIMEZONES = tuple(zip(pytz.all_timezones, pytz.all_timezones))
-class CustomUser(AbstractUser):
+
+
+# Django's error when a save() with update_fields finds no row to update
+UPDATE_MISSED_ROW = 'Save with update_fields did not affect any rows.'
+
+
+class DirtyFieldsMixin(models.Model):
+    """
+    Remembers the column values a row was loaded or last saved with.
+
+    A plain save() of an existing row then writes only the columns that changed
+    (and skips the UPDATE entirely when nothing did, while still sending pre_save
+    and post_save with an empty ``update_fields``), and has_changed() answers
+    "did this field change?" without re-reading the row. Fields listed in
+    ``save_excluded_fields`` are maintained with queryset updates elsewhere and
+    are never written by a plain save(). If the row was deleted meanwhile, a plain
+    save() inserts it again with every field, as Django's own save() does.
+    """
+    save_excluded_fields = ()
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._snapshot()
+        return instance
+
+    def _snapshot(self, attnames=None):
+        if attnames is None or not hasattr(self, '_loaded_values'):
+            self._loaded_values = {}
+            attnames = [field.attname for field in self._meta.concrete_fields]
+        for attname in attnames:
+            # Deferred fields are not loaded, so there is nothing to compare them with
+            if attname in self.__dict__:
+                self._loaded_values[attname] = self.__dict__[attname]
+
+    def loaded_value(self, attname, default=None):
+        """The value ``attname`` had when the row was loaded or last saved."""
+        return getattr(self, '_loaded_values', {}).get(attname, default)
+
+    def get_dirty_fields(self):
+        """Attribute names of the loaded fields whose values changed since the row was loaded or saved."""
+        loaded = getattr(self, '_loaded_values', {})
+        return {
+            attname for attname, value in loaded.items()
+            if attname in self.__dict__ and self.__dict__[attname] != value
+        }
+
+    def has_changed(self, *attnames):
+        """Whether the row is new or any of ``attnames`` changed since it was loaded or saved."""
+        if self._state.adding or not hasattr(self, '_loaded_values'):
+            return True
+        return bool(self.get_dirty_fields() & set(attnames))
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        super().refresh_from_db(using=using, fields=fields, from_queryset=from_queryset)
+        self._snapshot(None if fields is None else [self._meta.get_field(name).attname for name in fields])
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        chosen = False
+        if (not args and update_fields is None and not kwargs.get('force_insert')
+                and not self._state.adding and hasattr(self, '_loaded_values')):
+            dirty = self.get_dirty_fields()
+            dirty |= {field.attname for field in self._meta.concrete_fields if getattr(field, 'auto_now', False)}
+            # Fields that were deferred on load but have been assigned since
+            dirty |= {field.attname for field in self._meta.concrete_fields
+                      if not field.primary_key and field.attname in self.__dict__
+                      and field.attname not in self._loaded_values}
+            kwargs['update_fields'] = update_fields = dirty - set(self.save_excluded_fields)
+            chosen = True
+            if not update_fields:
+                self._send_unchanged_save_signals(kwargs.get('using'))
+                return
+        elif (not args and update_fields is None and not self._state.adding
+                and not kwargs.get('force_insert') and self.save_excluded_fields):
+            # No snapshot to compare with: write everything except the excluded fields
+            kwargs['update_fields'] = update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname not in self.save_excluded_fields
+            ]
+            chosen = True
+
+        try:
+            super().save(*args, **kwargs)
+        except DatabaseError as e:
+            if not chosen or str(e) != UPDATE_MISSED_ROW:
+                raise
+            # The row was deleted since it was loaded: insert it again, as a full save() would.
+            # Django raised this itself, not the database, so the transaction is still usable.
+            using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+            if transaction.get_connection(using).in_atomic_block:
+                transaction.set_rollback(False, using)
+            del kwargs['update_fields']
+            update_fields = None
+            super().save(*args, **kwargs)
+
+        if update_fields is None:
+            self._snapshot()
+        else:
+            fields = [self._meta.get_field(name) for name in update_fields]
+            self._snapshot([field.attname for field in fields])
+
+    def _send_unchanged_save_signals(self, using):
+        """Send the signals of a save() that had nothing to write, so receivers still see every save."""
+        using = using or router.db_for_write(self.__class__, instance=self)
+        pre_save.send(sender=self.__class__, instance=self, raw=False, using=using, update_fields=frozenset())
+        post_save.send(sender=self.__class__, instance=self, created=False, update_fields=frozenset(), raw=False,
+                       using=using)
+
+
+class CustomUser(AbstractUser, DirtyFieldsMixin):
     # Adding extra fields without changing the creation process
     LOGIN_TYPE_CHOICES = [
         ('email', 'Email and Password'),
@@ -37,6 +153,7 @@ class CustomUser(AbstractUser):
     date_joined = models.DateTimeField(auto_now_add=True)  # Automatically set when the user is created
     streak_savers = models.PositiveIntegerField(default=0)  # Count of streak savers
     gems_spent = models.PositiveIntegerField(default=0)  # Total gems the user has spent
+    gem_balance = models.IntegerField(default=0)  # Gems earned minus gems spent, maintained with the gem ledger
     # Add a foreign key to the company (a user can only belong to one company)
     company = models.ForeignKey(
         'Company', 
@@ -47,15 +164,13 @@ class CustomUser(AbstractUser):
     )
     timezone = TimeZoneField(default='UTC', use_pytz=False)
 
+    # gem_balance is only moved by the gem ledger; never write back a stale in-memory copy
+    save_excluded_fields = ('gem_balance',)
+
     def get_gem_count(self):
-        # Calculate total gems (XP-based + manual gems)
-        total_xp_gems = Gem.objects.filter(user=self).aggregate(total_xp_gems=Sum('xp_gem'))['total_xp_gems'] or 0
-        total_manual_gems = Gem.objects.filter(user=self).aggregate(total_manual_gems=Sum('manual_gem'))['total_manual_gems'] or 0
-        total_gems_spent = self.gems_spent  # Assuming you have a `gems_spent` field
-
-        # Calculate total gems and ensure no negative gems
-        total_gems = total_xp_gems + total_manual_gems - total_gems_spent
-        return max(0, total_gems)  # Ensure no negative gems
+        # Read the maintained balance instead of aggregating the Gem rows
+        from .gem_service import get_gem_balance
+        return get_gem_balance(self)
     
     def __str__(self):
         return self.email
@@ -117,7 +232,7 @@ class Invitation(models.Model):
     def __str__(self):
         return f" Invite for {self.email} to {self.company}"
 
-class Gem(models.Model):
+class Gem(DirtyFieldsMixin, models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='gem_records')
     date = models.DateField()
     xp_gem = models.PositiveIntegerField(default=0, blank=True, null=True)
@@ -132,18 +247,37 @@ class Gem(models.Model):
         return f'{self.user.email} - Gems on {self.date}'
 
     def save(self, *args, **kwargs):
-        # Track whether the values have changed
-        changed = False
-
-        if self.pk is not None:
-            orig = Gem.objects.get(pk=self.pk)
-            if self.xp_gem != orig.xp_gem or self.manual_gem != orig.manual_gem:
-                changed = True
+        from .gem_service import record_gem_row_change
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            writes_gems = bool({'xp_gem', 'manual_gem'} & set(update_fields))
         else:
-            # New object, always consider it as changed
-            changed = True
-
-        super().save(*args, **kwargs)
+            writes_gems = self.has_changed('xp_gem', 'manual_gem')
+        if not writes_gems:
+            # The gem columns are not written, so there is no change to record
+            super().save(*args, **kwargs)
+            return
+
+        with transaction.atomic():
+            old = {}
+            if not self._state.adding:
+                # Lock the row so concurrent saves of it are recorded one after another, each
+                # against what the row holds now rather than what it was loaded with
+                old = (Gem.objects.select_for_update().filter(pk=self.pk)
+                       .values('xp_gem', 'manual_gem').first() or {})
+                if not hasattr(self, '_loaded_values'):
+                    # Built by hand rather than loaded: compare with the stored values
+                    self._loaded_values = dict(old)
+            changed = self.has_changed('xp_gem', 'manual_gem')
+
+            super().save(*args, **kwargs)
+            if old:
+                # Only the changed columns may have been written, so read back what the row holds
+                new = Gem.objects.filter(pk=self.pk).values('xp_gem', 'manual_gem').get()
+            else:
+                new = {'xp_gem': self.xp_gem, 'manual_gem': self.manual_gem}
+            # Keep the user's gem balance and ledger in step with the row
+            record_gem_row_change(self, old, new)
 
         # Only broadcast if values have actually changed
         if changed:
@@ -162,9 +296,8 @@ class Gem(models.Model):
         gems_earned_today = gem_record.xp_gem if gem_record else 0
         xp_gems_remaining_today = max(0, 5 - gems_earned_today)  # Assuming the daily limit is 5
 
-        # Get the channel layer and send the updated gem count and XP gems remaining to the WebSocket
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
+        # Send the updated gem count and XP gems remaining to the WebSocket, coalesced with other updates
+        send_state_update(
             f'gem_{user.id}',  # Group name based on user_id
             {
                 'type': 'send_gem_update',
@@ -204,9 +337,107 @@ class Xp(models.Model):
         # self.gems_awarded = int (self.totalXpToday // 250)
         if not self.date:
             self.date = self.timeStamp.date()  # Set the date field based on timeStamp
-        super(Xp, self).save(*args, **kwargs)
+        from .xp_service import apply_xp_to_totals
+        with transaction.atomic():
+            is_new = self._state.adding
+            super(Xp, self).save(*args, **kwargs)
+            if is_new:
+                # Keep the materialized totals in step with every inserted record
+                apply_xp_to_totals(self.user_id, [self])
+
+
+class XpTotal(models.Model):
+    """All-time XP totals for a user, maintained on every Xp insert."""
+    user = models.OneToOneField(CustomUser, on_delete=models.CASCADE, related_name='xp_total')
+    total_xp = models.FloatField(default=0.0)
+    steps_xp = models.FloatField(default=0.0)
+    workout_xp = models.FloatField(default=0.0)
+
+    def __str__(self):
+        return f'{self.user.email} - Total XP: {self.total_xp}'
+
+
+class XpDailyTotal(models.Model):
+    """
+    Per-user, per-local-day activity rollup. XP columns are maintained on every Xp insert,
+    step and workout columns whenever DailySteps / WorkoutActivity rows are written.
+    """
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='xp_daily_totals')
+    date = models.DateField()
+    total_xp = models.FloatField(default=0.0)
+    steps_xp = models.FloatField(default=0.0)
+    workout_xp = models.FloatField(default=0.0)
+    movement_xp = models.FloatField(default=0.0)  # XP from movement workouts (steps XP is in steps_xp)
+    mindfulness_xp = models.FloatField(default=0.0)  # XP from mindfulness workouts
+    step_count = models.IntegerField(default=0)  # Latest DailySteps count for the day
+    steps_timestamp = models.DateTimeField(null=True, blank=True)  # Timestamp of that DailySteps record
+    workout_count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.user.email} - XP: {self.total_xp} on {self.date}'
+
+    class Meta:
+        unique_together = ('user', 'date')
+
+class GemTransaction(models.Model):
+    """
+    Append-only ledger of changes to a user's gem balance. CustomUser.gem_balance
+    is updated in the same transaction as every entry, so it always equals the
+    sum of the user's entries.
+    """
+    KIND_CHOICES = [
+        ('xp', 'XP Gems'),
+        ('manual', 'Manual Gems'),
+        ('spend', 'Spend'),
+        ('reset', 'Reset'),
+        ('adjustment', 'Adjustment'),
+    ]
+
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='gem_transactions')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    amount = models.IntegerField()  # Signed change to the balance
+    balance_after = models.IntegerField()
+    gem_date = models.DateField(null=True, blank=True)  # Date of the Gem row the change applies to
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.user.email} - {self.kind} {self.amount:+d} gems'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at']),
+        ]
+
+
+class IngestionReceipt(models.Model):
+    """
+    Stored result of an ingestion request made with a client sync key.
+    A retried request with the same key is answered from here without re-applying it.
+    """
+    ENDPOINT_CHOICES = [
+        ('daily_steps', 'Daily Steps'),
+        ('workout', 'Workout'),
+        ('health_sync', 'Health Sync'),
+    ]
+
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='ingestion_receipts')
+    sync_key = models.CharField(max_length=100)
+    endpoint = models.CharField(max_length=20, choices=ENDPOINT_CHOICES)
+    status_code = models.PositiveSmallIntegerField(default=0)
+    response = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.user.email} - {self.endpoint} sync key {self.sync_key}'
+
+    class Meta:
+        unique_together = ('user', 'sync_key')
+        indexes = [
+            models.Index(fields=['created_at']),
+        ]
+
 
-class Streak(models.Model):
+class Streak(DirtyFieldsMixin, models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='streak_records')
     timeStamp = models.DateTimeField()  # Timestamp for the streak update
     date = models.DateField()  # Explicitly store the date part
@@ -221,9 +452,32 @@ class Streak(models.Model):
         unique_together = ('user', 'date')  # Ensure one entry per user per day
     
     def save(self, *args, **kwargs):
+        from .activity_bitmap import mark_active_days
         if not self.date:
             self.date = self.timeStamp.date()  # Set the date field based on timeStamp
-        super(Streak, self).save(*args, **kwargs)
+        # Only a new or moved row changes which days are active
+        new_day = self.has_changed('date')
+        with transaction.atomic():
+            super(Streak, self).save(*args, **kwargs)
+            if new_day:
+                mark_active_days([(self.user_id, self.date)])
+
+
+class StreakActivityBitmap(models.Model):
+    """
+    One bit per local day of ``year`` for a user, set when the day has a Streak record.
+    Bit n (byte n // 8, bit n % 8, least significant first) is day n of the year,
+    counting from 0 for January 1st.
+    """
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='activity_bitmaps')
+    year = models.IntegerField()
+    bits = models.BinaryField(default=bytes(46))  # 366 days rounded up to whole bytes
+
+    def __str__(self):
+        return f'{self.user.email} - activity {self.year}'
+
+    class Meta:
+        unique_together = ('user', 'year')
 
 
 
@@ -241,7 +495,10 @@ class DailySteps(models.Model):
         unique_together = ('user', 'date')  # Ensure one record per user per day
 
     def save(self, *args, **kwargs):
-        super(DailySteps, self).save(*args, **kwargs)
+        from .xp_service import apply_steps_to_rollup
+        with transaction.atomic():
+            super(DailySteps, self).save(*args, **kwargs)
+            apply_steps_to_rollup(self.user_id, [self])
         logger.info(
             f"DailySteps saved for user {self.user.email} on {self.date}: "
             f"Steps: {self.step_count}, XP: {self.xp}, Timestamp: {self.timestamp}"
@@ -269,7 +526,15 @@ class WorkoutActivity(models.Model):
         return f'{self.user.email} - Activity: {self.activity_name} on {self.start_datetime.date()}'
     
     class Meta:
-        unique_together = ('user', 'start_datetime')  # Ensure one record per user per start time
+        unique_together = ('user', 'start_datetime', 'end_datetime')  # Ensure one record per user per start and end time
+
+    def save(self, *args, **kwargs):
+        from .xp_service import apply_workouts_to_rollup
+        with transaction.atomic():
+            is_new = self._state.adding
+            super(WorkoutActivity, self).save(*args, **kwargs)
+            if is_new:
+                apply_workouts_to_rollup(self.user_id, [self])
     
 
 
@@ -314,22 +579,51 @@ class Draw(models.Model):
     number_of_winners = models.PositiveIntegerField(default=1)
     is_active = models.BooleanField(default=True)
     video = models.FileField(upload_to='draw_videos/', null=True, blank=True)  # Optional video upload
+    # Tickets sold, kept by add_tickets() in the purchase transaction
+    entry_count = models.PositiveIntegerField(default=0)
+
+    def ticket_count(self):
+        """Number of tickets sold: the end of the last ticket block."""
+        last = self.ticket_blocks.order_by('-offset').values_list('offset', 'quantity').first()
+        return sum(last) if last else 0
+
+    def add_tickets(self, user, quantity):
+        """
+        Sell ``quantity`` tickets to ``user`` as one ticket block placed after the last one.
+
+        The draw row is locked until the caller's transaction ends, so concurrent
+        purchases get consecutive, non-overlapping ticket ranges and the draw's and
+        the user's entry counters stay exact.
+        """
+        with transaction.atomic():
+            offset = Draw.objects.select_for_update().values_list('entry_count', flat=True).get(pk=self.pk)
+            block = DrawTicketBlock.objects.create(user=user, draw=self, quantity=quantity, offset=offset)
+            Draw.objects.filter(pk=self.pk).update(entry_count=F('entry_count') + quantity)
+            if not DrawParticipant.objects.filter(draw=self, user=user).update(
+                    entry_count=F('entry_count') + quantity):
+                DrawParticipant.objects.create(draw=self, user=user, entry_count=quantity)
+            self.entry_count = offset + quantity
+            return block
 
     def pick_winners(self):
-        # Get all entries for the draw
-        entries = DrawEntry.objects.filter(draw=self)
-        if entries.count() == 0:
+        # Each ticket is a number in [0, total); its block is the last one starting at or before it
+        total = self.ticket_count()
+        if total == 0:
             return  # No entries to pick from
 
         # Get available prizes for the draw
         # prizes = list(Prize.objects.filter(draw=self, quantity__gt=0).order_by('-value'))  # Prioritize by value or other criteria
         prizes = list(Prize.objects.filter(draw=self, quantity__gt=0))
 
-        # Randomly pick winners from the list of entries
-        winners = random.sample(list(entries), min(self.number_of_winners, entries.count()))
+        # Randomly pick winning tickets; each one is an index lookup on (draw, offset)
+        tickets = random.sample(range(total), min(self.number_of_winners, total))
+        winners = [
+            self.ticket_blocks.filter(offset__lte=ticket).order_by('-offset').values_list('user_id', flat=True)[0]
+            for ticket in tickets
+        ]
 
         # Assign prizes to winners
-        for i, entry in enumerate(winners):
+        for i, user_id in enumerate(winners):
             if prizes:  # If there are remaining prizes
                 prize = prizes.pop(0)  # Get the first prize from the list
                 prize.quantity -= 1  # Reduce prize quantity
@@ -342,7 +636,7 @@ class Draw(models.Model):
                 prize = None  # No prize available for this winner
 
             # Create the DrawWinner entry
-            DrawWinner.objects.create(user=entry.user, draw=self, prize=prize)
+            DrawWinner.objects.create(user_id=user_id, draw=self, prize=prize)
 
         # Mark draw as inactive
         self.is_active = False
@@ -360,14 +654,55 @@ class DrawImage(models.Model):
     def __str__(self):
         return self.title
 
-# Entry Model (tracks user entries in a draw)
-class DrawEntry(models.Model):
-    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
-    draw = models.ForeignKey(Draw, on_delete=models.CASCADE, related_name='entries')
+class DrawTicketBlock(models.Model):
+    """
+    The tickets one purchase added to a draw. A draw's tickets are numbered from 0
+    in purchase order; a block holds tickets ``offset`` to ``offset + quantity - 1``,
+    so blocks ordered by offset cover every ticket exactly once.
+    """
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='draw_ticket_blocks')
+    draw = models.ForeignKey(Draw, on_delete=models.CASCADE, related_name='ticket_blocks')
+    quantity = models.PositiveIntegerField()
+    offset = models.PositiveIntegerField()  # Tickets sold in the draw before this block
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['draw', 'offset'], name='unique_draw_ticket_offset'),
+        ]
+        indexes = [
+            models.Index(fields=['draw', 'user']),
+        ]
+
+    @property
+    def ticket_ids(self):
+        """The block's ticket numbers, shown to users as their ticket ids (1-based)."""
+        return range(self.offset + 1, self.offset + self.quantity + 1)
+
+    @staticmethod
+    def user_ticket_ids(draw_ids, user):
+        """draw id -> ticket ids ``user`` holds in it, in purchase order, for each of ``draw_ids``."""
+        ticket_ids = {draw_id: [] for draw_id in draw_ids}
+        blocks = DrawTicketBlock.objects.filter(draw_id__in=list(ticket_ids), user=user).order_by('offset')
+        for block in blocks:
+            ticket_ids[block.draw_id].extend(block.ticket_ids)
+        return ticket_ids
+
     def __str__(self):
-        return f"{self.user} entry for {self.draw}"
+        return f"{self.user} tickets {self.offset + 1}-{self.offset + self.quantity} for {self.draw}"
+
+
+class DrawParticipant(models.Model):
+    """Tickets one user holds in a draw, kept by Draw.add_tickets() in the purchase transaction."""
+    draw = models.ForeignKey(Draw, on_delete=models.CASCADE, related_name='participants')
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='draw_participations')
+    entry_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('draw', 'user')
+
+    def __str__(self):
+        return f"{self.user} has {self.entry_count} tickets for {self.draw}"
 
 # Winner Model (tracks the winners for each draw)
 class DrawWinner(models.Model):
@@ -396,12 +731,43 @@ class LeagueInstance(models.Model):
     league_end = models.DateTimeField(db_index=True)
     company = models.ForeignKey(Company, null=True, blank=True, on_delete=models.CASCADE,db_index=True)
     max_participants = models.PositiveIntegerField(default=30)
+    # Memberships in this instance, kept current by league_service.place_users() and the UserLeague signals
+    participant_count = models.PositiveIntegerField(default=0)
     is_active = models.BooleanField(default=True,db_index=True)
+    # Set by the settlement that ranked this instance; a settled instance is never claimed again
+    settled_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.league.name} - {self.league_start}"
 
-class UserLeague(models.Model):
+class CompanyLeagueConfig(models.Model):
+    """
+    League settings derived from a company's members and active league instances.
+
+    Kept current by league_service.refresh_company_league_configs(), which runs
+    when a user joins or leaves the company and when its instances are created or
+    settled, so settlement and the league views read one row instead of counting
+    members and scanning instances.
+    """
+    company = models.OneToOneField(Company, on_delete=models.CASCADE, related_name='league_config')
+    member_count = models.PositiveIntegerField(default=0)
+    # Highest league order the company's users can be promoted to
+    highest_level = models.PositiveIntegerField(default=0)
+    # Span of the league orders of the company's active instances
+    lowest_order = models.PositiveIntegerField(null=True, blank=True)
+    highest_order = models.PositiveIntegerField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def allowed_orders(self):
+        """League orders the company's users can be placed in; the first league is always open."""
+        return list(range(1, max(self.highest_level, 1) + 1))
+
+    def __str__(self):
+        return f'{self.company.name} - up to league {self.highest_level}'
+
+
+class UserLeague(DirtyFieldsMixin, models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     league_instance = models.ForeignKey(LeagueInstance, on_delete=models.CASCADE)
     xp_company = models.IntegerField(default=0)  # XP specific to company leagues
@@ -414,6 +780,40 @@ class UserLeague(models.Model):
         return f"{self.user.username} in {self.league_instance}"
 
 
+class LeagueResult(models.Model):
+    """
+    Final standing of one user in a settled league instance. Written once by
+    league_service.settle_expired_leagues() and never updated afterwards.
+    """
+    STATUS_CHOICES = [
+        ('Promoted', 'Promoted'),
+        ('Retained', 'Retained'),
+        ('Demoted', 'Demoted'),
+    ]
+
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='league_results')
+    league_instance = models.ForeignKey(LeagueInstance, on_delete=models.CASCADE, related_name='results')
+    league = models.ForeignKey(League, on_delete=models.CASCADE)
+    # Copied from the instance so a user's history is one index range scan
+    company = models.ForeignKey(Company, null=True, blank=True, on_delete=models.CASCADE)
+    league_end = models.DateTimeField()
+    rank = models.PositiveIntegerField()
+    participants = models.PositiveIntegerField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES)
+    gems_obtained = models.PositiveIntegerField(default=0)
+    xp = models.IntegerField(default=0)  # League XP when the instance ended
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.user.username} - {self.status} #{self.rank} in {self.league_instance_id}'
+
+    class Meta:
+        unique_together = ('user', 'league_instance')
+        indexes = [
+            models.Index(fields=['user', 'company', '-league_end']),
+        ]
+
+
 class UserFollowing(models.Model):
     follower =models.ForeignKey(CustomUser, on_delete=models.CASCADE ,related_name="following")
     following = models.ForeignKey(CustomUser,on_delete=models.CASCADE, related_name="followers")
@@ -427,7 +827,7 @@ class UserFollowing(models.Model):
         return f"{self.follower} follows {self.following}"
     
 
-class Feed(models.Model):
+class Feed(DirtyFieldsMixin, models.Model):
     PROMOTION = 'Promotion'
     MILESTONE = 'Milestone'
     STREAK = 'Streak'
@@ -468,15 +868,24 @@ class Clap(models.Model):
         unique_together = ('user', 'feed')  # Ensures one clap per user per feed
 
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        self.feed.claps_count = self.feed.claps.count()
-        self.feed.save()
+        created = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if created:
+                self._adjust_claps_count(1)
 
     def delete(self, *args, **kwargs):
-        feed = self.feed
-        super().delete(*args, **kwargs)
-        feed.claps_count = feed.claps.count()
-        feed.save()
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            self._adjust_claps_count(-1)
+        return result
+
+    def _adjust_claps_count(self, delta):
+        # Move the counter in place instead of recounting the claps and re-saving the feed
+        Feed.objects.filter(pk=self.feed_id).update(claps_count=Greatest(F('claps_count') + delta, 0))
+        if Clap.feed.is_cached(self):
+            self.feed.claps_count = max(self.feed.claps_count + delta, 0)
+            self.feed._snapshot(['claps_count'])
 
     def __str__(self):
         return f"Clap on {self.feed}"
@@ -0,0 +1,294 @@
+"""
+Cached ranking snapshots per league instance.
+
+A snapshot is the league header plus every member's rank, XP, streak, expected
+advancement and gems, computed with the same rules as settlement. The league
+views and the ranking broadcasts read it through get_ranking_snapshot(), so a
+page view reuses what the last XP write already computed. With live league XP,
+the members' live scores are laid over the snapshot of an active instance on
+every read. Settled outcomes are read from LeagueResult instead, which does not
+expire.
+
+Snapshots are cached under a per-instance version. Any change to a membership or
+its XP bumps the version after commit (invalidate_ranking_snapshots), which makes
+every older snapshot unreachable; the cache timeout only bounds how long profile
+changes such as a new username or picture can take to show up.
+
+Delta protocol: clients connecting with ``?protocol=delta`` get the last
+published snapshot with its sequence number, then ``rankings_delta`` messages
+holding only the members whose entry changed (``changes``, upserted by
+user_id) and the members who left (``removed``, applied first). A delta applies
+to ``base_seq`` and moves the client to ``seq``. Clients silently drop a delta
+whose ``seq`` is not above the sequence they hold: it was published before the
+snapshot they connected with and is already part of it. A client whose sequence
+is below ``base_seq`` has missed a message and should reconnect for a new
+snapshot. A ``rankings_snapshot`` message replaces the client's state outright.
+
+Sequences come from an atomic ``incr`` of a per-instance counter that never
+expires, so concurrent publishers never send the same ``seq`` and a sequence
+never goes backwards, however long the published snapshots are kept. A publisher
+whose base snapshot is not (or no longer) stored sends a ``rankings_snapshot``
+instead of a delta.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .models import UserLeague
+
+logger = logging.getLogger(__name__)
+
+PROFILE_PICTURE_BASE_URL = "https://video-play-api-bucket.s3.amazonaws.com/"
+PUBLISHED_TIMEOUT = 8 * 24 * 3600  # Outlives a league week
+SUPERSEDED_TIMEOUT = 60  # Keeps a replaced snapshot for publishers still reading it
+
+
+def _cache():
+    return caches[settings.LEAGUE_RANKING_CACHE]
+
+
+def _version_key(instance_id):
+    return f'league_ranking:{instance_id}:version'
+
+
+def _version(instance_id):
+    # A lost version restarts from the clock so it never reuses an older snapshot key
+    return _cache().get_or_set(_version_key(instance_id), int(time.time() * 1000), None)
+
+
+def _snapshot_key(instance_id, version):
+    return f'league_ranking:{instance_id}:{version}'
+
+
+def invalidate_ranking_snapshots(instance_ids):
+    """Bump the snapshot version of ``instance_ids`` once the current transaction commits."""
+    instance_ids = set(instance_ids)
+    if not instance_ids:
+        return
+
+    def bump():
+        cache = _cache()
+        for instance_id in instance_ids:
+            try:
+                cache.incr(_version_key(instance_id))
+            except ValueError:
+                _version(instance_id)
+
+    transaction.on_commit(bump)
+
+
+def league_edges(league_instance):
+    """(is_highest, is_lowest) for the instance's league: fixed orders globally, the active span for a company."""
+    from .league_service import company_league_configs
+
+    order = league_instance.league.order
+    if league_instance.company_id is None:
+        return order == 10, order == 1
+    config = company_league_configs([league_instance.company_id])[league_instance.company_id]
+    return order == config.highest_order, order == config.lowest_order
+
+
+def _member_rows(instance_ids, company):
+    """(instance id, user id, username, picture, streak, xp) of every member, in ranking order per instance."""
+    xp_field = 'xp_company' if company else 'xp_global'
+    return (
+        UserLeague.objects.filter(league_instance_id__in=instance_ids)
+        .order_by('league_instance_id', f'-{xp_field}', '-user__streak', 'id')
+        .values_list('league_instance_id', 'user_id', 'user__username', 'user__profile_picture', 'user__streak',
+                     xp_field)
+    )
+
+
+def _rank(rankings, edges):
+    """Number ``rankings``, already in ranking order, and set each member's expected advancement and gems."""
+    from .league_service import OUTCOME_LABELS, decide_outcome
+
+    is_highest, is_lowest = edges
+    for rank, entry in enumerate(rankings, start=1):
+        move, gems_obtained = decide_outcome(rank, len(rankings), entry['xp'], is_highest, is_lowest)
+        entry.update(gems_obtained=gems_obtained, rank=rank, advancement=OUTCOME_LABELS[move][0])
+    return rankings
+
+
+def _snapshot(league_instance, members, edges):
+    rankings = _rank([
+        {
+            "user_id": user_id,
+            "username": username,
+            "profile_picture": f"{PROFILE_PICTURE_BASE_URL}{picture}" if picture else None,
+            "xp": xp,
+            "streaks": streak,
+        }
+        for user_id, username, picture, streak, xp in members
+    ], edges)
+
+    league = league_instance.league
+    return {
+        "league_id": league_instance.id,
+        "league_name": league.name,
+        "league_level": 11 - league.order,
+        "league_start": league_instance.league_start.isoformat(timespec='milliseconds') + 'Z',
+        "league_end": league_instance.league_end.isoformat(timespec='milliseconds') + 'Z',
+        "rankings": rankings,
+    }
+
+
+def cache_ranking_snapshots(league_instances, edges):
+    """
+    Build and cache the snapshots of several instances of one kind (all global or all
+    company) with a single member query, replacing any cached ones. Settlement uses
+    this to cache the final standings before it resets the XP.
+
+    Args:
+        league_instances (list): The instances, with their league loaded.
+        edges (dict): instance id -> (is_highest, is_lowest).
+    """
+    if not league_instances:
+        return {}
+    company = league_instances[0].company_id is not None
+    members = {instance.id: [] for instance in league_instances}
+    for instance_id, *member in _member_rows(list(members), company):
+        members[instance_id].append(member)
+
+    cache = _cache()
+    snapshots = {}
+    for instance in league_instances:
+        snapshots[instance.id] = _snapshot(instance, members[instance.id], edges[instance.id])
+        cache.set(_snapshot_key(instance.id, _version(instance.id)), snapshots[instance.id],
+                  settings.LEAGUE_RANKING_CACHE_SECONDS)
+    return snapshots
+
+
+def cache_ranking_snapshot(league_instance, edges=None):
+    """Build the instance's snapshot with one member query and cache it under the current version."""
+    if edges is None:
+        edges = league_edges(league_instance)
+    return cache_ranking_snapshots([league_instance], {league_instance.id: edges})[league_instance.id]
+
+
+def _with_live_scores(league_instance, snapshot):
+    """``snapshot`` re-ranked by the members' live XP, which runs ahead of the checkpointed UserLeague rows."""
+    from .live_leaderboard import live_scores
+
+    scores = live_scores(league_instance)
+    if all(scores.get(entry['user_id'], entry['xp']) == entry['xp'] for entry in snapshot['rankings']):
+        return snapshot
+    rankings = [dict(entry, xp=scores.get(entry['user_id'], entry['xp'])) for entry in snapshot['rankings']]
+    # Stable, so members tied on XP and streak keep their checkpointed order
+    rankings.sort(key=lambda entry: (-entry['xp'], -entry['streaks']))
+    return dict(snapshot, rankings=_rank(rankings, league_edges(league_instance)))
+
+
+def get_ranking_snapshot(league_instance):
+    """
+    Return the instance's ranking snapshot, building it only if the current version is not cached.
+    With LEAGUE_XP_MODE = 'live', an active instance is ranked by the live leaderboard.
+    """
+    from .live_leaderboard import is_live_leaderboard
+
+    snapshot = _cache().get(_snapshot_key(league_instance.id, _version(league_instance.id)))
+    if snapshot is None:
+        snapshot = cache_ranking_snapshot(league_instance)
+    if is_live_leaderboard() and league_instance.is_active:
+        snapshot = _with_live_scores(league_instance, snapshot)
+    return snapshot
+
+
+def with_user_rank(snapshot, user_id):
+    """The snapshot as sent to one user: the header and rankings plus that user's ``user_rank``."""
+    user_rank = next((entry['rank'] for entry in snapshot['rankings'] if entry['user_id'] == user_id), None)
+    return dict(snapshot, user_rank=user_rank)
+
+
+def _seq_key(instance_id):
+    return f'league_ranking:{instance_id}:seq'
+
+
+def _published_key(instance_id, seq):
+    return f'league_ranking:{instance_id}:published:{seq}'
+
+
+def _next_seq(cache, instance_id):
+    try:
+        return cache.incr(_seq_key(instance_id))
+    except ValueError:
+        # A lost counter restarts from the clock so it never reuses a sequence clients hold
+        cache.add(_seq_key(instance_id), int(time.time() * 1000), None)
+        return cache.incr(_seq_key(instance_id))
+
+
+def _latest_published(cache, instance_id):
+    """(seq, snapshot) of the last claimed sequence; the snapshot is None until it is stored."""
+    seq = cache.get(_seq_key(instance_id), 0)
+    return seq, cache.get(_published_key(instance_id, seq)) if seq else None
+
+
+def ranking_changes(previous, current):
+    """
+    The entries of ``current`` that differ from ``previous``, and the user ids that left.
+
+    New members are sent whole; existing members only with their changed fields.
+    """
+    before = {entry['user_id']: entry for entry in previous['rankings']}
+    changes = []
+    for entry in current['rankings']:
+        old = before.get(entry['user_id'])
+        if old is None:
+            changes.append(entry)
+        elif old != entry:
+            changes.append({'user_id': entry['user_id'],
+                            **{field: value for field, value in entry.items() if old.get(field) != value}})
+    current_ids = {entry['user_id'] for entry in current['rankings']}
+    removed = [user_id for user_id in before if user_id not in current_ids]
+    return changes, removed
+
+
+def publish_rankings(league_instance):
+    """
+    Record the current snapshot as the one delta clients hold and return the message moving them to it.
+
+    Returns:
+        dict: A ``rankings_delta`` message, a ``rankings_snapshot`` message when there is no
+        stored snapshot to base a delta on, or None when the rankings did not change.
+    """
+    cache = _cache()
+    snapshot = get_ranking_snapshot(league_instance)
+    latest_seq, published = _latest_published(cache, league_instance.id)
+    if published == snapshot:
+        return None
+
+    seq = _next_seq(cache, league_instance.id)
+    if seq != latest_seq + 1:
+        # Another publisher claimed a sequence in between: build on its snapshot if it is stored
+        published = cache.get(_published_key(league_instance.id, seq - 1))
+    cache.set(_published_key(league_instance.id, seq), snapshot, PUBLISHED_TIMEOUT)
+    cache.touch(_published_key(league_instance.id, seq - 1), SUPERSEDED_TIMEOUT)
+    if published is None:
+        return dict(snapshot, type='rankings_snapshot', seq=seq)
+
+    changes, removed = ranking_changes(published, snapshot)
+    return {
+        'type': 'rankings_delta',
+        'league_id': league_instance.id,
+        'base_seq': seq - 1,
+        'seq': seq,
+        'changes': changes,
+        'removed': removed,
+    }
+
+
+def published_rankings(league_instance):
+    """(seq, snapshot) delta clients currently hold, publishing the current snapshot if there is none."""
+    cache = _cache()
+    seq, snapshot = _latest_published(cache, league_instance.id)
+    if snapshot is None:
+        publish_rankings(league_instance)
+        seq, snapshot = _latest_published(cache, league_instance.id)
+    if snapshot is None:
+        # A concurrent publisher has claimed the next sequence but not stored it yet;
+        # its message moves the client on from the current rankings
+        snapshot = get_ranking_snapshot(league_instance)
+    return seq, snapshot
@@ -4,7 +4,8 @@ from django.contrib.auth import get_user_model
 from .models import Draw, Prize
 from django.utils import timezone
 from .models import (Company, Invitation, Membership, WorkoutActivity, Xp, Streak, DailySteps, Purchase, Draw,
-                     DrawEntry, DrawWinner, Prize, UserLeague, Feed, Clap, UserFollowing, Gem, DrawImage, Notif)
+                     DrawTicketBlock, DrawWinner, Prize, UserLeague, Feed, Clap, UserFollowing, Gem, DrawImage, Notif,
+                     XpDailyTotal, LeagueResult)
 import random
 import string
 from allauth.socialaccount.models import SocialAccount
@@ -12,6 +13,9 @@ import logging
 from rest_framework.validators import UniqueValidator
 from django.db import transaction, IntegrityError
 from .tasks import send_invitation_email_task
+from .xp_service import record_xp, get_total_xp_all_time
+from .gem_service import get_gem_balance
+from .live_leaderboard import add_league_xp, is_live_leaderboard
 from timezone_field.rest_framework import TimeZoneSerializerField
 from datetime import datetime, timedelta, timezone
 from django.db.models import Sum
@@ -249,14 +253,8 @@ class UserProfileSerializer(serializers.ModelSerializer):
         ]
 
     def get_gem(self, obj):
-        # Calculate the total gems from the Gem model
-        total_xp_gems = Gem.objects.filter(user=obj).aggregate(total_xp_gems=Sum('xp_gem'))['total_xp_gems'] or 0
-        total_manual_gems = Gem.objects.filter(user=obj).aggregate(total_manual_gems=Sum('manual_gem'))['total_manual_gems'] or 0
-        total_gems_spent = obj.gems_spent  # Assuming you have a `gems_spent` field in the user model
-
-        # Calculate total gems
-        total_gems = total_xp_gems + total_manual_gems - total_gems_spent
-        return max(0, total_gems)  # Ensure no negative gems
+        # The maintained gem balance of the loaded user
+        return get_gem_balance(obj, refresh=False)
 
     def get_global_league(self, obj):
         # Get the UserLeague entry for the user's global league
@@ -292,49 +290,45 @@ class UserProfileSerializer(serializers.ModelSerializer):
         return False
 
     def get_weekly_xp(self, obj):
-        return self.get_weekly_data(obj, 'xp_records', 'xp_value')
+        return self.get_weekly_data(obj, 'total_xp')
 
     def get_weekly_steps(self, obj):
-        return self.get_weekly_data(obj, 'daily_steps', 'step_count')
+        return self.get_weekly_data(obj, 'step_count')
 
     def get_weekly_workouts(self, obj):
         return self.get_detailed_weekly_workouts(obj)
 
     def get_total_xp_all_time(self, obj):
-        # Summing all XP values across all time for the user
-        total_xp = Xp.objects.filter(user=obj).aggregate(total=Sum('xp_value'))['total'] or 0
-        return total_xp
+        return get_total_xp_all_time(obj)
 
-    def get_weekly_data(self, obj, related_field, value_field, use_timestamp=False):
-        """Helper to get weekly data from Monday to Sunday, supports timestamp fields."""
-        user_timezone = obj.timezone
-        current_utc_time = now()
-        user_local_time = current_utc_time.astimezone(user_timezone)
-        current_day = user_local_time.date()
+    def get_weekly_rollup(self, obj):
+        """The user's daily rollup rows for the current week, read once and shared by the weekly charts."""
+        cache = self.__dict__.setdefault('_weekly_rollup', {})
+        if obj.pk not in cache:
+            user_timezone = obj.timezone
+            current_day = now().astimezone(user_timezone).date()
 
-        # Calculate the start and end of the week based on Monday as the start of the week
-        start_of_week = current_day - timedelta(days=current_day.weekday())
-        end_of_week = start_of_week + timedelta(days=6)
+            # Calculate the start and end of the week based on Monday as the start of the week
+            start_of_week = current_day - timedelta(days=current_day.weekday())
+            end_of_week = start_of_week + timedelta(days=6)
 
-        # Initialize weekly data as a dictionary with days of the week as keys and 0 values
-        weekly_data = {day: 0 for day in ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]}
+            rows = XpDailyTotal.objects.filter(
+                user=obj, date__range=[start_of_week, end_of_week]
+            ).values('date', 'total_xp', 'step_count')
+            cache[obj.pk] = (current_day, list(rows))
+        return cache[obj.pk]
 
-        # Get the user's records for the current week, filter by date range
-        records = getattr(obj, related_field)
+    def get_weekly_data(self, obj, value_field):
+        """Helper to get weekly data from Monday to Sunday out of the daily rollup."""
+        current_day, rows = self.get_weekly_rollup(obj)
 
-        # Filter records by date or timestamp based on the field type
-        if use_timestamp:
-            # For `workout_activity`, filter by `start_datetime` range
-            records = records.filter(start_datetime__date__range=[start_of_week, end_of_week])
-        else:
-            records = records.filter(date__range=[start_of_week, end_of_week])
+        # Initialize weekly data as a dictionary with days of the week as keys and 0 values
+        weekly_data = {day: 0 for day in ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]}
 
-        # Loop over the records and populate weekly data
-        for record in records:
-            record_date = record.start_datetime.date() if use_timestamp else record.date
-            record_day = record_date.weekday()  # Monday=0, Sunday=6
-            weekday_name = list(weekly_data.keys())[record_day]
-            weekly_data[weekday_name] += getattr(record, value_field, 0)
+        # Loop over the rows and populate weekly data
+        for row in rows:
+            weekday_name = list(weekly_data.keys())[row['date'].weekday()]  # Monday=0, Sunday=6
+            weekly_data[weekday_name] += row[value_field]
 
         # Set future days of the week to 0
         for day_offset in range(current_day.weekday() + 1, 7):
@@ -414,6 +408,29 @@ class FeedSerializer(serializers.ModelSerializer):
 
 
 
+class LeagueResultSerializer(serializers.ModelSerializer):
+    """A user's settled league result, in the shape of the league status endpoints."""
+    league_id = serializers.IntegerField(source='league_instance_id')
+    league_name = serializers.CharField(source='league.name')
+    league_level = serializers.SerializerMethodField()
+    league_end = serializers.SerializerMethodField()
+    league_type = serializers.SerializerMethodField()
+
+    class Meta:
+        model = LeagueResult
+        fields = ['league_id', 'league_name', 'league_level', 'league_type', 'league_end', 'status', 'rank',
+                  'participants', 'gems_obtained', 'xp']
+
+    def get_league_level(self, obj):
+        return 11 - obj.league.order
+
+    def get_league_end(self, obj):
+        return obj.league_end.isoformat(timespec='milliseconds') + 'Z'
+
+    def get_league_type(self, obj):
+        return 'company' if obj.company_id else 'global'
+
+
 # Serializer for Clap model
 class ClapSerializer(serializers.ModelSerializer):
     user = UserProfileSerializer(read_only=True)
@@ -581,56 +598,66 @@ class DailyStepsSerializer(serializers.ModelSerializer):
         return value
 
     def create(self, validated_data):
-        request = self.context['request']
-        user = request.user
+        user = self.context['request'].user
+        try:
+            return self.apply_steps(user, validated_data)
+        except Exception as e:
+            logger.error(f"Error creating/updating DailySteps for user {user.id}: {str(e)}")
+            raise serializers.ValidationError(f"An error occurred while processing the request: {str(e)}")
+
+    def apply_steps(self, user, validated_data):
+        """
+        Apply a daily step total for the user: update DailySteps, record the XP
+        difference and update leagues and milestones. Shared by the direct
+        endpoint and the buffered step flush.
+
+        Raises ValidationError when the count is not higher than the stored one;
+        any other error is raised as is, so the flush can retry it.
+        """
         step_count = validated_data.get('step_count')
         timestamp = validated_data.get('timestamp')
         print(timestamp, 'here is the timestamp passed')
 
         with transaction.atomic():
             local_date = timestamp.date()
-            try:
-                # Attempt to get or create the DailySteps instance
-                daily_steps, created = DailySteps.objects.get_or_create(
-                    user=user,
-                    date=local_date,
-                    defaults={'xp': round(step_count / 10, 1), 'timestamp': timestamp, **validated_data}
-                )
+            # Attempt to get or create the DailySteps instance
+            daily_steps, created = DailySteps.objects.get_or_create(
+                user=user,
+                date=local_date,
+                defaults={'xp': round(step_count / 10, 1), 'timestamp': timestamp, **validated_data}
+            )
 
-                new_xp = 0
-                if created:
-                    # If a new instance was created, the defaults are already saved
-                    new_xp = daily_steps.xp
+            new_xp = 0
+            if created:
+                # If a new instance was created, the defaults are already saved
+                new_xp = daily_steps.xp
+            else:
+                # Update the existing instance if step_count is higher
+                if step_count > daily_steps.step_count:
+                    step_diff = step_count - daily_steps.step_count
+                    new_xp = round(step_diff / 10, 1)
+                    daily_steps.step_count = step_count
+                    daily_steps.xp = round(daily_steps.xp + new_xp, 1)
+                    daily_steps.timestamp = max(daily_steps.timestamp, timestamp)
+                    daily_steps.save()  # Save only after all updates are made
                 else:
-                    # Update the existing instance if step_count is higher
-                    if step_count > daily_steps.step_count:
-                        step_diff = step_count - daily_steps.step_count
-                        new_xp = round(step_diff / 10, 1)
-                        daily_steps.step_count = step_count
-                        daily_steps.xp = round(daily_steps.xp + new_xp, 1)
-                        daily_steps.timestamp = max(daily_steps.timestamp, timestamp)
-                        daily_steps.save()  # Save only after all updates are made
-                    else:
-                        raise serializers.ValidationError(
-                            f"No update was made; step count is less than or equal to the latest entry for this day, {daily_steps.step_count} steps."
-                        )
+                    raise serializers.ValidationError(
+                        f"No update was made; step count is less than or equal to the latest entry for this day, {daily_steps.step_count} steps."
+                    )
 
 
-                self.update_user_xp(user, local_date, new_xp, timestamp)
-                self.update_user_leagues(user, new_xp, xp_date=timestamp)
+            self.update_user_xp(user, local_date, new_xp, timestamp)
+            self.update_user_leagues(user, new_xp, xp_date=timestamp)
 
-                # Calculate total daily step count
-                total_daily_step_count = DailySteps.objects.filter(user=user).aggregate(
-                    total_steps=Sum('step_count')
-                )['total_steps'] or 0
+            # Calculate total daily step count
+            total_daily_step_count = DailySteps.objects.filter(user=user).aggregate(
+                total_steps=Sum('step_count')
+            )['total_steps'] or 0
 
-                # Check for milestones based on total daily steps
-                self.check_dynamic_milestones(user, total_daily_step_count)
+            # Check for milestones based on total daily steps
+            self.check_dynamic_milestones(user, total_daily_step_count)
 
-                return daily_steps
-            except Exception as e:
-                logger.error(f"Error creating/updating DailySteps for user {user.id}: {str(e)}")
-                raise serializers.ValidationError(f"An error occurred while processing the request: {str(e)}")
+            return daily_steps
 
 
     def update_user_leagues(self, user, new_xp, xp_date):
@@ -648,6 +675,9 @@ class DailyStepsSerializer(serializers.ModelSerializer):
             xp_date_utc = xp_date_local.astimezone(timezone.utc)
 
             if xp_date_utc >= league_start_date:
+                if is_live_leaderboard():
+                    add_league_xp(user_league, new_xp)
+                    continue
                 if league_instance.company is not None:
                     user_league.xp_company += new_xp
                 else:
@@ -656,29 +686,8 @@ class DailyStepsSerializer(serializers.ModelSerializer):
 
 
     def update_user_xp(self, user, date, new_xp, timestamp):
-        # Get the last XP record for the user on the given date
-        last_xp = Xp.objects.filter(user=user, date=date).order_by('-id').first()
-
-        # Calculate totalXpToday and totalXpAllTime
-        if last_xp and last_xp.date == date:
-            total_xp_today = last_xp.totalXpToday + new_xp  # Add new XP to the total XP for today
-        else:
-            total_xp_today = new_xp  # No previous XP for today, so the new XP is the total
-
-        # Update totalXpAllTime by adding the new XP to the existing total
-        last_all_time_xp = Xp.objects.filter(user=user).aggregate(total=Sum('xp_value'))['total'] or 0.0
-        total_xp_all_time = last_all_time_xp + new_xp  # Add new XP to the total XP over all time
-
-        # Create the new XP record
-        Xp.objects.create(
-            user=user,
-            xp_value=new_xp,
-            totalXpToday=total_xp_today,
-            totalXpAllTime=total_xp_all_time,
-            timeStamp=timestamp,
-            date=date,
-            source='steps'
-        )
+        # Running totals come from the materialized XP totals
+        record_xp(user, date, new_xp, timestamp, source='steps')
 
 
     def check_dynamic_milestones(self, user, total_daily_step_count, milestone_increment=10000):
@@ -713,6 +722,8 @@ class DailyStepsSerializer(serializers.ModelSerializer):
 
 
 class WorkoutActivitySerializer(serializers.ModelSerializer):
+    duplicate_message = "A workout with the same start and end times already exists for this day."
+
     xp = serializers.FloatField(read_only=True)  # Mark xp as read-only
 
     class Meta:
@@ -761,7 +772,7 @@ class WorkoutActivitySerializer(serializers.ModelSerializer):
             start_datetime=start_datetime,
             end_datetime=end_datetime
         ).exists()):
-            raise serializers.ValidationError("A workout with the same start and end times already exists for this day.")
+            raise serializers.ValidationError(self.duplicate_message)
 
         xp_earned = self.calculate_xp(validated_data)
         validated_data['xp'] = xp_earned
@@ -771,30 +782,8 @@ class WorkoutActivitySerializer(serializers.ModelSerializer):
         return workout_activity
 
     def update_user_xp(self, user, date, new_xp, timestamp):
-        # Get the last XP record for the user on the given date
-        last_xp = Xp.objects.filter(user=user, date=date).order_by('-id').first()
-        print(last_xp.xp_value)
-
-        # Calculate totalXpToday and totalXpAllTime
-        if last_xp and last_xp.date == date:
-            total_xp_today = last_xp.totalXpToday + new_xp  # Add new XP to the total XP for today
-        else:
-            total_xp_today = new_xp  # No previous XP for today, so the new XP is the total
-
-        # Update totalXpAllTime by adding the new XP to the existing total
-        last_all_time_xp = Xp.objects.filter(user=user).aggregate(total=Sum('xp_value'))['total'] or 0.0
-        total_xp_all_time = last_all_time_xp + new_xp  # Add new XP to the total XP over all time
-
-        # Create the new XP record
-        Xp.objects.create(
-            user=user,
-            xp_value=new_xp,
-            totalXpToday=total_xp_today,
-            totalXpAllTime=total_xp_all_time,
-            timeStamp=timestamp,
-            date=date,
-            source='workout'
-        )
+        # Running totals come from the materialized XP totals
+        record_xp(user, date, new_xp, timestamp, source='workout')
 
     def calculate_xp(self, data):
         duration = data.get('duration', 0)
@@ -847,6 +836,9 @@ class WorkoutActivitySerializer(serializers.ModelSerializer):
             xp_date_utc = xp_date_local.astimezone(timezone.utc)
 
             if xp_date_utc >= league_start_date:
+                if is_live_leaderboard():
+                    add_league_xp(user_league, new_xp)
+                    continue
                 if league_instance.company is not None:
                     user_league.xp_company += new_xp
                 else:
@@ -854,6 +846,25 @@ class WorkoutActivitySerializer(serializers.ModelSerializer):
                 user_league.save()
 
 
+class HealthSyncSerializer(serializers.Serializer):
+    """
+    Envelope of a batch health sync. Items are validated one by one with
+    DailyStepsSerializer / WorkoutActivitySerializer so each gets its own result.
+    """
+    MAX_ITEMS = 500
+
+    steps = serializers.ListField(child=serializers.DictField(), required=False, default=list)
+    workouts = serializers.ListField(child=serializers.DictField(), required=False, default=list)
+
+    def validate(self, data):
+        total_items = len(data['steps']) + len(data['workouts'])
+        if total_items == 0:
+            raise serializers.ValidationError("Provide at least one step or workout entry.")
+        if total_items > self.MAX_ITEMS:
+            raise serializers.ValidationError(f"A sync can contain at most {self.MAX_ITEMS} entries.")
+        return data
+
+
 class XpSerializer(serializers.ModelSerializer):
     total_xp_today = serializers.SerializerMethodField()
     total_xp_all_time = serializers.SerializerMethodField()
@@ -906,7 +917,6 @@ class DrawImageSerializer(serializers.ModelSerializer):
 
 class DrawSerializer(serializers.ModelSerializer):
     prizes = PrizeSerializer(many=True)  # Add nested PrizeSerializer
-    entry_count = serializers.SerializerMethodField()
     user_entry_count = serializers.SerializerMethodField()  # User-specific entry count
     images = DrawImageSerializer(many=True, read_only=True) # Nested DrawImageSerializer
 
@@ -915,14 +925,16 @@ class DrawSerializer(serializers.ModelSerializer):
         fields = ['id', 'draw_name', 'draw_type', 'draw_date', 'number_of_winners', 'is_active', 'entry_count','video', 'prizes','user_entry_count','images']
         read_only_fields = ['id', 'draw_name', 'draw_type', 'draw_date', 'is_active', 'entry_count', 'user_entry_count']
 
-    def get_entry_count(self, obj):
-        return obj.entries.count()  # Count the related DrawEntry objects
-
     # Number of entries for the authenticated user in this draw
     def get_user_entry_count(self, obj):
         request = self.context.get('request')
         if request and request.user.is_authenticated:
-            return obj.entries.filter(user=request.user).count()  # Count entries for the logged-in user
+            user_entry_counts = self.context.get('user_entry_counts')
+            if user_entry_counts is not None:
+                # Read for every listed draw at once by the list views
+                return user_entry_counts.get(obj.id, 0)
+            # Tickets of the logged-in user
+            return obj.participants.filter(user=request.user).values_list('entry_count', flat=True).first() or 0
         return 0  # Return 0 if the user is not authenticated or has no entries
 
 
@@ -985,11 +997,16 @@ class DrawSerializer(serializers.ModelSerializer):
         print(f"Created New Prize: {prize_data}")
 
 
-class DrawEntrySerializer(serializers.ModelSerializer):
+class DrawTicketBlockSerializer(serializers.ModelSerializer):
     draw = serializers.PrimaryKeyRelatedField(queryset=Draw.objects.all())  # Use PrimaryKeyRelatedField
+    ticket_ids = serializers.SerializerMethodField()
+
     class Meta:
-        model = DrawEntry
-        fields = ['user', 'draw', 'timestamp']
+        model = DrawTicketBlock
+        fields = ['user', 'draw', 'timestamp', 'quantity', 'ticket_ids']
+
+    def get_ticket_ids(self, obj):
+        return list(obj.ticket_ids)
 
 
 class DrawWinnerSerializer(serializers.ModelSerializer):
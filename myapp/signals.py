@@ -1,9 +1,14 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.utils import timezone
-from .models import Xp, Streak, Company, Draw, League, UserLeague, LeagueInstance, Feed, Gem, Notif, DailySteps
+from .models import (Xp, Streak, Company, Draw, League, UserLeague, LeagueInstance, Feed, Gem, Notif, DailySteps,
+                     CustomUser)
+from .xp_pipeline import run_xp_pipeline
+from .ranking_service import invalidate_ranking_snapshots
+from .league_service import refresh_company_league_configs
 from dateutil.relativedelta import relativedelta
 from django.db.models import Count, F
+from django.db.models.functions import Greatest
 from datetime import timedelta, datetime
 from django.db import transaction
 import pytz
@@ -39,136 +44,6 @@ load_dotenv()
 
 
 
-def is_milestone_streak(streak):
-    # Define milestones dynamically
-    if streak < 10:
-        return False
-    elif streak % 10 == 0 and streak < 100:
-        return True
-    elif streak % 100 == 0 and streak < 1000:
-        return True
-    elif streak % 1000 == 0 and streak < 1000000:
-        return True
-    elif streak % 1000000 == 0:
-        return True
-    return False
-
-
-@receiver(post_save, sender=Xp)
-def update_streak_on_xp_change(sender, instance, **kwargs):
-    # print("Signal triggered")
-    user = instance.user
-    total_xp_today = instance.totalXpToday
-    # print(f"Total XP today: {total_xp_today}")
-
-    # Check if total XP for today is >= 250
-    if total_xp_today < 250:
-        # print("Total XP is less than 500, not updating streak")
-        return
-
-    xp_date = instance.date  # Use the date from Xp instance
-
-    with transaction.atomic():
-        # Get the most recent streak record before the given xp_date
-        recent_streak = Streak.objects.filter(user=user, date__lt=xp_date).order_by('-date').first()
-        # print('Recent streak date:', recent_streak.date if recent_streak else None)
-    
-        # Determine the starting streak value and highest streak value
-        if recent_streak:
-            if (xp_date - recent_streak.date).days == 1:
-                current_streak = recent_streak.currentStreak + 1
-                highest_streak = max(recent_streak.highestStreak, current_streak)
-            else:
-                current_streak = 1
-                highest_streak = recent_streak.highestStreak
-        else:
-            current_streak = 1
-            highest_streak = 1
-
-        current_date = xp_date
-
-        # Create or update the streak record for the given xp_date
-        streak_record, created = Streak.objects.get_or_create(
-            user=user,
-            date=xp_date,
-            defaults={
-                'currentStreak': current_streak,
-                'highestStreak': highest_streak,
-                'timeStamp': instance.timeStamp,
-            }
-        )
-
-        if not created:
-            streak_record.currentStreak = current_streak
-            streak_record.highestStreak = highest_streak
-            streak_record.timeStamp = instance.timeStamp
-            streak_record.save()
-            # print(f"Streak record updated for date: {xp_date}")
-        else:
-            print(f"Streak record created for date: {xp_date}")
-
-        # Ensure proper conversion to user's local timezone
-        user_timezone = pytz.timezone(user.timezone.key)
-        print('user timezone',user_timezone)
-        local_now = datetime.now(user_timezone)
-        print('user local time now',local_now)
-
-        current_date = xp_date + timedelta(days=1)  # Start checking from the next day
-
-        while current_date <= local_now.date():
-            # Check if a streak record exists for this date
-            streak_record = Streak.objects.filter(user=user, date=current_date).first()
-
-
-            if streak_record:
-                # Update existing record for current_date
-                # Increment the streak for each existing record
-                current_streak += 1
-                streak_record.currentStreak = current_streak
-                streak_record.highestStreak = max(streak_record.highestStreak, current_streak)
-                streak_record.save()
-            else:
-                # Break the streak if no XP was gained for the day
-                break
-
-            current_date += timedelta(days=1)
-
-        # Correct the current streak before updating the CustomUser model
-        user.streak = current_streak
-        user.save()
-
-        # Dynamic milestone check
-        if is_milestone_streak(current_streak):
-            # Check the most recent milestone feed for this user
-            last_milestone_feed = Feed.objects.filter(
-                user=user,
-                feed_type=Feed.STREAK
-            ).order_by('-created_at').first()
-
-            # Extract the last recorded milestone streak from the feed content
-            last_milestone = 0
-            if last_milestone_feed:
-                # print('last milestone')
-                try:
-                    # Use regex to extract the milestone number
-                    match = re.search(r'has reached a (\d+)-day streak', last_milestone_feed.content)
-                    if match:
-                        last_milestone = int(match.group(1))  # Extract the number from the match
-                except ValueError:
-                    last_milestone = 0
-
-            # Only create a feed if the current streak exceeds the last recorded milestone
-            if current_streak > last_milestone:
-                Feed.objects.create(
-                    user=user,
-                    feed_type=Feed.STREAK,
-                    content=f"{user.username} has reached a {current_streak}-day streak!",
-                )
-                print(f"Feed created for {current_streak}-day streak milestone.")
-
-        print(f"Updated user streak to: {user.streak}")
-
-
 @receiver(post_save, sender=Company)
 def create_company_draw(sender, instance, created, **kwargs):
     if created:
@@ -192,125 +67,10 @@ def create_company_draw(sender, instance, created, **kwargs):
 
 
 @receiver(post_save, sender=Xp)
-def update_gem_for_xp(sender, instance, **kwargs):
-    user = instance.user
-    xp_today = instance.totalXpToday
-
-    # Retrieve the user's timezone
-    user_timezone = user.timezone
-    now_utc = timezone.now()
-    user_local_time = now_utc.astimezone(user_timezone)
-
-    # Calculate the Monday of the current week
-    today = user_local_time.date()
-    current_week_monday = today - timedelta(days=today.weekday())
-
-    # Check if the XP was gained within the current week
-    xp_date = instance.date  # Assuming `date` field exists in Xp model
-    xp_timestamp = instance.timeStamp
-
-    # Convert the local xp_date to UTC before querying the database
-    xp_utc_time = xp_timestamp.astimezone(pytz.utc)
-
-    if xp_date < current_week_monday:
-
-        return  # Do not award gems if the XP was gained before the current week
-
-    # Calculate gems awarded based on XP (1 gem per 250 XP)
-    xp_gem = int(xp_today // 250)
-
-    # Fetch today's gem record for the user
-    gem, created = Gem.objects.get_or_create(user=user, date=xp_date)
-
-    # Calculate the total XP-based gems for today
-    total_xp_gem_today = xp_gem
-
-    # Ensure the total does not exceed 5
-    if total_xp_gem_today > 5:
-        # print('gem is greated than 5')
-        total_xp_gem_today = 5
-
-    # Update the gem record
-    gem.xp_gem = total_xp_gem_today
-    gem.copy_xp_gem = total_xp_gem_today
-    gem.save()
-
-    # Check if there's already a "received_gem" notification for the user on this day
-    existing_notification = Notif.objects.filter(
-        user=user,
-        notif_type="received_gem",
-        created_at__date=xp_utc_time
-    ).first()
-
-    if existing_notification:
-        # Update the existing "received_gem" notification content
-        existing_notification.content = f"You earned {xp_today} XP and therefore, claimed {total_xp_gem_today} gems."
-        existing_notification.created_at = timezone.now()  # Update the timestamp to the current time
-        existing_notification.save()
-    else:
-        if total_xp_gem_today > 0:
-            # Create a new "received_gem" notification if one doesn't exist for the day
-            Notif.objects.create(
-                user=user,
-                notif_type="received_gem",
-                content=f"You earned {xp_today} XP and therefore, claimed {total_xp_gem_today} gems.",
-            )
-
-
-
-@receiver(post_save, sender=Xp)
-def add_to_first_league(sender, instance, **kwargs):
-    """
-    This signal assigns users with total XP >= 65 to the Pathfinder League (level one league).
-    If no Pathfinder LeagueInstance has available space, a new instance is created.
-    """
-    # print('Add to league triggered')
-    user = instance.user
-    # total_xp = instance.totalXpAllTime
-    # print(f"Total xp for the user is {total_xp}")
-    
-    # Check if user's total XP qualifies them for the Pathfinder league
-    # if total_xp >= 1:
-    pathfinder_league = League.objects.filter(name="Pathfinder league", order=1).first()
-
-    if not pathfinder_league:
-        print("Error: Pathfinder league not found.")
-        return
-
-    # Check if the user is already in the Pathfinder league
-    user_league_entry = UserLeague.objects.filter(user=user, league_instance__league=pathfinder_league).first()
-    if user_league_entry:
-        return  # User is already assigned to the Pathfinder league
-    
-    # Find or create a new LeagueInstance for Pathfinder League with less than max participants
-    pathfinder_instance = (
-        LeagueInstance.objects
-        .filter(league=pathfinder_league, company=None, is_active=True, league_end__gt=timezone.now())
-        .annotate(participant_count=Count('userleague'))
-        .filter(participant_count__lt=F('max_participants'))
-        .first()
-    )
-
-    if not pathfinder_instance:
-        # Calculate the next midnight UK time
-        uk_tz = pytz.timezone('Europe/London')
-        now_uk = timezone.now().astimezone(uk_tz)
-        midnight_uk = (now_uk + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-        
-        # Convert UK midnight to UTC for storage
-        midnight_utc = midnight_uk.astimezone(pytz.utc)
-
-        # Create a new Pathfinder LeagueInstance if no open instance exists
-        pathfinder_instance = LeagueInstance.objects.create(
-            league=pathfinder_league,
-            league_start=timezone.now(),
-            league_end=midnight_utc,  # : set league end for uk midnight
-            max_participants=10
-        )
-
-    # Add user to the Pathfinder LeagueInstance
-    UserLeague.objects.create(user=user, league_instance=pathfinder_instance, xp_global=0)
-    # print(f"User {user} added to {pathfinder_instance.league.name}.")
+def run_xp_pipeline_on_insert(sender, instance, created, **kwargs):
+    """Every new Xp record goes through the single XP-applied pipeline (see xp_pipeline.py)."""
+    if created:
+        run_xp_pipeline(instance)
 
 
 # Constants for minimum users and XP thresholds
@@ -328,63 +88,36 @@ XP_THRESHOLD = {
     }  # Example XP thresholds for leagues
 
 
-@receiver(post_save, sender=Xp)
-def add_to_first_company_league(sender, instance, **kwargs):
-    """
-    Adds a user to the first available Pathfinder league instance for their company upon joining.
-    If no instance has room, a new Pathfinder instance is created.
-    """
-    # print('Add to Company league triggered')
-    user = instance.user
-    # total_xp = instance.totalXpAllTime
-    company = user.company
-    
-    # Check if user's total XP qualifies them for the Pathfinder league
-    # if total_xp >= 1:
-    pathfinder_league = League.objects.filter(name="Pathfinder league", order=1).first()
-
-    if not pathfinder_league:
-        # print("Error: Pathfinder league not found.")
-        return
-
-    # Check if the user is already assigned to a Pathfinder league for this company
-    user_league_entry = UserLeague.objects.filter(
-        user=user,
-        league_instance__league=pathfinder_league,
-        league_instance__company=company
-    ).first()
-    # print('in company league, user league entry', user_league_entry)
+@receiver(post_save, sender=UserLeague)
+def count_league_participant(sender, instance, created, **kwargs):
+    """Memberships created one by one (admin, tests) keep the instance's participant_count current."""
+    if created:
+        LeagueInstance.objects.filter(pk=instance.league_instance_id).update(
+            participant_count=F('participant_count') + 1
+        )
+    # A new member or an XP change reorders the instance's rankings
+    invalidate_ranking_snapshots([instance.league_instance_id])
 
-    if user_league_entry:
-        return  # User is already in the Pathfinder league for this company
 
-    # Find an active Pathfinder instance with room or create a new one
-    pathfinder_instance = (
-        LeagueInstance.objects
-        .filter(league=pathfinder_league, company=company, is_active=True, league_end__gt=timezone.now())
-        .annotate(participant_count=Count('userleague'))
-        .filter(participant_count__lt=F('max_participants'))
-        .first()
+@receiver(post_delete, sender=UserLeague)
+def uncount_league_participant(sender, instance, **kwargs):
+    LeagueInstance.objects.filter(pk=instance.league_instance_id).update(
+        participant_count=Greatest(F('participant_count') - 1, 0)
     )
+    invalidate_ranking_snapshots([instance.league_instance_id])
 
-    if not pathfinder_instance:
-        # Calculate the next midnight UK time
-        uk_tz = pytz.timezone('Europe/London')
-        now_uk = timezone.now().astimezone(uk_tz)
-        midnight_uk = (now_uk + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-        
-        # Convert UK midnight to UTC for storage
-        midnight_utc = midnight_uk.astimezone(pytz.utc)
 
-        # Create a new Pathfinder instance if all are full or none exist
-        pathfinder_instance = LeagueInstance.objects.create(
-            league=pathfinder_league,
-            company=company,
-            league_start=timezone.now(),
-            league_end=midnight_utc,
-            max_participants=10
-        )
+@receiver(post_save, sender=CustomUser)
+def track_company_members(sender, instance, created, **kwargs):
+    """Joining or leaving a company changes its member count and league ceiling."""
+    previous = None if created else instance.loaded_value('company_id', instance.company_id)
+    if previous != instance.company_id:
+        refresh_company_league_configs([previous, instance.company_id])
+
 
-    # Add the user to the Pathfinder league instance
-    UserLeague.objects.create(user=user, league_instance=pathfinder_instance, xp_company=0)
-    print(f"User {user} added to the {pathfinder_instance.league.name} instance for {company.name}.")
\ No newline at end of file
+@receiver(post_delete, sender=CustomUser)
+def untrack_company_member(sender, instance, **kwargs):
+    company_id = instance.company_id
+    if company_id is not None:
+        # After commit: when the whole company is being deleted there is nothing left to count
+        transaction.on_commit(lambda: refresh_company_league_configs([company_id]))
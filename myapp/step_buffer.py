@@ -0,0 +1,274 @@
+"""
+Write-behind buffer for daily step updates.
+
+Clients post cumulative step counts for the same day many times per hour. With
+STEP_INGEST_MODE = 'buffered' those updates are parked here, keyed by user and
+day, keeping only the highest count. flush_step_buffer() periodically applies the
+surviving value of each key through the regular DailySteps/XP logic, so N posts
+inside one window cost a single DailySteps write, Xp row and signal cascade.
+Drained entries are only dropped once applied, so a flush that dies or hits a
+transient error leaves them to the next flush.
+"""
+import json
+import logging
+import threading
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+from rest_framework import serializers
+
+from .models import CustomUser
+
+logger = logging.getLogger(__name__)
+
+PENDING_KEY = 'step_buffer:pending'
+STATS_KEY = 'step_buffer:stats'
+
+# Keep the highest step count per field and count every update received
+_ADD_SCRIPT = """
+redis.call('HINCRBY', KEYS[2], 'received', 1)
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if current and tonumber(cjson.decode(current)['step_count']) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+return 1
+"""
+
+PROCESSING_KEY = 'step_buffer:processing'
+FLUSH_LOCK_KEY = 'step_buffer:flush_lock'
+# A flush that has not released the buffer by then is assumed to have died
+FLUSH_LEASE_SECONDS = 600
+
+# Take the flush lease, move the pending entries into the processing hash (keeping the
+# higher count when an unapplied entry of the same user and day is still there) and reset
+# the received counter. Entries stay in the processing hash until they are applied, so a
+# flush that dies leaves them to the next one. Returns nil while another flush holds the lease.
+_DRAIN_SCRIPT = """
+if not redis.call('SET', KEYS[4], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    return nil
+end
+local received = redis.call('HGET', KEYS[2], 'received') or '0'
+redis.call('HSET', KEYS[2], 'received', 0)
+local pending = redis.call('HGETALL', KEYS[1])
+for i = 1, #pending, 2 do
+    local current = redis.call('HGET', KEYS[3], pending[i])
+    if not current or tonumber(cjson.decode(current)['step_count']) < tonumber(cjson.decode(pending[i + 1])['step_count']) then
+        redis.call('HSET', KEYS[3], pending[i], pending[i + 1])
+    end
+end
+redis.call('DEL', KEYS[1])
+return {received, #pending / 2, redis.call('HGETALL', KEYS[3])}
+"""
+
+# Drop an applied entry, unless it was replaced in the meantime
+_ACK_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+# Give the lease back if it is still ours
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def _field(user_id, date):
+    return f'{user_id}:{date.isoformat()}'
+
+
+def _parse_entry(field, payload):
+    user_id = field.split(':', 1)[0]
+    data = json.loads(payload)
+    return {
+        'field': field,
+        'payload': payload,
+        'user_id': int(user_id),
+        'step_count': data['step_count'],
+        'timestamp': datetime.fromisoformat(data['timestamp']),
+    }
+
+
+class RedisStepBuffer:
+    """Buffer shared by every web process and worker through Redis."""
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self._add = self.client.register_script(_ADD_SCRIPT)
+        self._drain = self.client.register_script(_DRAIN_SCRIPT)
+        self._ack = self.client.register_script(_ACK_SCRIPT)
+        self._release = self.client.register_script(_RELEASE_SCRIPT)
+
+    def add(self, user_id, date, step_count, timestamp):
+        payload = json.dumps({'step_count': step_count, 'timestamp': timestamp.isoformat()})
+        self._add(keys=[PENDING_KEY, STATS_KEY], args=[_field(user_id, date), step_count, payload])
+
+    def drain(self, token):
+        """
+        Take the flush lease and return the received count, how many distinct entries
+        it collapsed into and every unapplied entry, or None while another flush holds
+        the lease.
+        """
+        result = self._drain(keys=[PENDING_KEY, STATS_KEY, PROCESSING_KEY, FLUSH_LOCK_KEY],
+                             args=[token, FLUSH_LEASE_SECONDS])
+        if result is None:
+            return None
+        received, drained, flat = result
+        entries = [_parse_entry(field.decode(), payload) for field, payload in zip(flat[::2], flat[1::2])]
+        return int(received), drained, entries
+
+    def ack(self, entry):
+        self._ack(keys=[PROCESSING_KEY], args=[entry['field'], entry['payload']])
+
+    def release(self, token):
+        self._release(keys=[FLUSH_LOCK_KEY], args=[token])
+
+    def record_flush(self, applied, collapsed):
+        pipe = self.client.pipeline()
+        pipe.hincrby(STATS_KEY, 'applied_total', applied)
+        pipe.hincrby(STATS_KEY, 'collapsed_total', collapsed)
+        pipe.execute()
+
+    def stats(self):
+        raw = self.client.hgetall(STATS_KEY)
+        return {key.decode(): int(value) for key, value in raw.items()}
+
+
+class LocalStepBuffer:
+    """
+    In-process stand-in for RedisStepBuffer. Only coalesces updates seen by the
+    same process, so it suits development, tests and single-process deployments.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._processing = {}
+        self._stats = {'received': 0, 'applied_total': 0, 'collapsed_total': 0}
+
+    def add(self, user_id, date, step_count, timestamp):
+        with self._lock:
+            self._stats['received'] += 1
+            field = _field(user_id, date)
+            current = self._pending.get(field)
+            if current is None or step_count > current['step_count']:
+                self._pending[field] = {
+                    'field': field, 'user_id': user_id, 'step_count': step_count, 'timestamp': timestamp,
+                }
+
+    def drain(self, token):
+        with self._lock:
+            received = self._stats['received']
+            self._stats['received'] = 0
+            drained = len(self._pending)
+            for field, entry in self._pending.items():
+                current = self._processing.get(field)
+                if current is None or entry['step_count'] > current['step_count']:
+                    self._processing[field] = entry
+            self._pending = {}
+            return received, drained, list(self._processing.values())
+
+    def ack(self, entry):
+        with self._lock:
+            if self._processing.get(entry['field']) is entry:
+                del self._processing[entry['field']]
+
+    def release(self, token):
+        pass
+
+    def record_flush(self, applied, collapsed):
+        with self._lock:
+            self._stats['applied_total'] += applied
+            self._stats['collapsed_total'] += collapsed
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+_buffer = None
+
+
+def get_step_buffer():
+    """Return the configured buffer backend (STEP_BUFFER_BACKEND: 'redis' or 'local')."""
+    global _buffer
+    if _buffer is None:
+        if settings.STEP_BUFFER_BACKEND == 'redis':
+            _buffer = RedisStepBuffer(settings.STEP_BUFFER_REDIS_URL)
+        else:
+            _buffer = LocalStepBuffer()
+    return _buffer
+
+
+def is_buffered_ingest():
+    return settings.STEP_INGEST_MODE == 'buffered'
+
+
+def buffer_step_update(user, validated_data):
+    """Park a validated daily step update until the next flush."""
+    timestamp = validated_data['timestamp']
+    get_step_buffer().add(user.id, timestamp.date(), validated_data['step_count'], timestamp)
+
+
+def flush_step_buffer():
+    """
+    Apply the latest buffered step count of every user/day through the regular
+    DailySteps logic.
+
+    Returns:
+        dict: ``received`` updates since the last flush, ``applied`` and ``skipped``
+        entries, ``requeued`` entries that failed and stay buffered for the next
+        flush, and ``collapsed`` updates that never had to be written.
+    """
+    from .serializers import DailyStepsSerializer
+
+    buffer = get_step_buffer()
+    token = uuid.uuid4().hex
+    result = buffer.drain(token)
+    if result is None:
+        logger.info("Step buffer flush skipped: another flush is running")
+        return {'received': 0, 'applied': 0, 'skipped': 0, 'requeued': 0, 'collapsed': 0}
+    received, drained, entries = result
+
+    try:
+        users = CustomUser.objects.in_bulk({entry['user_id'] for entry in entries})
+        serializer = DailyStepsSerializer()
+        applied = skipped = requeued = 0
+        for entry in sorted(entries, key=lambda e: e['timestamp']):
+            user = users.get(entry['user_id'])
+            if user is None:
+                skipped += 1
+                buffer.ack(entry)
+                continue
+            try:
+                serializer.apply_steps(user, {'step_count': entry['step_count'], 'timestamp': entry['timestamp']})
+                applied += 1
+            except serializers.ValidationError as e:
+                # Typically a count that is not higher than what is already stored
+                logger.info(f"Buffered steps for user {user.id} not applied: {e.detail}")
+                skipped += 1
+            except Exception:
+                # Left in the buffer for the next flush to retry
+                logger.exception(f"Buffered steps for user {user.id} failed to apply")
+                requeued += 1
+                continue
+            # apply_steps has committed by now
+            buffer.ack(entry)
+    finally:
+        buffer.release(token)
+
+    collapsed = max(received - drained, 0)
+    buffer.record_flush(applied, collapsed)
+
+    result = {'received': received, 'applied': applied, 'skipped': skipped, 'requeued': requeued,
+              'collapsed': collapsed}
+    if received or requeued:
+        logger.info(f"Step buffer flush: {result}")
+    return result
@@ -0,0 +1,247 @@
+"""
+Set-based streak recomputation.
+
+A day counts towards the streak when it has a Streak row. When XP lands on a
+day (possibly a late backfill), that day's row and every consecutive row after
+it have to be renumbered. recompute_streak() loads the affected range in one
+query, renumbers it in memory with compute_streak_run() and writes the changes
+with a single bulk_update, then sends post_save for every renumbered row.
+
+reset_missed_streaks() is the set-based daily job that spends streak savers or
+resets streaks once a user's local day has ended without a streak day.
+"""
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from functools import partial
+
+from django.db import transaction
+from django.db.models import Max
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+from .activity_bitmap import mark_active_days
+from .models import CustomUser, Streak, XpDailyTotal
+
+logger = logging.getLogger(__name__)
+
+STREAK_XP_THRESHOLD = 250  # XP needed in a day to keep the streak
+
+
+def compute_streak_run(start_date, stored_highest, previous=None):
+    """
+    Renumber the run of consecutive active days starting at ``start_date``.
+
+    Args:
+        start_date (date): The day that just became active.
+        stored_highest (dict): date -> stored highestStreak for the active days after
+            ``start_date`` (``start_date`` itself may be included).
+        previous (tuple, optional): (date, currentStreak, highestStreak) of the latest
+            streak before ``start_date``.
+
+    Returns:
+        list: (date, currentStreak, highestStreak) for ``start_date`` and every following
+        day up to the first gap.
+    """
+    if previous is None:
+        current = highest = 1
+    elif (start_date - previous[0]).days == 1:
+        current = previous[1] + 1
+        highest = max(previous[2], current)
+    else:
+        current = 1
+        highest = max(previous[2], current)
+
+    run = [(start_date, current, highest)]
+    day = start_date + timedelta(days=1)
+    while day in stored_highest:
+        current += 1
+        highest = max(highest, stored_highest[day], current)
+        run.append((day, current, highest))
+        day += timedelta(days=1)
+    return run
+
+
+def recompute_streak(user, date, timestamp, today, previous_streak=None):
+    """
+    Mark ``date`` as an active streak day for ``user`` and renumber the days after it.
+
+    Args:
+        user (CustomUser): The user.
+        date (date): The day that reached the streak threshold.
+        timestamp (datetime): Timestamp stored on the day's streak row.
+        today (date): The user's current local date; later rows are ignored.
+        previous_streak (Streak, optional): The latest streak row before ``date`` if the
+            caller already loaded it; queried otherwise.
+
+    Returns:
+        int: The current streak at the end of the recomputed run.
+    """
+    if previous_streak is None:
+        previous_streak = Streak.objects.filter(user=user, date__lt=date).order_by('-date').first()
+    previous = None
+    if previous_streak:
+        previous = (previous_streak.date, previous_streak.currentStreak, previous_streak.highestStreak)
+
+    with transaction.atomic():
+        rows = {
+            streak.date: streak
+            for streak in Streak.objects.select_for_update().filter(user=user, date__range=[date, max(date, today)])
+        }
+        for streak in rows.values():
+            # The post_save receivers read the user of every renumbered row
+            streak.user = user
+        stored_highest = {day: streak.highestStreak for day, streak in rows.items()}
+        run = compute_streak_run(date, stored_highest, previous)
+
+        # The XP day itself is saved normally so its post_save receivers fire as before
+        _, current, highest = run[0]
+        streak_record = rows.get(date)
+        if streak_record is None:
+            streak_record = Streak(user=user, date=date)
+        streak_record.currentStreak = current
+        streak_record.highestStreak = highest
+        streak_record.timeStamp = timestamp
+        streak_record.save()
+
+        changed = []
+        for day, current, highest in run[1:]:
+            streak = rows[day]
+            if (streak.currentStreak, streak.highestStreak) != (current, highest):
+                streak.currentStreak = current
+                streak.highestStreak = highest
+                changed.append(streak)
+        if changed:
+            Streak.objects.bulk_update(changed, ['currentStreak', 'highestStreak'])
+            # Oldest first, so the coalesced websocket update ends on the latest day
+            _send_streak_saved(changed, False)
+            logger.info(f"Renumbered {len(changed)} streak days after {date} for user {user.id}")
+
+    return run[-1][1]
+
+
+def _send_streak_saved(streaks, created):
+    """
+    Send post_save for streak rows written in bulk, so the receivers that send the
+    streak websocket update and the milestone notification see them as they would
+    a save().
+    """
+    for streak in streaks:
+        post_save.send(sender=Streak, instance=streak, created=created, update_fields=None, raw=False,
+                       using=streak._state.db)
+
+
+def _timezones_at_midnight(timezones, now):
+    """Return the timezones whose local time is currently in the midnight hour, with their local time."""
+    return {tz: now.astimezone(tz) for tz in timezones if now.astimezone(tz).hour == 0}
+
+
+def _plan_resets(users, yesterday, now_local):
+    """Decide, with a few set-based queries, which of ``users`` keep their streak with a saver or lose it."""
+    user_ids = [user.id for user in users]
+    day_before = yesterday - timedelta(days=1)
+
+    kept = set(
+        Streak.objects.filter(user_id__in=user_ids, date=yesterday).values_list('user_id', flat=True)
+    )
+    xp_yesterday = dict(
+        XpDailyTotal.objects.filter(user_id__in=user_ids, date=yesterday).values_list('user_id', 'total_xp')
+    )
+    previous_current = dict(
+        Streak.objects.filter(user_id__in=user_ids, date=day_before).values_list('user_id', 'currentStreak')
+    )
+    highest = dict(
+        Streak.objects.filter(user_id__in=user_ids)
+        .values('user_id').annotate(max_streak=Max('highestStreak'))
+        .values_list('user_id', 'max_streak')
+    )
+    yesterday_end = (now_local - timedelta(days=1)).replace(hour=23, minute=59, second=59, microsecond=999999)
+
+    saved, reset = [], []
+    for user in users:
+        # A streak row for yesterday means the XP was sufficient or a saver was already used
+        if user.id in kept or xp_yesterday.get(user.id, 0) >= STREAK_XP_THRESHOLD:
+            continue
+        if user.streak_savers > 0:
+            current_streak = previous_current.get(user.id, 0) + 1
+            saved.append((user, Streak(
+                user=user,
+                date=yesterday,
+                timeStamp=yesterday_end,
+                currentStreak=current_streak,
+                highestStreak=max(highest.get(user.id, 0) + 1, current_streak),
+            )))
+        else:
+            reset.append(user)
+    return saved, reset
+
+
+def reset_missed_streaks(now=None, dry_run=False, batch_size=2000):
+    """
+    Use a streak saver for, or reset the streak of, every user whose local day just
+    ended without a streak day.
+
+    Users in the midnight hour of their timezone are selected with one query per
+    batch; missing days, yesterday's XP and saver availability are loaded per batch,
+    and savers and resets are written with bulk operations. Users who spent a saver
+    get their streak update after commit.
+
+    Args:
+        now (datetime, optional): The current time. Defaults to timezone.now().
+        dry_run (bool): Report what would change without writing anything.
+        batch_size (int): Number of users planned and written per transaction.
+
+    Returns:
+        dict: ``checked`` users, and the ``saved`` and ``reset`` user ids.
+    """
+    now = now or timezone.now()
+    candidates = CustomUser.objects.exclude(timezone=None).filter(streak__gt=0)
+    timezones = set(candidates.order_by().values_list('timezone', flat=True).distinct())
+    at_midnight = _timezones_at_midnight(timezones, now)
+
+    report = {'checked': 0, 'saved': [], 'reset': []}
+    if not at_midnight:
+        return report
+
+    last_id = 0
+    while True:
+        users = list(
+            candidates.filter(timezone__in=list(at_midnight), id__gt=last_id)
+            .order_by('id')
+            .only('id', 'email', 'timezone', 'streak', 'streak_savers')[:batch_size]
+        )
+        if not users:
+            break
+        last_id = users[-1].id
+        report['checked'] += len(users)
+
+        # Timezones at midnight can still be on different calendar days
+        by_yesterday = defaultdict(list)
+        for user in users:
+            by_yesterday[at_midnight[user.timezone].date() - timedelta(days=1)].append(user)
+
+        with transaction.atomic():
+            for yesterday, day_users in by_yesterday.items():
+                saved, reset = _plan_resets(day_users, yesterday, at_midnight[day_users[0].timezone])
+                report['saved'].extend(user.id for user, _ in saved)
+                report['reset'].extend(user.id for user in reset)
+                if dry_run:
+                    continue
+
+                for user, streak in saved:
+                    user.streak_savers -= 1
+                    user.streak = streak.currentStreak
+                for user in reset:
+                    user.streak = 0
+                streaks = Streak.objects.bulk_create([streak for _, streak in saved])
+                transaction.on_commit(partial(_send_streak_saved, streaks, True))
+                mark_active_days((user.id, yesterday) for user, _ in saved)
+                CustomUser.objects.bulk_update(
+                    [user for user, _ in saved] + reset, ['streak', 'streak_savers'], batch_size=1000
+                )
+
+    logger.info(
+        f"Streak reset{' (dry run)' if dry_run else ''}: checked {report['checked']} users, "
+        f"used {len(report['saved'])} streak savers, reset {len(report['reset'])} streaks"
+    )
+    return report
@@ -1,16 +1,21 @@
-from celery import shared_task
+from celery import group, shared_task
 from .email_utils import send_invitation_email, send_successful_login_email
 from django.utils import timezone
-from .models import Streak, CustomUser, Xp, Draw, Company,LeagueInstance, UserLeague, Gem, Notif
+from .models import Streak, CustomUser, Xp, Draw, Company,LeagueInstance, UserLeague, Gem, Notif, LeagueResult
 import logging
+from collections import defaultdict
 from datetime import timedelta, datetime
 from django.utils import timezone as django_timezone
-from .league_service import promote_user, demote_user, retain_user, promote_company_user, demote_company_user, retain_company_user
+from .league_service import settle_league_instances, settlement_shares
+from .ranking_service import get_ranking_snapshot
 from dateutil.relativedelta import relativedelta  # For precise next-month calculation
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from django.db.models import Max, F
 from .s3_utils import save_file_to_s3
+from .idempotency import purge_ingestion_receipts
+from .streak_service import reset_missed_streaks
+from .gem_service import reset_weekly_gems
 import os
 from celery import signals
 
@@ -68,87 +73,12 @@ def upload_file_task(file_path, folder_name, file_type, user_id=None, draw_id=No
 
 @shared_task
 def reset_daily_streaks():
-    # Batch size for processing users
-    batch_size = 100  # Adjust based on your needs
-    offset = 0
-
-    while True:
-        # Fetch users who have a timezone set and whose current streak is greater than 0
-        users = CustomUser.objects.exclude(timezone=None).filter(streak__gt=0)[offset:offset + batch_size]
-        
-        if not users:  # Exit if no more users are left
-            logger.info("Processed all users successfully.")
-            break
-
-        for user in users:
-            # Get the current time in the user's timezone
-            current_utc_time = timezone.now()
-            user_local_time = current_utc_time.astimezone(user.timezone)
-            print(f'{user} local time', user_local_time)
-            print(f'{user} local hour', user_local_time.hour)
-
-            # Check if the current time is midnight in the user's local time
-            if user_local_time.hour == 0 and user_local_time.minute < 60:
-                # Define yesterday's start and end times in the user's local timezone
-                yesterday_start_local = (user_local_time.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)).replace(tzinfo=None)
-                yesterday_end_local = (user_local_time.replace(hour=23, minute=59, second=59, microsecond=999999) - timedelta(days=1)).replace(tzinfo=None)
-                day_before_yesterday_start_local = (yesterday_start_local - timedelta(days=1)).replace(tzinfo=None)
-
-                # Retrieve the previous day's XP record
-                previous_xp = Xp.objects.filter(user=user, timeStamp__range=(yesterday_start_local, yesterday_end_local)).last()
-                if previous_xp:
-                    # If there is already a record for yesterday, it means the streak saver was used or XP was sufficient
-                    logger.info(f"Xp record for {user.email} already exists for {yesterday_start_local.date()}.")
-
-                # Check if there's already a streak record for yesterday
-                existing_streak = Streak.objects.filter(user=user, date=yesterday_start_local.date()).exists()
-                if existing_streak:
-                    # If there is already a record for yesterday, it means the streak saver was used or XP was sufficient
-                    logger.info(f"Streak record for {user.email} already exists for {yesterday_start_local.date()}. Skipping.")
-                    continue
-
-                # Retrieve the day before yesterday's streak record
-                previous_streak = Streak.objects.filter(user=user, date=day_before_yesterday_start_local.date()).last()
-                if previous_streak:
-                    # If there is already a streak record for the day before yesterday, it means the streak saver
-                    # was used or XP was sufficient
-                    logger.info(f"Streak record for {user.email} already exists for day before yesterday {day_before_yesterday_start_local.date()}")
-
-                # Get the total XP for yesterday, defaulting to 0 if no entry exists
-                daily_xp = previous_xp.calculate_total_xp_today() if previous_xp else 0
-
-                # Calculate the highest streak value up to today
-                highest_streak = Streak.objects.filter(user=user).aggregate(max_streak=Max('highestStreak'))['max_streak'] or 0
-
-                # Only reset the streak if yesterday's XP is less than 250
-                if daily_xp < 250:
-                    if user.streak_savers > 0:
-                        # Use a streak saver
-                        user.streak_savers -= 1
-                        # Create the streak record for yesterday
-                        current_streak = (previous_streak.currentStreak if previous_streak else 0) + 1
-                        
-                        
-                        Streak.objects.create(
-                            user=user,
-                            date=yesterday_start_local.date(),
-                            timeStamp=yesterday_end_local,
-                            currentStreak=current_streak,
-                            highestStreak=max(highest_streak + 1, current_streak)
-                        )
-                        
-                        logger.info(f"Used a streak saver for user {user.email}. Remaining streak savers: {user.streak_savers}")
-                        user.streak = current_streak
-                    else:
-                        # Reset the streak to 0
-                        user.streak = 0
-                        logger.info(f"Reset streak for user {user.email} to 0.")
-                    
-                    user.save(update_fields=['streak', 'streak_savers'])
-
-        offset += batch_size  # Move to the next batch
-
-    logger.info("Streaks reset task completed successfully.")
+    # Spend streak savers or reset streaks for users whose local day just ended
+    report = reset_missed_streaks()
+    logger.info(
+        f"Streaks reset task completed: checked {report['checked']} users, "
+        f"used {len(report['saved'])} streak savers, reset {len(report['reset'])} streaks."
+    )
 
 
 
@@ -279,346 +209,71 @@ def create_global_draw():
 
 
 @shared_task
-def reset_gems_for_local_timezones():
-    """
-    This task resets the users' gem amount and gems spent every day at midnight in their local timezone.
-    """
-    now_utc = django_timezone.now()
+def flush_step_buffer_task():
+    """Apply buffered step updates (STEP_INGEST_MODE = 'buffered')."""
+    from .step_buffer import flush_step_buffer
+    return flush_step_buffer()
 
-    batch_size = 100  # Adjust based on your needs
-    offset = 0
 
-    while True:
-        # Fetch users with timezones in batches
-        users = CustomUser.objects.exclude(timezone=None).exclude(is_superuser=True).exclude(is_staff=True).values('id', 'email', 'gems_spent', 'timezone').order_by('id')[offset:offset + batch_size]
-        # print(users, 'users')
-
-        if not users:
-            print("Processed all users successfully.")
-            break
-
-        for user in users:
-            user_timezone = user['timezone']
-
-            try:
-                # Convert UTC time to user's local time
-                user_local_time = now_utc.astimezone(user_timezone)
+@shared_task
+def checkpoint_leaderboards_task():
+    """Write pending live league XP to UserLeague (LEAGUE_XP_MODE = 'live')."""
+    from .live_leaderboard import checkpoint_leaderboards, is_live_leaderboard
+    if not is_live_leaderboard():
+        return None
+    return checkpoint_leaderboards()
 
-                # Check if it's midnight (0 hour) in the user's local timezone
-                if user_local_time.hour == 0:
-                    # Calculate the date for the previous day
-                    previous_day = user_local_time.date() - timedelta(days=1)
-                    print('previous day',previous_day)
 
-                    # Reset the user's total gems and gems spent
-                    CustomUser.objects.filter(id=user['id']).update(gems_spent=0)
+@shared_task
+def purge_ingestion_receipts_task():
+    """Drop stored sync-key results once clients can no longer be retrying them."""
+    deleted = purge_ingestion_receipts()
+    logger.info(f"Purged {deleted} expired ingestion receipts")
 
-                    # Fetch or create the Gem record for the previous day
-                    gem_record, created = Gem.objects.get_or_create(user_id=user['id'], date=previous_day)
-                    print('gem record yesterday',gem_record)
 
-                    # Update the gem values and save
-                    gem_record.xp_gem = 0
-                    gem_record.manual_gem = 0
-                    gem_record.save()
+@shared_task
+def reset_gems_for_local_timezones():
+    """
+    This task runs the weekly gem reset for users whose local Monday midnight just passed.
+    """
+    reset = reset_weekly_gems()
+    logger.info(f"Gem reset task completed successfully for {reset} users.")
 
-                    print(f"Reset gems and gems spent for user {user['email']}")
 
-            except Exception as e:
-                print(f"Error processing user {user['email']} with timezone {user['timezone']}: {e}")
+@shared_task(acks_late=True)
+def settle_league_instances_task(instance_ids):
+    """
+    Settle one share of expired league instances. A redelivered or repeated task
+    finds them settled and does nothing (see league_service.settle_league_instances).
+    """
+    return settle_league_instances(instance_ids)
 
-        offset += batch_size
 
-    print("Gem reset task completed successfully.")
+def _fan_out_settlement(company):
+    shares = settlement_shares(company=company)
+    if shares:
+        group(settle_league_instances_task.s(instance_ids) for instance_ids in shares).apply_async()
+    return len(shares)
 
 
 @shared_task(bind=True, acks_late=True)
 def process_league_promotions(self):
-    now = timezone.now()
-    logger.info('Processing expired leagues...')
-
-    expired_leagues = (LeagueInstance.objects.filter( league_end__lte=now, is_active=True, company__isnull=True )
-                       .select_related('league', 'company'))
-
-
-    logger.info(f'Found {expired_leagues.count()} expired leagues')
-    logger.info(f'Found {expired_leagues} expired leagues')
-
-    # Mark all expired leagues as inactive immediately to prevent reprocessing
-    # expired_leagues.update(is_active=False)
-
-    for league in expired_leagues:
-        is_highest_league = league.league.order == 10
-        is_lowest_league = league.league.order == 1
-
-        # users_in_league = league.userleague_set.order_by('-xp_global', '-user__streak', 'id')
-        users_in_league = UserLeague.objects.filter(league_instance=league).select_related('user').order_by(
-            '-xp_global', '-user__streak', 'id')
-        total_users = users_in_league.count()
-        logger.info(f'Total users in league {league.id}: {total_users}')
-
-        promotion_threshold = int(total_users * 0.30)
-        demotion_threshold = int(total_users * 0.80)
-
-        bulk_updates = []
-        notifications = []
-        channel_messages = []
-        gems_data = [] # Collect gems data
-
-        for rank, user_league in enumerate(users_in_league, start=1):
-            user = user_league.user
-            logger.info(f'Processing user {user.id} in league {league.id}')
-
-            notif_type = ""
-            content = ""
-            gems_obtained = 0 # Default to 0
-
-
-            if is_highest_league:
-                # Highest league: users can only be retained or demoted
-                if rank <= demotion_threshold:
-                    status = "Retained"
-                    gems_obtained = 10
-                    notif_type = "league_retained"
-                    content = f"You have been retained in Global League {11 - league.league.order} ({league.league.name})"
-                    retain_user(user, gems_obtained, league)
-                else:
-                    status = "Demoted"
-                    gems_obtained = 0  # No gems for demoted users
-                    notif_type = "league_demotion"
-                    content = f"You have been demoted to Global League {11 - league.league.order} ({league.league.name})"
-                    demote_user(user, gems_obtained, league)
-
-            elif is_lowest_league:
-                if rank <= promotion_threshold:
-                    gems_obtained = 20 - (rank - 1) * 2
-                    status = "Promoted"
-                    notif_type = "league_promotion"
-                    content = f"You have been promoted to Global League {11 - league.league.order} ({league.league.name})"
-                    promote_user(user, gems_obtained, league)
-                else:
-                    gems_obtained = 10 if user_league.xp_global > 0 else 0
-                    status = "Retained"
-                    notif_type = "league_retained"
-                    content = f"You have been retained in Global League {11 - league.league.order} ({league.league.name})"
-                    retain_user(user, gems_obtained, league)
-            else:
-                if total_users <= 3:
-                    if user_league.xp_global == 0:
-                        gems_obtained = 0
-                        status = "Demoted"
-                        notif_type = "league_demotion"
-                        content = f"You have been demoted to Global League {11 - league.league.order} ({league.league.name})"
-                        demote_user(user, gems_obtained, league)
-                    else:
-                        gems_obtained = 10
-                        status = "Re retain_user(user, gems_obtained, league)tained"
-                        notif_type = "league_retained"
-                        content = f"You have been retained in Global League {11 - league.league.order} ({league.league.name})"
-                        retain_user(user, gems_obtained, league)
-                else:
-                    if rank <= promotion_threshold:
-                        gems_obtained = 20 - (rank - 1) * 2
-                        status = "Promoted"
-                        notif_type = "league_promotion"
-                        content = f"You have been promoted to Global League {11 - league.league.order} ({league.league.name})"
-                        promote_user(user, gems_obtained, league)
-                    elif rank <= demotion_threshold:
-                        gems_obtained = 10
-                        status = "Retained"
-                        notif_type = "league_retained"
-                        content = f"You have been retained in Global League {11 - league.league.order} ({league.league.name})"
-                        retain_user(user, gems_obtained, league)
-                    else:
-                        gems_obtained = 0
-                        status = "Demoted"
-                        notif_type = "league_demotion"
-                        content = f"You have been demoted in Global League {11 - league.league.order} ({league.league.name})"
-                        demote_user(user, gems_obtained, league)
-
-            notifications.append(Notif(user=user, notif_type=notif_type, content=content))
-
-            user_league.xp_global = 0
-
-            bulk_updates.append(user_league)
-
-            new_gem_count = user.get_gem_count()
-            channel_messages.append({
-                'user_id': user.id,
-                'gem_count': new_gem_count,
-                'channel_name': f'gem_{user.id}',
-            })
-
-            # Collect gems data
-            gems_data.append(
-                {
-                    "user_id": user.id,
-                    "gems_obtained": gems_obtained
-                }
-            )
-
-        UserLeague.objects.bulk_update(bulk_updates, ['xp_global'])
-        Notif.objects.bulk_create(notifications)
-        
-        league.is_active = False
-        league.save()
-        logger.info(f'Users in league {league.id}: {list(users_in_league)}')
-
-        custom_users_ids = [user_league.user.id for user_league in users_in_league]
-        logger.info(f'USER IDS OF USERS IN LEAGUE XXXXXX: {custom_users_ids}')
-
-        send_status_update.delay(custom_users_ids, league.id, status, is_lowest_league, is_highest_league, total_users, promotion_threshold, demotion_threshold)
-
-        send_next_league_update.delay(custom_users_ids, league.id, gems_data)
-
-        send_gem_update.delay(channel_messages)
-
-    logger.info("Completed processing expired leagues.")
+    """
+    Fans the settlement of expired global league instances out over the workers,
+    one task per instance.
+    """
+    dispatched = _fan_out_settlement(company=False)
+    logger.info(f"Dispatched settlement of {dispatched} expired global league instances")
 
 
 @shared_task(bind=True, acks_late=True)
 def process_company_league_promotions(self):
     """
-    Handles promotions and demotions of users in company leagues at the end of a league period.
+    Fans the settlement of expired company league instances out over the workers,
+    one task per company.
     """
-    now = timezone.now()
-    expired_leagues = (LeagueInstance.objects.filter(league_end__lte=now, is_active=True, company__isnull=False).select_related('league','company'))
-
-    logger.info(f'Expired company leagues: {expired_leagues}')
-
-    for league in expired_leagues:
-        users_in_league = UserLeague.objects.filter(league_instance=league).select_related('user').order_by('-xp_company', '-user__streak', 'id')
-        total_users = users_in_league.count()
-
-        logger.info(f"Total users in league {league.id}: {total_users}")
-
-        promotion_threshold = int(total_users * 0.30)
-        demotion_threshold = int(total_users * 0.80)
-
-        bulk_updates = []
-        notifications = []
-        channel_messages = []
-        gems_data = [] # Collect gems data
-
-        # Get the highest and lowest league orders for the company
-        approved_leagues = LeagueInstance.objects.filter(company=league.company, is_active=True)
-        lowest_league_order = approved_leagues.first().league.order
-        highest_league_order = approved_leagues.last().league.order
-
-        is_highest_league = league.league.order == highest_league_order
-        is_lowest_league = league.league.order == lowest_league_order
-
-        for rank, user_league in enumerate(users_in_league, start=1):
-            user = user_league.user
-            logger.info(f"Processing user {user.id} in league {league.id}")
-
-            notif_type = ""
-            content = ""
-            gems_obtained = 0 # Default to 0
-            if is_highest_league and is_lowest_league: 
-                # When the highest and lowest leagues are the same, all users are retained 
-                status = "Retained" 
-                gems_obtained = 10 if user_league.xp_company > 0 else 0
-                notif_type = "league_retained"
-                content = f"You have been retained in company League {11 - league.league.order} ({league.league.name})"
-                retain_company_user(user, gems_obtained, league)
-            elif is_highest_league:
-                # Highest league: users can only be retained or demoted
-                if rank <= demotion_threshold:
-                    status = "Retained"
-                    gems_obtained = 10
-                    notif_type = "league_retained"
-                    content = f"You have been retained in company League {11 - league.league.order} ({league.league.name})"
-                    retain_company_user(user, gems_obtained, league)
-                else:
-                    status = "Demoted"
-                    gems_obtained = 0  # No gems for demoted users
-                    notif_type = "league_demotion"
-                    content = f"You have been demoted to company League {11 - league.league.order} ({league.league.name})"
-                    demote_company_user(user, gems_obtained, league)
-            elif is_lowest_league:
-                if rank <= promotion_threshold:
-                    gems_obtained = 20 - (rank - 1) * 2
-                    status = "Promoted"
-                    notif_type = "league_promotion"
-                    content = f"You have been promoted to company League {11 - league.league.order} ({league.league.name})"
-                    promote_company_user(user, gems_obtained, league)
-                else:
-                    gems_obtained = 10 if user_league.xp_company > 0 else 0
-                    status = "Retained"
-                    notif_type = "league_retained"
-                    content = f"You have been retained in company League {11 - league.league.order} ({league.league.name})"
-                    retain_company_user(user, gems_obtained, league)
-            else:
-                if total_users <= 3:
-                    if user_league.xp_company == 0:
-                        gems_obtained = 0
-                        status = "Demoted"
-                        notif_type = "league_demotion"
-                        content = f"You have been demoted to company League {11 - league.league.order} ({league.league.name})"
-                        demote_company_user(user, gems_obtained, league)
-                    else:
-                        gems_obtained = 10
-                        status = "Retained"
-                        notif_type = "league_retained"
-                        content = f"You have been retained in company League {11 - league.league.order} ({league.league.name})"
-                        retain_company_user(user, gems_obtained, league)
-                else:
-                    if rank <= promotion_threshold:
-                        gems_obtained = 20 - (rank - 1) * 2
-                        status = "Promoted"
-                        notif_type = "league_promotion"
-                        content = f"You have been promoted to company League {11 - league.league.order} ({league.league.name})"
-                        promote_company_user(user, gems_obtained, league)
-                    elif rank <= demotion_threshold:
-                        gems_obtained = 10
-                        status = "Retained"
-                        notif_type = "league_retained"
-                        content = f"You have been retained in company League {11 - league.league.order} ({league.league.name})"
-                        retain_company_user(user, gems_obtained, league)
-                    else:
-                        gems_obtained = 0
-                        status = "Demoted"
-                        notif_type = "league_demotion"
-                        content = f"You have been demoted in company League {11 - league.league.order} ({league.league.name})"
-                        demote_company_user(user, gems_obtained, league)
-
-            notifications.append(Notif(user=user, notif_type=notif_type, content=content))
-
-            user_league.xp_company = 0
-
-            bulk_updates.append(user_league)
-
-            new_gem_count = user.get_gem_count()
-            channel_messages.append({
-                'user_id': user.id,
-                'gem_count': new_gem_count,
-                'channel_name': f'gem_{user.id}',
-            })
-
-            # Collect gems data
-            gems_data.append(
-                {
-                    "user_id": user.id,
-                    "gems_obtained": gems_obtained
-                }
-            )
-
-        UserLeague.objects.bulk_update(bulk_updates, ['xp_company'])
-        Notif.objects.bulk_create(notifications)
-
-        league.is_active = False
-        league.save()
-        logger.info(f'Users in league {league.id}: {list(users_in_league)}')
-
-        custom_users_ids = [user_league.user.id for user_league in users_in_league]
-        logger.info(f'USER IDS OF USERS IN LEAGUE XXXXXX: {custom_users_ids}')
-
-        send_status_update.delay(custom_users_ids, league.id, status, is_lowest_league, is_highest_league, total_users, promotion_threshold, demotion_threshold)
-
-        send_next_league_update.delay(custom_users_ids, league.id, gems_data)
-
-        send_gem_update.delay(channel_messages)
+    dispatched = _fan_out_settlement(company=True)
+    logger.info(f"Dispatched settlement of expired league instances of {dispatched} companies")
 
 
 @shared_task
@@ -642,160 +297,108 @@ def send_gem_update(channel_messages):
         logger.info(f'Error occurred: {e}', exc_info=True)
 
 @shared_task
-def send_status_update(custom_users_ids, league_instance_id, status, is_lowest_league, is_highest_league, total_users, promotion_threshold, demotion_threshold):
+def send_status_update(custom_users_ids, league_instance_id, *legacy_args):
+    """
+    Send every settled user their final rank and advancement in the just concluded league.
+
+    Ranks and statuses are read from the LeagueResult rows settlement wrote, so they
+    do not depend on any cache surviving until the task runs. Tasks queued with the
+    former (status, is_lowest, is_highest, total, thresholds) arguments still run.
+    """
     try:
         logger.info("Sending status updates.")
-        users_in_league = CustomUser.objects.filter(id__in=custom_users_ids)
-
-        # Fetch the league instance
-        league = LeagueInstance.objects.get(id=league_instance_id)
+        league = LeagueInstance.objects.select_related('league').get(id=league_instance_id)
 
         # Determine league type based on the presence of a company
-        league_type = 'company' if league.company else 'global'
+        league_type = 'company' if league.company_id else 'global'
 
-        # Fetch appropriate XP based on league type
-        if league_type == 'company':
-            rankings = UserLeague.objects.filter(league_instance=league).select_related('user').order_by('-xp_company', '-user__streak', 'id')
-        else:
-            rankings = UserLeague.objects.filter(league_instance=league).select_related('user').order_by('-xp_global', '-user__streak', 'id')
-
-        rankings_data = []
-        for idx, ul in enumerate(rankings, start=1):
-            xp = ul.xp_company if league_type == 'company' else ul.xp_global
-            if total_users <= 3:
-                advancement = "Demoted" if xp == 0 and not is_lowest_league else "Retained" if xp == 0 else "Promoted" if not is_highest_league else "Retained"
-            else:
-                advancement = "Promoted" if idx <= promotion_threshold and not is_highest_league else "Retained" if idx <= demotion_threshold else "Demoted" if not is_lowest_league else "Retained"
-            rankings_data.append({
-                "user_id": ul.user.id,
-                "username": ul.user.username,
-                "profile_picture": ul.user.profile_picture.url if ul.user.profile_picture else None,
-                "xp": xp,
-                "streaks": ul.user.streak,
-                "rank": idx,
-                "advancement": advancement
-            })
-
-        league_end = league.league_end.isoformat(timespec='milliseconds') + 'Z'
         data_for_status = {
             "league_id": league.id,
             "league_name": league.league.name,
             "league_level": 11 - league.league.order,
-            "league_end": league_end
+            "league_end": league.league_end.isoformat(timespec='milliseconds') + 'Z',
         }
 
-        # Build users with ranks
-        # {user_id: rank} so we can access the rank in 0(1)
-        # users_ranks = {}
-        # for rank,user in enumerate(users_in_league, start=1):
-        #     users_ranks[user.id]=rank
-
-        # Send status updates for the just concluded league
-        for rank,user in enumerate(users_in_league, start=1):
-            logger.info(user.email)
-            data_for_status.update({
-                "rank": rank,
-                "status": status
-            })
-            logger.info(f'Sending status update to user {user.id}')
-            channel_layer = get_channel_layer()
+        results = LeagueResult.objects.filter(
+            league_instance_id=league_instance_id, user_id__in=custom_users_ids
+        ).order_by('rank').values_list('user_id', 'rank', 'status')
+        channel_layer = get_channel_layer()
+        for user_id, rank, result_status in results:
+            logger.info(f"Sending status update to user {user_id}")
             async_to_sync(channel_layer.group_send)(
-                f'{league_type}_league_status_{user.id}',
+                f"{league_type}_league_status_{user_id}",
                 {
                     'type': 'send_league_status',
-                    'data': data_for_status
+                    'data': dict(data_for_status, rank=rank, status=result_status)
                 }
             )
-            logger.info(f'Sent status update to user {user.id}')
         logger.info(f'Sent status update successful')
     except Exception as e:
         logger.error(f'Error occurred: {e}', exc_info=True)
 
+
 @shared_task
-def send_next_league_update(user_ids, league_instance_id, gems_data):
+def send_next_league_update(league_instance_id, *legacy_args):
+    """
+    Send the users of a settled league instance the rankings of the instances they moved to.
+
+    Users are grouped by destination instance. Each destination's rankings are read
+    once from its ranking snapshot and sent as one message on the settled instance's
+    group, with the moved users' ranks in ``user_ranks`` next to the payload. The
+    league consumers forward it only to those users, as the usual payload with their
+    ``user_rank``. The gems earned come from the settled instance's LeagueResult
+    rows, so the task only carries its id.
+    Tasks queued with the former (user_ids, league_instance_id, gems_data)
+    arguments are still accepted.
+    """
     try:
-        logger.info('sending next league info')
-        users_in_league = CustomUser.objects.filter(id__in=user_ids)
+        if isinstance(league_instance_id, list) and len(legacy_args) == 2:
+            # Legacy (user_ids, league_instance_id, gems_data) call, queued before settlement
+            # recorded LeagueResult rows. Remove this branch and legacy_args once a release with
+            # the single-id call has drained every worker queue.
+            user_ids = league_instance_id
+            league_instance_id, gems_data = legacy_args
+            gems = dict.fromkeys(user_ids, 0)
+            gems.update((item['user_id'], item['gems_obtained']) for item in gems_data)
+        else:
+            gems = dict(
+                LeagueResult.objects.filter(league_instance_id=league_instance_id)
+                .values_list('user_id', 'gems_obtained')
+            )
 
-        # Fetch the current league instance
         league = LeagueInstance.objects.get(id=league_instance_id)
+        league_type = 'company' if league.company_id else 'global'
 
-        # Determine league type based on the presence of a company
-        league_type = 'company' if league.company else 'global'
-
-        # Prepare and send data for the next league instance
-        for rank,user in enumerate(users_in_league, start=1):
-            if league_type == 'company':
-                next_user_league = UserLeague.objects.filter(
-                    user=user,
-                    league_instance__is_active=True,
-                    league_instance__company__isnull=False,
-                    league_instance__company=league.company
-                ).select_related('league_instance', 'league_instance__league').first()
-            else:
-                next_user_league = UserLeague.objects.filter(
-                    user=user,
-                    league_instance__is_active=True,
-                    league_instance__company__isnull=True
-                ).select_related('league_instance', 'league_instance__league').first()
-
-            if next_user_league:
-                next_league_instance = next_user_league.league_instance
-                logger.info(f'Next league instance ID: {next_league_instance.id}')
-
-                if league_type == 'company':
-                    next_rankings = UserLeague.objects.filter(
-                        league_instance=next_league_instance
-                    ).select_related('user').order_by('-xp_company','-user__streak', 'id')
-                else:
-                    next_rankings = UserLeague.objects.filter(
-                        league_instance=next_league_instance
-                    ).select_related('user').order_by('-xp_global','-user__streak', 'id')
-
-                next_rankings_data = []
-                user_rank = None
-                # TODO: This should be only processed once!
-                #  We should oly process _user_ data here and use another part(not in this loop: for user in users_in_league)
-                # need something like (next_league)=>{'user_id': {rank, ...user}}
-                for idx, ul in enumerate(next_rankings, start=1):
-                    if ul.user.id == user.id:
-                        user_rank = idx
-
-                    gems_obtained = next((item['gems_obtained'] for item in gems_data if item['user_id'] == ul.user.id), 0)
-                    next_rankings_data.append({
-                        "user_id": ul.user.id,
-                        "username": ul.user.username,
-                        "profile_picture": ul.user.profile_picture.url if ul.user.profile_picture else None,
-                        "xp": ul.xp_company if league_type == 'company' else ul.xp_global,
-                        "streaks": ul.user.streak,
-                        "rank": idx,
-                        "gems_obtained": gems_obtained,
-                        "advancement": "TBD"  # Update this based on the new rankings logic if necessary
-                    })
-
-                next_league_start = next_league_instance.league_start.isoformat(timespec='milliseconds') + 'Z'
-                next_league_end = next_league_instance.league_end.isoformat(timespec='milliseconds') + 'Z'
-                data = {
-                    "league_id": next_league_instance.id,
-                    "league_name": next_league_instance.league.name,
-                    "league_level": 11 - next_league_instance.league.order,
-                    "league_start": next_league_start,
-                    "league_end": next_league_end,
-                    "user_rank": user_rank,
-                    "rankings": next_rankings_data,
+        destinations = defaultdict(list)
+        instances = {}
+        next_leagues = UserLeague.objects.filter(
+            user_id__in=list(gems), league_instance__is_active=True, league_instance__company=league.company_id
+        ).select_related('league_instance__league')
+        for next_league in next_leagues:
+            instances[next_league.league_instance_id] = next_league.league_instance
+            destinations[next_league.league_instance_id].append(next_league.user_id)
+
+        channel_layer = get_channel_layer()
+        for instance_id, moved_user_ids in destinations.items():
+            snapshot = get_ranking_snapshot(instances[instance_id])
+            ranks = {entry['user_id']: entry['rank'] for entry in snapshot['rankings']}
+            data = dict(
+                snapshot,
+                rankings=[
+                    # Everyone starts the new league level, so advancement is not known yet
+                    dict(entry, gems_obtained=gems.get(entry['user_id'], 0), advancement='TBD')
+                    for entry in snapshot['rankings']
+                ],
+            )
+            async_to_sync(channel_layer.group_send)(
+                f'{league_type}_league_{league_instance_id}',
+                {
+                    'type': 'send_league_update',
+                    'data': data,
+                    'user_ranks': {str(user_id): ranks.get(user_id) for user_id in moved_user_ids},
                 }
+            )
 
-                channel_layer = get_channel_layer()
-                async_to_sync(channel_layer.group_send)(
-                    f'{league_type}_league_{league_instance_id}',
-                    {
-                        'type': 'send_league_update',  # Changed this to send the next league data
-                        'data': data,
-                    }
-                )
-                logger.info(f"Sent next league update for league {next_league_instance.id}")
-
-        # Logic to send league update notification
-        logger.info(f'Sent next league update for league users {league_instance_id}')
+        logger.info(f'Sent next league update for league {league_instance_id} to {len(destinations)} destinations')
     except Exception as e:
         logger.error(f'Error occurred: {e}', exc_info=True)
@@ -0,0 +1,73 @@
+from datetime import date, timedelta
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from myapp.activity_bitmap import ActivityHistory
+from myapp.models import CustomUser, Streak, StreakActivityBitmap
+
+
+def _streak(user, day):
+    return Streak.objects.create(user=user, date=day, timeStamp=timezone.now(), currentStreak=1, highestStreak=1)
+
+
+class ActivityHistoryTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='bitmap@test.com',
+            email='bitmap@test.com',
+            password='testpass123',
+        )
+
+    def test_streak_saves_maintain_bitmap_across_years(self):
+        # A six day run over new year, a gap, then a two day run
+        first = date(2023, 12, 28)
+        for offset in range(6):
+            _streak(self.user, first + timedelta(days=offset))
+        _streak(self.user, date(2024, 1, 5))
+        _streak(self.user, date(2024, 1, 6))
+
+        self.assertEqual(StreakActivityBitmap.objects.filter(user=self.user).count(), 2)
+        history = ActivityHistory(self.user.id)
+        self.assertEqual(history.highest_streak(), 6)
+        self.assertEqual(history.run_ending(date(2024, 1, 2)), 6)
+        self.assertEqual(history.current_streak(date(2024, 1, 7)), 2)
+        self.assertEqual(history.current_streak(date(2024, 1, 8)), 0)
+        self.assertEqual(history.active_days(date(2024, 1, 1), date(2024, 1, 31)), 4)
+        self.assertEqual(history.calendar(date(2024, 1, 2), date(2024, 1, 5)),
+                         [(date(2024, 1, 2), 6), (date(2024, 1, 5), 1)])
+
+    def test_rebuild_matches_incremental_maintenance(self):
+        for day in (date(2024, 2, 28), date(2024, 2, 29), date(2024, 12, 31)):
+            _streak(self.user, day)
+        expected = dict(StreakActivityBitmap.objects.values_list('year', 'bits'))
+        StreakActivityBitmap.objects.all().delete()
+
+        call_command('rebuild_activity_bitmaps', stdout=StringIO())
+
+        rebuilt = dict(StreakActivityBitmap.objects.values_list('year', 'bits'))
+        self.assertEqual({year: bytes(bits) for year, bits in rebuilt.items()},
+                         {year: bytes(bits) for year, bits in expected.items()})
+
+
+class StreakRecordsViewTests(APITestCase):
+    def test_calendar_comes_from_bitmap(self):
+        user = CustomUser.objects.create_user(
+            username='calendar@test.com',
+            email='calendar@test.com',
+            password='testpass123',
+        )
+        self.client.force_authenticate(user=user)
+        today = timezone.localtime(timezone.now(), user.timezone).date()
+        for offset in (3, 2, 1):
+            _streak(user, today - timedelta(days=offset))
+
+        response = self.client.get(reverse('streak-records'), {'start_date': str(today - timedelta(days=2))})
+
+        data = response.json()['data']
+        self.assertEqual([entry['current_streak'] for entry in data['streak_per_day']], [2, 3, 0])
+        self.assertEqual(data['active_days'], 2)
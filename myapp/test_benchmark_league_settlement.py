@@ -0,0 +1,35 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+
+from myapp.models import CustomUser, LeagueInstance, LeagueResult
+
+
+class BenchmarkLeagueSettlementTests(TestCase):
+    def _run(self, **options):
+        out = StringIO()
+        call_command('benchmark_league_settlement', users=120, companies=2, stdout=out, **options)
+        return out.getvalue()
+
+    @override_settings(DEBUG=True)
+    def test_reports_every_phase_and_keeps_nothing(self):
+        output = self._run()
+
+        for phase in ('populate', 'global settlement', 'company settlement'):
+            self.assertIn(phase, output)
+        self.assertFalse(CustomUser.objects.exists())
+        self.assertFalse(LeagueInstance.objects.exists())
+        self.assertFalse(LeagueResult.objects.exists())
+
+    @override_settings(DEBUG=True)
+    def test_same_seed_settles_the_same_population(self):
+        def reports(output):
+            return [line for line in output.splitlines() if line.endswith('}')]
+
+        self.assertEqual(reports(self._run(seed=3)), reports(self._run(seed=3)))
+
+    def test_refuses_to_run_without_debug(self):
+        with self.assertRaises(CommandError):
+            self._run()
@@ -0,0 +1,67 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.test import TestCase
+from django.utils import timezone
+
+from myapp.league_service import place_users, settle_expired_leagues
+from myapp.models import Company, CompanyLeagueConfig, CustomUser, League, LeagueInstance
+from myapp.ranking_service import league_edges
+
+
+class CompanyLeagueConfigTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.leagues = {order: League.objects.create(name=f'League {order}', order=order) for order in range(1, 11)}
+        owner = CustomUser.objects.create_user(username='owner', email='owner@co.com', password='testpass123')
+        self.company = Company.objects.create(name='Config Co', owner=owner, domain='co.com')
+
+    def _member(self, n):
+        return CustomUser.objects.create_user(username=f'm{n}', email=f'm{n}@co.com', password='testpass123',
+                                              company=self.company)
+
+    def _config(self):
+        return CompanyLeagueConfig.objects.get(company=self.company)
+
+    def test_follows_members_joining_and_leaving(self):
+        members = [self._member(n) for n in range(10)]
+        self.assertEqual((self._config().member_count, self._config().highest_level), (10, 2))
+        self.assertEqual(self._config().allowed_orders, [1, 2])
+
+        members[0].company = None
+        members[0].save()
+        with self.captureOnCommitCallbacks(execute=True):
+            members[1].delete()
+
+        self.assertEqual((self._config().member_count, self._config().highest_level), (8, 1))
+
+    def test_follows_the_active_instance_span(self):
+        users = [self._member(n) for n in range(5)]
+        place_users({(self.leagues[1].id, self.company.id): [user.id for user in users]})
+        self.assertEqual((self._config().lowest_order, self._config().highest_order), (1, 1))
+
+        instance = LeagueInstance.objects.select_related('league').get(company=self.company)
+        LeagueInstance.objects.create(league=self.leagues[3], company=self.company, league_start=self.now,
+                                      league_end=self.now + timedelta(days=1))
+        CompanyLeagueConfig.objects.filter(company=self.company).update(highest_order=3)
+
+        # Reads the stored span instead of scanning the company's instances
+        with self.assertNumQueries(1):
+            self.assertEqual(league_edges(instance), (False, True))
+
+    @patch('myapp.tasks.send_gem_update.delay')
+    @patch('myapp.tasks.send_next_league_update.delay')
+    @patch('myapp.tasks.send_status_update.delay')
+    def test_settlement_refreshes_the_span(self, *mocks):
+        users = [self._member(n) for n in range(5)]
+        place_users({(self.leagues[1].id, self.company.id): [user.id for user in users]})
+        # An instance nobody was left in still spans up to league 3 until it is settled
+        LeagueInstance.objects.create(
+            league=self.leagues[3], company=self.company, league_start=self.now - timedelta(days=7),
+            league_end=self.now - timedelta(minutes=1),
+        )
+        CompanyLeagueConfig.objects.filter(company=self.company).update(highest_order=3)
+
+        settle_expired_leagues(company=True, now=self.now)
+
+        self.assertEqual((self._config().lowest_order, self._config().highest_order), (1, 1))
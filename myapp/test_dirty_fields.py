@@ -0,0 +1,90 @@
+from django.db import connection
+from django.db.models.signals import post_save, pre_save
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from myapp.models import CustomUser, Gem, Feed, Clap
+
+
+class DirtyFieldsTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='dirty@test.com',
+            email='dirty@test.com',
+            password='testpass123',
+        )
+
+    def test_save_writes_only_changed_columns(self):
+        user = CustomUser.objects.get(pk=self.user.pk)
+        with CaptureQueriesContext(connection) as queries:
+            user.save()
+        self.assertEqual(len(queries), 0)
+
+        user.bio = 'Cyclist'
+        with CaptureQueriesContext(connection) as queries:
+            user.save()
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"bio"', updates[0])
+        self.assertNotIn('"email"', updates[0])
+        self.assertFalse(user.has_changed('bio'))
+
+    def test_unchanged_save_still_sends_save_signals(self):
+        user = CustomUser.objects.get(pk=self.user.pk)
+        received = []
+
+        def receiver(sender, instance, update_fields, **kwargs):
+            received.append((kwargs['signal'], instance, update_fields))
+
+        for signal in (pre_save, post_save):
+            signal.connect(receiver, sender=CustomUser)
+            self.addCleanup(signal.disconnect, receiver, sender=CustomUser)
+
+        user.save()
+
+        self.assertEqual(received, [(pre_save, user, frozenset()), (post_save, user, frozenset())])
+
+    def test_save_of_a_deleted_row_inserts_it_again(self):
+        user = CustomUser.objects.get(pk=self.user.pk)
+        CustomUser.objects.filter(pk=user.pk).delete()
+
+        user.bio = 'Back again'
+        user.save()
+        self.assertEqual(CustomUser.objects.get(pk=user.pk).bio, 'Back again')
+
+        # Without a snapshot every column except the excluded ones is written
+        CustomUser.objects.filter(pk=user.pk).delete()
+        del user._loaded_values
+        user.save()
+        self.assertTrue(CustomUser.objects.filter(pk=user.pk).exists())
+
+    def test_gem_save_locks_row_only_when_gems_change(self):
+        gem = Gem.objects.create(user=self.user, date=timezone.now().date(), xp_gem=1)
+        gem = Gem.objects.get(pk=gem.pk)
+
+        with CaptureQueriesContext(connection) as queries:
+            gem.save()
+        self.assertEqual([q['sql'] for q in queries if 'SAVEPOINT' not in q['sql']], [])
+
+        gem.xp_gem = 2
+        with CaptureQueriesContext(connection) as queries:
+            gem.save()
+        reads = [q['sql'] for q in queries
+                 if q['sql'].startswith('SELECT') and f'"myapp_gem"."id" = {gem.pk}' in q['sql']]
+        self.assertTrue(reads[0].endswith('FOR UPDATE'))
+        self.assertEqual(self.user.gem_transactions.filter(kind='xp').count(), 2)
+
+    def test_claps_move_counter_without_recount(self):
+        feed = Feed.objects.create(user=self.user, feed_type=Feed.STREAK, content='10-day streak')
+        clapper = CustomUser.objects.create_user(username='clapper@test.com', email='clapper@test.com',
+                                                 password='testpass123')
+
+        with CaptureQueriesContext(connection) as queries:
+            clap = Clap.objects.create(user=clapper, feed=feed)
+        self.assertFalse(any('COUNT(' in q['sql'] for q in queries))
+        self.assertEqual(feed.claps_count, 1)
+        self.assertEqual(Feed.objects.get(pk=feed.pk).claps_count, 1)
+
+        clap.delete()
+        self.assertEqual(Feed.objects.get(pk=feed.pk).claps_count, 0)
@@ -0,0 +1,97 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from myapp.gem_service import credit_manual_gems
+from myapp.models import CustomUser, Draw, DrawParticipant, DrawTicketBlock, DrawWinner, Prize
+
+
+class DrawTicketBlockTests(APITestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='buyer', email='buyer@test.com', password='testpass123')
+        self.other = CustomUser.objects.create_user(username='other', email='other@test.com', password='testpass123')
+        self.draw = Draw.objects.create(draw_name='Global', draw_type='global',
+                                        draw_date=timezone.now() + timedelta(days=1), number_of_winners=2)
+        self.client.force_authenticate(user=self.user)
+
+    def test_purchase_adds_one_block_after_the_last(self):
+        self.draw.add_tickets(self.other, 4)
+        credit_manual_gems({self.user.id: 10}, timezone.now().date())
+
+        response = self.client.post(reverse('convert-gem'), {'item_type': 'ticket_global', 'quantity': 3},
+                                    format='json')
+
+        self.assertEqual(response.status_code, 200)
+        block = DrawTicketBlock.objects.get(user=self.user)
+        self.assertEqual((block.offset, block.quantity), (4, 3))
+        self.assertEqual(self.draw.ticket_count(), 7)
+
+        draws = self.client.get(reverse('active-global-draw-list')).json()['data']
+        self.assertEqual(draws[0]['user_ticket_ids'], [5, 6, 7])
+        self.assertEqual((draws[0]['entry_count'], draws[0]['user_entry_count']), (7, 3))
+
+    def test_winning_tickets_map_to_their_blocks(self):
+        self.draw.add_tickets(self.user, 3)
+        self.draw.add_tickets(self.other, 5)
+        self.draw.add_tickets(self.user, 2)
+
+        # Tickets 0-2 and 8-9 are the buyer's, 3-7 the other user's
+        with patch('myapp.models.random.sample', return_value=[9, 3]):
+            self.draw.pick_winners()
+
+        winners = list(DrawWinner.objects.filter(draw=self.draw).order_by('id').values_list('user', flat=True))
+        self.assertEqual(winners, [self.user.id, self.other.id])
+        self.draw.refresh_from_db()
+        self.assertFalse(self.draw.is_active)
+
+    def test_picking_winners_does_not_grow_with_tickets(self):
+        small = Draw.objects.create(draw_name='Small', draw_type='global', draw_date=self.draw.draw_date,
+                                    number_of_winners=2)
+        small.add_tickets(self.user, 2)
+        for i in range(50):
+            self.draw.add_tickets(self.user if i % 2 else self.other, 1000)
+
+        with CaptureQueriesContext(connection) as few:
+            small.pick_winners()
+        with CaptureQueriesContext(connection) as many:
+            self.draw.pick_winners()
+
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(DrawWinner.objects.filter(draw=self.draw).count(), 2)
+
+    def test_purchases_keep_the_entry_counters(self):
+        self.draw.add_tickets(self.user, 3)
+        self.draw.add_tickets(self.other, 5)
+        self.draw.add_tickets(self.user, 2)
+
+        self.draw.refresh_from_db()
+        self.assertEqual(self.draw.entry_count, self.draw.ticket_count())
+        self.assertEqual(self.draw.entry_count, 10)
+        counts = dict(DrawParticipant.objects.filter(draw=self.draw).values_list('user', 'entry_count'))
+        self.assertEqual(counts, {self.user.id: 5, self.other.id: 5})
+
+    def _list_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('active-global-draw-list'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_draw_list_queries_do_not_grow_with_draws(self):
+        self.draw.add_tickets(self.user, 2)
+        few = self._list_queries()
+
+        for i in range(4):
+            draw = Draw.objects.create(draw_name=f'Global {i}', draw_type='global', draw_date=self.draw.draw_date)
+            Prize.objects.create(draw=draw, name='Prize', description='A prize')
+            draw.add_tickets(self.user, i + 1)
+            draw.add_tickets(self.other, 1)
+
+        self.assertEqual(self._list_queries(), few)
+        draws = {draw['draw_name']: draw for draw in self.client.get(reverse('active-global-draw-list')).json()['data']}
+        self.assertEqual((draws['Global 3']['entry_count'], draws['Global 3']['user_entry_count']), (5, 4))
+        self.assertEqual(draws['Global 3']['user_ticket_ids'], [1, 2, 3, 4])
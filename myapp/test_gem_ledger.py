@@ -0,0 +1,84 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from myapp.gem_service import get_gem_balance, reconcile_gem_ledger
+from myapp.models import CustomUser, Gem, GemTransaction
+from myapp.utils import add_manual_gem
+
+
+class GemLedgerTests(APITestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='gems@test.com',
+            email='gems@test.com',
+            password='testpass123',
+        )
+        self.client.force_authenticate(user=self.user)
+        self.today = timezone.now().date()
+
+    def test_earning_updates_balance_and_ledger(self):
+        gem = Gem.objects.create(user=self.user, date=self.today, xp_gem=2)
+        gem.xp_gem = 3
+        gem.save()
+        add_manual_gem(self.user, 10, self.today)
+
+        self.assertEqual(get_gem_balance(self.user), 13)
+        self.assertEqual(list(GemTransaction.objects.filter(user=self.user).order_by('id')
+                              .values_list('kind', 'amount', 'balance_after')),
+                         [('xp', 2, 2), ('xp', 1, 3), ('manual', 10, 13)])
+        self.assertEqual(reconcile_gem_ledger(), [])
+
+    def test_saves_of_stale_copies_keep_balance_in_step_with_rows(self):
+        Gem.objects.create(user=self.user, date=self.today, xp_gem=2, manual_gem=1)
+        first = Gem.objects.get(user=self.user, date=self.today)
+        second = Gem.objects.get(user=self.user, date=self.today)
+
+        first.xp_gem = 3
+        first.save()
+        # Loaded before the first save: its old values are stale
+        second.xp_gem = 4
+        second.save()
+        third = Gem.objects.get(user=self.user, date=self.today)
+        first.manual_gem = 6
+        first.save()
+
+        third.refresh_from_db()
+        self.assertEqual((third.xp_gem, third.manual_gem), (4, 6))
+        self.assertEqual(get_gem_balance(self.user), 10)
+        self.assertEqual(reconcile_gem_ledger(), [])
+
+    def test_conversion_spends_through_ledger(self):
+        add_manual_gem(self.user, 5, self.today)
+        # A stale in-memory copy must not overwrite the maintained balance
+        self.user.bio = 'Runner'
+        self.user.save()
+
+        response = self.client.post(reverse('convert-gem'), {'item_type': 'streak_saver', 'quantity': 2},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['data']['remaining_gem'], 1)
+
+        response = self.client.post(reverse('convert-gem'), {'item_type': 'streak_saver', 'quantity': 1},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.gem_balance, self.user.gems_spent, self.user.streak_savers), (1, 4, 2))
+        self.assertEqual(reconcile_gem_ledger(), [])
+
+    def test_reconcile_detects_and_fixes_drift(self):
+        add_manual_gem(self.user, 6, self.today)
+        CustomUser.objects.filter(pk=self.user.pk).update(gems_spent=2, gem_balance=4)
+
+        # gems_spent was changed behind the ledger's back
+        mismatches = reconcile_gem_ledger()
+        self.assertEqual(mismatches, [{'user_id': self.user.id, 'expected': 4, 'balance': 4, 'ledger': 6}])
+
+        call_command('reconcile_gem_ledger', '--fix', stdout=StringIO())
+        self.assertEqual(reconcile_gem_ledger(), [])
+
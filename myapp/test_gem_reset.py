@@ -0,0 +1,48 @@
+from datetime import date, datetime, timezone as dt_timezone
+from unittest.mock import patch
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from myapp.gem_service import reset_weekly_gems, reconcile_gem_ledger
+from myapp.models import CustomUser, Gem
+from myapp.utils import add_manual_gem
+
+
+class WeeklyGemResetTests(TestCase):
+    def setUp(self):
+        # Monday 00:10 in UTC, still Sunday evening in New York
+        self.now = datetime(2024, 6, 10, 0, 10, tzinfo=dt_timezone.utc)
+        self.sunday = date(2024, 6, 9)
+
+    def _user(self, name, tz='UTC', gems=0):
+        user = CustomUser.objects.create_user(username=name, email=f'{name}@test.com', password='testpass123',
+                                              timezone=tz)
+        if gems:
+            add_manual_gem(user, gems, date(2024, 6, 5))
+        return user
+
+    @patch('myapp.tasks.send_gem_update.delay')
+    def test_resets_only_users_due(self, send_gem_update):
+        due = self._user('due', gems=7)
+        self._user('empty')
+        later = self._user('later', tz='America/New_York', gems=4)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(reset_weekly_gems(now=self.now), 1)
+
+        self.assertLess(len(queries), 15)
+        due.refresh_from_db()
+        later.refresh_from_db()
+        self.assertEqual((due.gem_balance, due.gems_spent), (0, 0))
+        self.assertEqual(later.gem_balance, 4)
+        self.assertTrue(Gem.objects.filter(user=due, date=self.sunday).exists())
+        self.assertEqual(reconcile_gem_ledger(), [])
+        send_gem_update.assert_called_once_with(
+            [{'user_id': due.id, 'gem_count': 0, 'channel_name': f'gem_{due.id}'}]
+        )
+
+        # A second run within the hour has nobody left to reset
+        self.assertEqual(reset_weekly_gems(now=self.now), 0)
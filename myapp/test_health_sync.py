@@ -0,0 +1,123 @@
+from datetime import timedelta
+
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from myapp.models import CustomUser, DailySteps, WorkoutActivity, Xp, Streak, League, UserLeague
+
+
+class HealthSyncViewTests(APITestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='sync@test.com',
+            email='sync@test.com',
+            password='testpass123',
+        )
+        self.user.date_joined = timezone.now() - timedelta(days=10)
+        self.user.save()
+        League.objects.create(name="Pathfinder league", order=1)
+
+        self.today = timezone.now().date()
+        self.yesterday = self.today - timedelta(days=1)
+        self.url = reverse('health-sync')
+        self.client.force_authenticate(user=self.user)
+
+    def _ts(self, day, hour=12):
+        return f"{day.isoformat()}T{hour:02d}:00:00"
+
+    def test_batch_writes_steps_and_workouts(self):
+        response = self.client.post(self.url, {
+            'steps': [
+                {'step_count': 3000, 'timestamp': self._ts(self.yesterday)},
+                {'step_count': 1000, 'timestamp': self._ts(self.today, 9)},
+                {'step_count': 1500, 'timestamp': self._ts(self.today, 10)},
+            ],
+            'workouts': [{
+                'duration': 45,
+                'activity_type': 'movement',
+                'activity_name': 'Running',
+                'average_heart_rate': 130,
+                'start_datetime': self._ts(self.today, 11),
+                'end_datetime': self._ts(self.today, 12),
+            }],
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()['data']
+        self.assertEqual([r['status'] for r in data['steps']], ['created', 'superseded', 'created'])
+        self.assertEqual(data['workouts'][0]['status'], 'created')
+        self.assertEqual(data['workouts'][0]['xp'], 190)
+
+        self.assertEqual(DailySteps.objects.get(user=self.user, date=self.today).step_count, 1500)
+        self.assertEqual(WorkoutActivity.objects.filter(user=self.user).count(), 1)
+
+        # One XP row per applied item, with running totals per day
+        self.assertEqual(Xp.objects.filter(user=self.user).count(), 3)
+        last_today = Xp.objects.filter(user=self.user, date=self.today).order_by('-id').first()
+        self.assertEqual(last_today.totalXpToday, 340)
+        self.assertEqual(last_today.totalXpAllTime, 640)
+
+        # Yesterday crossed the streak threshold, and the league placement ran once
+        self.assertTrue(Streak.objects.filter(user=self.user, date=self.yesterday).exists())
+        self.assertEqual(UserLeague.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(data['xp']['totalXpAllTime'], 640)
+
+    def test_replayed_items_are_reported_not_duplicated(self):
+        payload = {
+            'steps': [{'step_count': 2000, 'timestamp': self._ts(self.today)}],
+            'workouts': [{
+                'duration': 30,
+                'activity_type': 'movement',
+                'activity_name': 'Walking',
+                'start_datetime': self._ts(self.today, 8),
+                'end_datetime': self._ts(self.today, 9),
+            }],
+        }
+        self.client.post(self.url, payload, format='json')
+        response = self.client.post(self.url, payload, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()['data']
+        self.assertEqual(data['steps'][0]['status'], 'unchanged')
+        self.assertEqual(data['workouts'][0]['status'], 'duplicate')
+        self.assertEqual(Xp.objects.filter(user=self.user).count(), 2)
+
+    def test_workouts_are_duplicates_only_when_start_and_end_match(self):
+        workout = {
+            'duration': 30,
+            'activity_type': 'movement',
+            'activity_name': 'Walking',
+            'start_datetime': self._ts(self.today, 8),
+            'end_datetime': self._ts(self.today, 9),
+        }
+        self.client.post(self.url, {'workouts': [workout]}, format='json')
+        response = self.client.post(self.url, {'workouts': [
+            dict(workout, duration=60, end_datetime=self._ts(self.today, 10)),
+            workout,
+        ]}, format='json')
+
+        data = response.json()['data']
+        self.assertEqual([r['status'] for r in data['workouts']], ['created', 'duplicate'])
+        self.assertEqual(data['workouts'][1]['detail'],
+                         "A workout with the same start and end times already exists for this day.")
+        self.assertEqual(WorkoutActivity.objects.filter(user=self.user).count(), 2)
+
+    def test_invalid_items_do_not_block_valid_ones(self):
+        response = self.client.post(self.url, {
+            'steps': [
+                {'step_count': -5, 'timestamp': self._ts(self.today)},
+                {'step_count': 500, 'timestamp': self._ts(self.today)},
+            ],
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()['data']
+        self.assertEqual(data['steps'][0]['status'], 'invalid')
+        self.assertIn('step_count', data['steps'][0]['errors'])
+        self.assertEqual(data['steps'][1]['status'], 'created')
+
+    def test_empty_sync_is_rejected(self):
+        response = self.client.post(self.url, {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,79 @@
+from datetime import timedelta
+
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from myapp.models import CustomUser, DailySteps, WorkoutActivity, Xp, IngestionReceipt
+from myapp.idempotency import purge_ingestion_receipts
+
+
+class IdempotentIngestionTests(APITestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='retry@test.com',
+            email='retry@test.com',
+            password='testpass123',
+        )
+        self.client.force_authenticate(user=self.user)
+        self.timestamp = timezone.now().strftime("%Y-%m-%dT%H:%M:%S")
+
+    def test_replayed_steps_return_original_result(self):
+        url = reverse('daily-steps')
+        payload = {'step_count': 1200, 'timestamp': self.timestamp}
+
+        first = self.client.post(url, payload, format='json', HTTP_IDEMPOTENCY_KEY='steps-1')
+        second = self.client.post(url, payload, format='json', HTTP_IDEMPOTENCY_KEY='steps-1')
+
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.json()['data'], first.json()['data'])
+        self.assertEqual(Xp.objects.filter(user=self.user).count(), 1)
+
+    def test_replayed_workout_with_body_key_is_not_reapplied(self):
+        url = reverse('workout')
+        start = timezone.now() - timedelta(hours=1)
+        payload = {
+            'sync_key': 'workout-1',
+            'duration': 30,
+            'activity_type': 'movement',
+            'activity_name': 'Running',
+            'start_datetime': start.isoformat(),
+            'end_datetime': timezone.now().isoformat(),
+        }
+
+        self.client.post(url, payload, format='json')
+        response = self.client.post(url, payload, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(WorkoutActivity.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(Xp.objects.filter(user=self.user).count(), 1)
+
+    def test_failed_request_does_not_claim_key(self):
+        url = reverse('daily-steps')
+        response = self.client.post(url, {'step_count': -1, 'timestamp': self.timestamp},
+                                    format='json', HTTP_IDEMPOTENCY_KEY='steps-2')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(IngestionReceipt.objects.filter(user=self.user).exists())
+
+        response = self.client.post(url, {'step_count': 10, 'timestamp': self.timestamp},
+                                    format='json', HTTP_IDEMPOTENCY_KEY='steps-2')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(DailySteps.objects.get(user=self.user).step_count, 10)
+
+    def test_key_reused_on_another_endpoint_conflicts(self):
+        self.client.post(reverse('daily-steps'), {'step_count': 100, 'timestamp': self.timestamp},
+                         format='json', HTTP_IDEMPOTENCY_KEY='shared')
+        response = self.client.post(reverse('health-sync'),
+                                    {'steps': [{'step_count': 200, 'timestamp': self.timestamp}]},
+                                    format='json', HTTP_IDEMPOTENCY_KEY='shared')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_purge_removes_expired_receipts(self):
+        old = IngestionReceipt.objects.create(user=self.user, sync_key='old', endpoint='workout')
+        IngestionReceipt.objects.filter(pk=old.pk).update(created_at=timezone.now() - timedelta(days=30))
+        IngestionReceipt.objects.create(user=self.user, sync_key='new', endpoint='workout')
+
+        self.assertEqual(purge_ingestion_receipts(retention_days=7), 1)
+        self.assertEqual(list(IngestionReceipt.objects.values_list('sync_key', flat=True)), ['new'])
@@ -0,0 +1,92 @@
+import threading
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from myapp.league_service import place_users, sync_participant_counts
+from myapp.models import CustomUser, League, LeagueInstance, UserLeague
+
+
+def _users(count, prefix='a'):
+    return [
+        CustomUser.objects.create_user(username=f'{prefix}{i}', email=f'{prefix}{i}@test.com', password='testpass123')
+        for i in range(count)
+    ]
+
+
+class PlaceUsersTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.league = League.objects.create(name='Pathfinder league', order=1)
+
+    def _instance(self, max_participants):
+        return LeagueInstance.objects.create(league=self.league, league_start=self.now,
+                                             league_end=self.now + timedelta(days=1), max_participants=max_participants)
+
+    def test_fills_open_instances_then_creates_new_ones(self):
+        instance = self._instance(3)
+        UserLeague.objects.create(user=_users(1, 'x')[0], league_instance=instance)
+        users = _users(14)
+
+        assigned = place_users({(self.league.id, None): [user.id for user in users]})
+
+        self.assertEqual(len(assigned), 14)
+        instance.refresh_from_db()
+        self.assertEqual(instance.participant_count, 3)
+        counts = sorted(LeagueInstance.objects.exclude(id=instance.id).values_list('participant_count', flat=True))
+        self.assertEqual(counts, [2, 10])
+        self.assertEqual(sync_participant_counts(), 0)
+
+    def test_existing_member_is_not_placed_twice(self):
+        instance = self._instance(5)
+        user = _users(1)[0]
+        UserLeague.objects.create(user=user, league_instance=instance)
+
+        self.assertEqual(place_users({(self.league.id, None): [user.id]}), {user.id: instance.id})
+        instance.refresh_from_db()
+        self.assertEqual(instance.participant_count, 1)
+
+    def test_counter_follows_memberships_and_sync_repairs_drift(self):
+        instance = self._instance(5)
+        memberships = [UserLeague.objects.create(user=user, league_instance=instance) for user in _users(3)]
+        memberships[0].delete()
+        instance.refresh_from_db()
+        self.assertEqual(instance.participant_count, 2)
+
+        LeagueInstance.objects.filter(id=instance.id).update(participant_count=9)
+        self.assertEqual(sync_participant_counts(), 1)
+        instance.refresh_from_db()
+        self.assertEqual(instance.participant_count, 2)
+
+
+class ConcurrentPlacementTests(TransactionTestCase):
+    def test_instance_locked_by_another_worker_is_not_overfilled(self):
+        now = timezone.now()
+        league = League.objects.create(name='Pathfinder league', order=1)
+        busy = LeagueInstance.objects.create(league=league, league_start=now, league_end=now + timedelta(days=1),
+                                             max_participants=10)
+        users = _users(3)
+        locked, release = threading.Event(), threading.Event()
+
+        def other_worker():
+            try:
+                with transaction.atomic():
+                    LeagueInstance.objects.select_for_update().get(id=busy.id)
+                    locked.set()
+                    release.wait(timeout=10)
+            finally:
+                connection.close()
+
+        worker = threading.Thread(target=other_worker)
+        worker.start()
+        locked.wait(timeout=10)
+        try:
+            assigned = place_users({(league.id, None): [user.id for user in users]})
+        finally:
+            release.set()
+            worker.join()
+
+        self.assertNotIn(busy.id, assigned.values())
+        self.assertEqual(LeagueInstance.objects.get(id=busy.id).participant_count, 0)
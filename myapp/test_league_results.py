@@ -0,0 +1,93 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from myapp.league_service import settle_expired_leagues
+from myapp.models import Company, CustomUser, League, LeagueInstance, LeagueResult, UserLeague
+
+
+@patch('myapp.tasks.send_gem_update.delay')
+@patch('myapp.tasks.send_next_league_update.delay')
+@patch('myapp.tasks.send_status_update.delay')
+class LeagueResultTests(APITestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.leagues = {order: League.objects.create(name=f'League {order}', order=order) for order in range(1, 11)}
+        self.users = [
+            CustomUser.objects.create_user(username=f'res{i}', email=f'res{i}@test.com', password='testpass123')
+            for i in range(5)
+        ]
+        self.client.force_authenticate(user=self.users[0])
+
+    def _settle(self, order, end, company=None):
+        # Each call settles a fresh week; the placements of the previous one are not part of it
+        LeagueInstance.objects.filter(is_active=True).update(is_active=False)
+        instance = LeagueInstance.objects.create(
+            league=self.leagues[order], company=company, league_start=end - timedelta(days=7), league_end=end,
+        )
+        field = 'xp_company' if company else 'xp_global'
+        for i, user in enumerate(self.users):
+            UserLeague.objects.create(user=user, league_instance=instance, **{field: 50 - i * 10})
+        settle_expired_leagues(company=company is not None, now=end + timedelta(minutes=1))
+        return instance
+
+    def test_settlement_records_final_standings(self, *mocks):
+        instance = self._settle(5, self.now - timedelta(minutes=5))
+
+        results = list(LeagueResult.objects.filter(league_instance=instance).order_by('rank'))
+        self.assertEqual([r.user_id for r in results], [user.id for user in self.users])
+        self.assertEqual([r.status for r in results], ['Promoted', 'Retained', 'Retained', 'Retained', 'Demoted'])
+        self.assertEqual([r.xp for r in results], [50, 40, 30, 20, 10])
+        self.assertEqual(results[0].gems_obtained, 20)
+        self.assertEqual({(r.participants, r.league_id, r.company_id) for r in results},
+                         {(5, self.leagues[5].id, None)})
+
+    def test_status_is_the_latest_result(self, *mocks):
+        self._settle(5, self.now - timedelta(days=7, minutes=5))
+        latest = self._settle(6, self.now - timedelta(minutes=5))
+
+        response = self.client.get(reverse('custom-user-league-status'))
+
+        data = response.json()['data']
+        self.assertEqual((data['league_id'], data['league_level'], data['rank']), (latest.id, 5, 1))
+        self.assertEqual(data['status'], 'Promoted')
+        self.assertEqual(data['league_end'], latest.league_end.isoformat(timespec='milliseconds') + 'Z')
+        self.assertEqual(self.client.get(reverse('custom-user-company-league-status')).status_code, 404)
+
+    def test_status_before_results_were_recorded_is_computed(self, *mocks):
+        # Settled before settlement wrote LeagueResult rows: only the memberships remain
+        previous = LeagueInstance.objects.create(
+            league=self.leagues[5], league_start=self.now - timedelta(days=14),
+            league_end=self.now - timedelta(days=7), is_active=False,
+        )
+        current = LeagueInstance.objects.create(
+            league=self.leagues[6], league_start=self.now - timedelta(days=7), league_end=self.now + timedelta(days=1),
+        )
+        for i, user in enumerate(self.users):
+            UserLeague.objects.create(user=user, league_instance=previous, xp_global=10 + i * 10)
+        UserLeague.objects.create(user=self.users[0], league_instance=current)
+
+        response = self.client.get(reverse('custom-user-league-status'))
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()['data']
+        self.assertEqual((data['league_id'], data['rank'], data['status']), (previous.id, 5, 'Demoted'))
+        self.assertEqual(self.client.get(reverse('custom-user-company-league-status')).status_code, 404)
+
+    def test_history_is_paginated_and_filtered(self, *mocks):
+        owner = CustomUser.objects.create_user(username='owner', email='owner@co.com', password='testpass123')
+        company = Company.objects.create(name='History Co', owner=owner, domain='co.com')
+        for weeks in (3, 2, 1):
+            self._settle(5, self.now - timedelta(weeks=weeks))
+        self._settle(1, self.now - timedelta(minutes=5), company=company)
+
+        data = self.client.get(reverse('league-history'), {'page_size': 2}).json()['data']
+        self.assertEqual(data['count'], 4)
+        self.assertEqual([r['league_type'] for r in data['results']], ['company', 'global'])
+
+        data = self.client.get(reverse('league-history'), {'league_type': 'global'}).json()['data']
+        self.assertEqual(data['count'], 3)
+        self.assertEqual(self.client.get(reverse('league-history'), {'league_type': 'x'}).status_code, 400)
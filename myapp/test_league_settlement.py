@@ -0,0 +1,214 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from myapp.consumers import league_update_for
+from myapp.gem_service import reconcile_gem_ledger
+from myapp.league_service import (
+    decide_outcome, settle_expired_leagues, settle_league_instances, settlement_shares,
+)
+from myapp.models import Company, CustomUser, League, LeagueInstance, LeagueResult, Notif, UserLeague
+from myapp.tasks import process_company_league_promotions, process_league_promotions, send_next_league_update
+
+
+class DecideOutcomeTests(TestCase):
+    def test_thresholds_and_rewards(self):
+        outcomes = [decide_outcome(rank, 10, 100, False, False) for rank in range(1, 11)]
+        self.assertEqual(outcomes[:3], [('promote', 20), ('promote', 18), ('promote', 16)])
+        self.assertEqual(set(outcomes[3:8]), {('retain', 10)})
+        self.assertEqual(outcomes[8:], [('demote', 0), ('demote', 0)])
+
+    def test_edge_leagues_and_small_instances(self):
+        self.assertEqual(decide_outcome(10, 10, 100, True, False), ('demote', 0))
+        self.assertEqual(decide_outcome(10, 10, 0, False, True), ('retain', 0))
+        self.assertEqual(decide_outcome(1, 3, 0, False, False), ('demote', 0))
+        self.assertEqual(decide_outcome(1, 3, 5, True, True), ('retain', 10))
+
+
+@patch('myapp.tasks.send_gem_update.delay')
+@patch('myapp.tasks.send_next_league_update.delay')
+@patch('myapp.tasks.send_status_update.delay')
+class SettleExpiredLeaguesTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.leagues = {
+            order: League.objects.create(name=f'League {order}', order=order) for order in range(1, 11)
+        }
+
+    def _expired_instance(self, order, xps, company=None):
+        instance = LeagueInstance.objects.create(
+            league=self.leagues[order], company=company, league_start=self.now - timedelta(days=7),
+            league_end=self.now - timedelta(minutes=1), max_participants=30,
+        )
+        users = []
+        for xp in xps:
+            n = CustomUser.objects.count()
+            user = CustomUser.objects.create_user(username=f'u{n}', email=f'u{n}@test.com', password='testpass123',
+                                                  company=company)
+            field = 'xp_company' if company else 'xp_global'
+            UserLeague.objects.create(user=user, league_instance=instance, **{field: xp})
+            users.append(user)
+        return instance, users
+
+    def _active_order(self, user, company=None):
+        return UserLeague.objects.get(
+            user=user, league_instance__is_active=True, league_instance__company=company
+        ).league_instance.league.order
+
+    def test_global_settlement_moves_rewards_and_notifies(self, status_update, next_update, gem_update):
+        instance, users = self._expired_instance(5, [100 - i for i in range(10)])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            report = settle_expired_leagues(now=self.now)
+
+        self.assertEqual(report, {'instances': 1, 'participants': 10, 'promote': 3, 'retain': 5, 'demote': 2})
+        self.assertEqual([self._active_order(user) for user in users], [6] * 3 + [5] * 5 + [4] * 2)
+        balances = [user.get_gem_count() for user in users]
+        self.assertEqual(balances, [20, 18, 16] + [10] * 5 + [0, 0])
+        self.assertEqual(reconcile_gem_ledger(), [])
+        self.assertEqual(Notif.objects.filter(notif_type='league_promotion').count(), 3)
+        self.assertEqual(Notif.objects.filter(notif_type='league_demotion').count(), 2)
+
+        instance.refresh_from_db()
+        self.assertFalse(instance.is_active)
+        self.assertFalse(UserLeague.objects.filter(league_instance=instance, xp_global__gt=0).exists())
+        # The five retained users fit in one new instance
+        self.assertEqual(LeagueInstance.objects.filter(league=self.leagues[5], is_active=True).count(), 1)
+
+        status_update.assert_called_once()
+        next_update.assert_called_once_with(instance.id)
+        self.assertEqual(gem_update.call_args[0][0][0]['gem_count'], 20)
+
+        # Already settled instances are not picked up again
+        self.assertEqual(settle_expired_leagues(now=self.now)['instances'], 0)
+
+    def test_fills_open_instances_before_creating_new_ones(self, *mocks):
+        open_instance = LeagueInstance.objects.create(
+            league=self.leagues[5], league_start=self.now, league_end=self.now + timedelta(days=1),
+            max_participants=4,
+        )
+        _, users = self._expired_instance(5, [50, 40, 30, 20, 10])
+        # A 5-user middle league: one promoted, three retained, one demoted
+        settle_expired_leagues(now=self.now)
+
+        retained = UserLeague.objects.filter(league_instance=open_instance).values_list('user_id', flat=True)
+        self.assertEqual(sorted(retained), sorted(user.id for user in users[1:4]))
+
+    def test_query_count_does_not_grow_with_participants(self, *mocks):
+        self._expired_instance(5, range(10))
+        with CaptureQueriesContext(connection) as small:
+            settle_expired_leagues(now=self.now)
+
+        # Target leagues without open instances, as in the first run
+        self._expired_instance(8, range(30))
+        self._expired_instance(8, range(20))
+        with CaptureQueriesContext(connection) as large:
+            settle_expired_leagues(now=self.now)
+
+        self.assertEqual(len(small), len(large))
+
+    def test_company_settlement_caps_promotion_at_company_level(self, *mocks):
+        owner = CustomUser.objects.create_user(username='owner', email='owner@co.com', password='testpass123')
+        company = Company.objects.create(name='Settle Co', owner=owner, domain='co.com')
+        # Two active instances make order 1 the lowest and order 2 the highest company league
+        LeagueInstance.objects.create(league=self.leagues[2], company=company, league_start=self.now,
+                                      league_end=self.now + timedelta(days=1))
+        _, users = self._expired_instance(1, [30, 20, 10, 5, 0], company=company)
+        # Five members allow a single company league level, so the promoted user stays
+        settle_expired_leagues(company=True, now=self.now)
+
+        self.assertEqual([self._active_order(user, company) for user in users], [1] * 5)
+        self.assertEqual(users[0].get_gem_count(), 20)
+        self.assertEqual(users[4].get_gem_count(), 0)
+
+    def test_shares_are_per_instance_or_per_company(self, *mocks):
+        owner = CustomUser.objects.create_user(username='owner', email='owner@co.com', password='testpass123')
+        company = Company.objects.create(name='Share Co', owner=owner, domain='co.com')
+        first, _ = self._expired_instance(5, [10])
+        second, _ = self._expired_instance(6, [10])
+        company_instances = [self._expired_instance(order, [10], company=company)[0] for order in (1, 2)]
+
+        self.assertEqual(settlement_shares(now=self.now), [[first.id], [second.id]])
+        self.assertEqual(settlement_shares(company=True, now=self.now), [[i.id for i in company_instances]])
+
+    def test_repeated_instance_settlement_is_harmless(self, *mocks):
+        instance, users = self._expired_instance(5, [50, 40, 30, 20, 10])
+
+        report = settle_league_instances([instance.id], now=self.now)
+        self.assertEqual((report['instances'], report['participants']), (1, 5))
+        instance.refresh_from_db()
+        self.assertIsNotNone(instance.settled_at)
+
+        # A redelivered task finds the instance settled
+        self.assertEqual(settle_league_instances([instance.id], now=self.now)['instances'], 0)
+        self.assertEqual(LeagueResult.objects.filter(league_instance=instance).count(), 5)
+        self.assertEqual(users[0].get_gem_count(), 20)
+
+    def test_tasks_fan_out_one_share_per_task(self, *mocks):
+        instances = [self._expired_instance(order, [10, 5])[0] for order in (4, 5)]
+
+        with patch('myapp.tasks.group') as group:
+            process_league_promotions.apply()
+            process_company_league_promotions.apply()
+
+        signatures = list(group.call_args_list[0][0][0])
+        self.assertEqual(group.call_count, 1)
+        self.assertEqual([signature.args for signature in signatures], [([i.id],) for i in instances])
+        for signature in signatures:
+            signature.apply()
+        self.assertFalse(LeagueInstance.objects.filter(id__in=[i.id for i in instances], is_active=True).exists())
+
+
+    def test_next_league_update_is_sent_once_per_destination(self, *mocks):
+        instance, users = self._expired_instance(5, [100 - i for i in range(10)])
+        settle_expired_leagues(now=self.now)
+
+        sent = []
+
+        class Layer:
+            async def group_send(self, group, message):
+                sent.append((group, message))
+
+        with patch('myapp.tasks.get_channel_layer', return_value=Layer()):
+            send_next_league_update(instance.id)
+
+        # Promoted, retained and demoted users each landed in one new instance
+        self.assertEqual(len(sent), 3)
+        self.assertEqual({group for group, _ in sent}, {f'global_league_{instance.id}'})
+        by_level = {message['data']['league_level']: message for _, message in sent}
+        self.assertEqual(sorted(by_level), [5, 6, 7])
+
+        promoted = by_level[5]
+        self.assertEqual(promoted['user_ranks'], {str(user.id): rank for rank, user in enumerate(users[:3], start=1)})
+        self.assertEqual([entry['gems_obtained'] for entry in promoted['data']['rankings']], [20, 18, 16])
+        self.assertEqual({entry['advancement'] for entry in promoted['data']['rankings']}, {'TBD'})
+        self.assertEqual(len(by_level[6]['user_ranks']), 5)
+        self.assertEqual(len(by_level[7]['user_ranks']), 2)
+
+        # Each socket only gets its own destination, in the usual payload with its user_rank
+        self.assertEqual(league_update_for(promoted, users[1].id), dict(promoted['data'], user_rank=2))
+        self.assertIsNone(league_update_for(promoted, users[9].id))
+        self.assertEqual(league_update_for({'data': {'rankings': []}}, users[9].id), {'rankings': []})
+
+    def test_next_league_update_accepts_legacy_arguments(self, *mocks):
+        instance, users = self._expired_instance(5, [100 - i for i in range(10)])
+        settle_expired_leagues(now=self.now)
+        gems_data = [{'user_id': user.id, 'gems_obtained': 7} for user in users[:3]]
+
+        sent = []
+
+        class Layer:
+            async def group_send(self, group, message):
+                sent.append((group, message))
+
+        with patch('myapp.tasks.get_channel_layer', return_value=Layer()):
+            send_next_league_update([user.id for user in users], instance.id, gems_data)
+
+        self.assertEqual(len(sent), 3)
+        by_level = {message['data']['league_level']: message for _, message in sent}
+        self.assertEqual([entry['gems_obtained'] for entry in by_level[5]['data']['rankings']], [7, 7, 7])
+        self.assertEqual(len(by_level[7]['user_ranks']), 2)
@@ -0,0 +1,132 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from myapp import live_leaderboard
+from myapp.league_service import settle_expired_leagues
+from myapp.live_leaderboard import (
+    LocalLeaderboard, add_league_xp, checkpoint_leaderboards, live_around, live_rank, live_top,
+)
+from myapp.models import CustomUser, League, LeagueInstance, UserLeague
+from myapp.ranking_service import get_ranking_snapshot
+
+
+@override_settings(LEAGUE_XP_MODE='live', LEADERBOARD_BACKEND='local')
+class LiveLeaderboardTests(TestCase):
+    def setUp(self):
+        patcher = patch.object(live_leaderboard, '_leaderboard', LocalLeaderboard())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('myapp.websocket_signals.broadcast_global_league_ranking_update')
+        self.broadcast = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.now = timezone.now()
+        self.league = League.objects.create(name='League 5', order=5)
+        self.instance = self._instance(self.now + timedelta(days=1))
+        self.memberships = self._members(self.instance, [50, 40, 30, 20, 10])
+
+    def _instance(self, league_end):
+        return LeagueInstance.objects.create(league=self.league, league_start=self.now - timedelta(days=7),
+                                             league_end=league_end)
+
+    def _members(self, instance, xps):
+        memberships = []
+        for xp in xps:
+            n = CustomUser.objects.count()
+            user = CustomUser.objects.create_user(username=f'live{n}', email=f'live{n}@test.com',
+                                                  password='testpass123')
+            memberships.append(UserLeague.objects.create(user=user, league_instance=instance, xp_global=xp))
+        return memberships
+
+    def _add(self, membership, xp):
+        with self.captureOnCommitCallbacks(execute=True):
+            add_league_xp(membership, xp)
+
+    def test_queries_follow_increments_before_any_write(self):
+        last = self.memberships[4]
+        self.assertEqual(live_rank(self.instance, last.user_id), 5)
+
+        self._add(last, 35.7)
+
+        self.assertEqual(live_rank(self.instance, last.user_id), 2)
+        self.assertEqual(live_top(self.instance, 2), [
+            {'rank': 1, 'user_id': self.memberships[0].user_id, 'xp': 50},
+            {'rank': 2, 'user_id': last.user_id, 'xp': 45},
+        ])
+        self.assertEqual([entry['rank'] for entry in live_around(self.instance, last.user_id, radius=1)], [1, 2, 3])
+        self.assertEqual(live_around(self.instance, -1), [])
+        last.refresh_from_db()
+        self.assertEqual(last.xp_global, 10)
+
+    def test_active_league_view_ranks_live_xp(self):
+        last = self.memberships[4]
+        self._add(last, 35)
+
+        client = APIClient()
+        client.force_authenticate(user=last.user)
+        data = client.get(reverse('global-active-league')).json()['data']
+
+        self.assertEqual(data['user_rank'], 2)
+        self.assertEqual([(entry['user_id'], entry['xp'], entry['rank']) for entry in data['rankings'][:3]], [
+            (self.memberships[0].user_id, 50, 1),
+            (last.user_id, 45, 2),
+            (self.memberships[1].user_id, 40, 3),
+        ])
+
+    def test_increment_is_broadcast_after_it_lands(self):
+        last = self.memberships[4]
+        self.broadcast.side_effect = lambda user, instance: self.assertEqual(
+            [entry['user_id'] for entry in get_ranking_snapshot(instance)['rankings']][0], user.id)
+
+        self._add(last, 100)
+
+        self.broadcast.assert_called_once_with(last.user, self.instance)
+
+    def test_checkpoint_writes_pending_xp_once(self):
+        self._add(self.memberships[4], 45)
+        self._add(self.memberships[3], 5)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            result = checkpoint_leaderboards()
+
+        self.assertEqual(result, {'instances': 1, 'memberships': 2, 'discarded': 0})
+        xps = UserLeague.objects.filter(league_instance=self.instance).order_by('id').values_list('xp_global', flat=True)
+        self.assertEqual(list(xps), [50, 40, 30, 25, 55])
+        self.assertEqual(checkpoint_leaderboards()['instances'], 0)
+        self.assertEqual(live_rank(self.instance, self.memberships[4].user_id), 1)
+
+    def test_failed_checkpoint_keeps_xp_pending(self):
+        self._add(self.memberships[4], 45)
+
+        with patch('myapp.live_leaderboard.invalidate_ranking_snapshots', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                checkpoint_leaderboards()
+
+        self.memberships[4].refresh_from_db()
+        self.assertEqual(self.memberships[4].xp_global, 10)
+        self.assertEqual(checkpoint_leaderboards()['memberships'], 1)
+        self.memberships[4].refresh_from_db()
+        self.assertEqual(self.memberships[4].xp_global, 55)
+
+    @patch('myapp.tasks.send_gem_update.delay')
+    @patch('myapp.tasks.send_next_league_update.delay')
+    @patch('myapp.tasks.send_status_update.delay')
+    def test_settlement_ranks_checkpointed_xp(self, *mocks):
+        for order in (4, 6):
+            League.objects.create(name=f'League {order}', order=order)
+        expired = self._instance(self.now - timedelta(minutes=1))
+        memberships = self._members(expired, [50, 40, 30, 20, 10])
+        self._add(memberships[4], 100)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            settle_expired_leagues(now=self.now)
+
+        # The live leader is the one promoted user of a 5-member league
+        promoted = UserLeague.objects.get(league_instance__is_active=True, league_instance__league__order=6)
+        self.assertEqual(promoted.user_id, memberships[4].user_id)
+        self.assertNotIn(expired.id, live_leaderboard.get_leaderboard().dirty())
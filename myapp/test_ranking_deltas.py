@@ -0,0 +1,151 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.core.cache import caches
+from django.test import TestCase
+from django.utils import timezone
+
+from myapp.consumers import wants_ranking_deltas
+from myapp.models import CustomUser, League, LeagueInstance, UserLeague
+from myapp import ranking_service
+from myapp.ranking_service import publish_rankings, published_rankings, ranking_changes
+from myapp.websocket_signals import _broadcast_ranking_delta
+
+
+class RankingDeltaTests(TestCase):
+    def setUp(self):
+        caches['rankings'].clear()
+        now = timezone.now()
+        league = League.objects.create(name='League 5', order=5)
+        self.instance = LeagueInstance.objects.create(
+            league=league, league_start=now - timedelta(days=1), league_end=now + timedelta(days=1),
+        )
+        self.memberships = []
+        for i, xp in enumerate([30, 20, 10]):
+            user = CustomUser.objects.create_user(username=f'delta{i}', email=f'delta{i}@test.com',
+                                                  password='testpass123')
+            self.memberships.append(UserLeague.objects.create(user=user, league_instance=self.instance, xp_global=xp))
+
+    def _set_xp(self, membership, xp):
+        with self.captureOnCommitCallbacks(execute=True):
+            membership.xp_global = xp
+            membership.save()
+
+    def _apply(self, rankings, delta):
+        entries = {entry['user_id']: dict(entry) for entry in rankings}
+        for user_id in delta['removed']:
+            entries.pop(user_id, None)
+        for change in delta['changes']:
+            entries.setdefault(change['user_id'], {}).update(change)
+        return sorted(entries.values(), key=lambda entry: entry['rank'])
+
+    def test_changes_hold_only_changed_fields(self):
+        previous = {'rankings': [{'user_id': 1, 'xp': 5, 'rank': 1}, {'user_id': 2, 'xp': 3, 'rank': 2}]}
+        current = {'rankings': [{'user_id': 3, 'xp': 9, 'rank': 1}, {'user_id': 1, 'xp': 5, 'rank': 2}]}
+
+        changes, removed = ranking_changes(previous, current)
+
+        self.assertEqual(changes, [{'user_id': 3, 'xp': 9, 'rank': 1}, {'user_id': 1, 'rank': 2}])
+        self.assertEqual(removed, [2])
+
+    def test_publish_sequences_deltas_onto_the_snapshot(self):
+        first = publish_rankings(self.instance)
+        self.assertEqual(first['type'], 'rankings_snapshot')
+        self.assertIsNone(publish_rankings(self.instance))
+
+        self._set_xp(self.memberships[2], 40)
+        delta = publish_rankings(self.instance)
+
+        self.assertEqual((delta['type'], delta['base_seq'], delta['seq']),
+                         ('rankings_delta', first['seq'], first['seq'] + 1))
+        self.assertEqual(delta['removed'], [])
+        # Everyone's rank moved, but only the climber's XP and gems changed
+        self.assertEqual(len(delta['changes']), 3)
+        seq, snapshot = published_rankings(self.instance)
+        self.assertEqual(seq, delta['seq'])
+        self.assertEqual(self._apply(first['rankings'], delta), snapshot['rankings'])
+
+    def _receive(self, held, message):
+        """The documented client rule: (seq, rankings) after ``message``, or None to reconnect."""
+        seq, rankings = held
+        if message['type'] == 'rankings_snapshot':
+            return message['seq'], message['rankings']
+        if message['seq'] <= seq:
+            return held  # Already part of the snapshot the client holds
+        if message['base_seq'] != seq:
+            return None
+        return message['seq'], self._apply(rankings, message)
+
+    def test_deltas_older_than_the_connect_snapshot_are_dropped(self):
+        publish_rankings(self.instance)
+        self._set_xp(self.memberships[2], 40)
+        in_flight = publish_rankings(self.instance)
+
+        # A socket connecting before the delta arrives already holds its sequence
+        seq, snapshot = published_rankings(self.instance)
+        held = (seq, snapshot['rankings'])
+        self.assertEqual(self._receive(held, in_flight), held)
+
+        self._set_xp(self.memberships[1], 50)
+        held = self._receive(held, publish_rankings(self.instance))
+        seq, snapshot = published_rankings(self.instance)
+        self.assertEqual(held, (seq, snapshot['rankings']))
+
+    def test_concurrent_publishers_claim_distinct_sequences(self):
+        publish_rankings(self.instance)
+        stale = ranking_service._latest_published(caches['rankings'], self.instance.id)
+        self._set_xp(self.memberships[2], 40)
+        winner = publish_rankings(self.instance)
+
+        # This publisher read the sequence before the winner claimed the next one
+        self._set_xp(self.memberships[1], 50)
+        with patch('myapp.ranking_service._latest_published', return_value=stale):
+            loser = publish_rankings(self.instance)
+
+        self.assertEqual(winner['base_seq'], stale[0])
+        self.assertEqual((loser['base_seq'], loser['seq']), (winner['seq'], winner['seq'] + 1))
+        held = self._receive((stale[0], stale[1]['rankings']), winner)
+        held = self._receive(held, loser)
+        self.assertEqual(held, (loser['seq'], published_rankings(self.instance)[1]['rankings']))
+
+    def test_sequence_keeps_rising_when_snapshots_are_evicted(self):
+        first = publish_rankings(self.instance)
+        held = (first['seq'], first['rankings'])
+        caches['rankings'].delete(ranking_service._published_key(self.instance.id, first['seq']))
+
+        self._set_xp(self.memberships[2], 40)
+        message = publish_rankings(self.instance)
+
+        self.assertEqual((message['type'], message['seq']), ('rankings_snapshot', first['seq'] + 1))
+        self.assertEqual(self._receive(held, message)[0], message['seq'])
+
+    def test_lost_counter_restarts_above_every_held_sequence(self):
+        first = publish_rankings(self.instance)
+        caches['rankings'].delete(ranking_service._seq_key(self.instance.id))
+
+        self._set_xp(self.memberships[2], 40)
+        message = publish_rankings(self.instance)
+
+        self.assertEqual(message['type'], 'rankings_snapshot')
+        self.assertGreater(message['seq'], first['seq'])
+
+    def test_deltas_are_sent_without_waiting_for_the_coalescer(self):
+        publish_rankings(self.instance)
+        self._set_xp(self.memberships[2], 40)
+        sent = []
+
+        class Layer:
+            async def group_send(self, group, message):
+                sent.append((group, message['data']['seq']))
+
+        with patch('myapp.websocket_signals.get_channel_layer', return_value=Layer()), \
+                patch('myapp.websocket_signals.send_state_update') as coalesced:
+            _broadcast_ranking_delta('global_league_delta_1', self.instance)
+
+        self.assertEqual(sent, [('global_league_delta_1', published_rankings(self.instance)[0])])
+        coalesced.assert_not_called()
+
+    def test_protocol_is_opt_in(self):
+        self.assertTrue(wants_ranking_deltas({'query_string': b'protocol=delta'}))
+        self.assertFalse(wants_ranking_deltas({'query_string': b''}))
+        self.assertFalse(wants_ranking_deltas({}))
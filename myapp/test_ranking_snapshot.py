@@ -0,0 +1,90 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.core.cache import caches
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from myapp.league_service import settle_expired_leagues
+from myapp.models import CustomUser, League, LeagueInstance, UserLeague
+from myapp.tasks import send_status_update
+
+
+class RankingSnapshotTests(APITestCase):
+    def setUp(self):
+        caches['rankings'].clear()
+        self.now = timezone.now()
+        league = League.objects.create(name='League 5', order=5)
+        self.instance = LeagueInstance.objects.create(
+            league=league, league_start=self.now - timedelta(days=1), league_end=self.now + timedelta(days=1),
+        )
+        self.users = []
+        for i, xp in enumerate([50, 40, 30, 20, 10]):
+            user = CustomUser.objects.create_user(username=f'rank{i}', email=f'rank{i}@test.com',
+                                                  password='testpass123')
+            UserLeague.objects.create(user=user, league_instance=self.instance, xp_global=xp)
+            self.users.append(user)
+        self.client.force_authenticate(user=self.users[2])
+
+    def _get(self):
+        return self.client.get(reverse('global-active-league')).json()['data']
+
+    def _ranking_queries(self, queries):
+        return [q for q in queries if 'ORDER BY "myapp_userleague"."league_instance_id"' in q['sql']]
+
+    def test_view_reads_cached_snapshot(self):
+        with CaptureQueriesContext(connection) as queries:
+            data = self._get()
+        self.assertEqual(len(self._ranking_queries(queries)), 1)
+
+        self.assertEqual(data['user_rank'], 3)
+        self.assertEqual([entry['advancement'] for entry in data['rankings']],
+                         ['Promoted', 'Retained', 'Retained', 'Retained', 'Demoted'])
+        self.assertEqual(data['rankings'][0]['gems_obtained'], 20)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self._get(), data)
+        self.assertEqual(self._ranking_queries(queries), [])
+
+    def test_xp_change_invalidates_after_commit(self):
+        self._get()
+        membership = UserLeague.objects.get(user=self.users[4])
+        with self.captureOnCommitCallbacks(execute=True):
+            membership.xp_global = 100
+            membership.save()
+
+        data = self._get()
+        self.assertEqual(data['rankings'][0]['user_id'], self.users[4].id)
+        self.assertEqual(data['user_rank'], 4)
+
+    @patch('myapp.tasks.send_gem_update.delay')
+    @patch('myapp.tasks.send_next_league_update.delay')
+    @patch('myapp.tasks.send_status_update.delay')
+    def test_status_update_uses_final_standings(self, *mocks):
+        LeagueInstance.objects.filter(id=self.instance.id).update(league_end=self.now - timedelta(minutes=1))
+        settle_expired_leagues(now=self.now)
+
+        sent = []
+
+        class Layer:
+            async def group_send(self, group, message):
+                sent.append((group, message['data']['rank'], message['data']['status']))
+
+        # The worker may run in another process, after the cached final standings are gone
+        caches['rankings'].clear()
+        user_ids = [user.id for user in self.users]
+        with patch('myapp.tasks.get_channel_layer', return_value=Layer()):
+            send_status_update(user_ids, self.instance.id)
+
+        self.assertEqual(len(sent), 5)
+        self.assertEqual(sent[0], (f'global_league_status_{self.users[0].id}', 1, 'Promoted'))
+        self.assertEqual(sent[-1], (f'global_league_status_{self.users[4].id}', 5, 'Demoted'))
+
+        # Tasks queued with the former arguments still run
+        sent.clear()
+        with patch('myapp.tasks.get_channel_layer', return_value=Layer()):
+            send_status_update(user_ids, self.instance.id, 'Demoted', False, False, 5, 1, 4)
+        self.assertEqual(len(sent), 5)
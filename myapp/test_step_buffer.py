@@ -0,0 +1,177 @@
+from datetime import timedelta
+from unittest import mock, skipUnless
+
+import redis
+from django.db import OperationalError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from myapp import step_buffer
+from myapp.models import CustomUser, DailySteps, Xp
+from myapp.serializers import DailyStepsSerializer
+from vertex import settings
+
+
+def _redis_available():
+    try:
+        return redis.Redis.from_url(settings.redis_url).ping()
+    except redis.RedisError:
+        return False
+
+
+@override_settings(STEP_INGEST_MODE='buffered', STEP_BUFFER_BACKEND='local')
+class BufferedStepIngestTests(APITestCase):
+    def setUp(self):
+        step_buffer._buffer = None
+        self.user = CustomUser.objects.create_user(
+            username='buffer@test.com',
+            email='buffer@test.com',
+            password='testpass123',
+        )
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('daily-steps')
+
+    def tearDown(self):
+        step_buffer._buffer = None
+
+    def _post(self, step_count, when):
+        return self.client.post(self.url, {
+            'step_count': step_count,
+            'timestamp': when.strftime("%Y-%m-%dT%H:%M:%S"),
+        }, format='json')
+
+    def test_updates_are_coalesced_until_flush(self):
+        now = timezone.now()
+        for step_count in (100, 400, 300, 900):
+            response = self._post(step_count, now)
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertFalse(DailySteps.objects.filter(user=self.user).exists())
+
+        result = step_buffer.flush_step_buffer()
+
+        self.assertEqual(result, {'received': 4, 'applied': 1, 'skipped': 0, 'requeued': 0, 'collapsed': 3})
+        self.assertEqual(DailySteps.objects.get(user=self.user).step_count, 900)
+        self.assertEqual(Xp.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(step_buffer.get_step_buffer().stats()['collapsed_total'], 3)
+
+    def test_each_day_is_flushed_separately(self):
+        self.user.date_joined = timezone.now() - timedelta(days=3)
+        self.user.save()
+        now = timezone.now()
+        self._post(500, now - timedelta(days=1))
+        self._post(200, now)
+
+        result = step_buffer.flush_step_buffer()
+
+        self.assertEqual(result['applied'], 2)
+        self.assertEqual(DailySteps.objects.filter(user=self.user).count(), 2)
+
+    def test_failed_apply_is_retried_by_the_next_flush(self):
+        self._post(700, timezone.now())
+
+        with mock.patch.object(DailyStepsSerializer, 'apply_steps', side_effect=OperationalError('connection lost')):
+            result = step_buffer.flush_step_buffer()
+
+        self.assertEqual(result['requeued'], 1)
+        self.assertFalse(DailySteps.objects.filter(user=self.user).exists())
+
+        result = step_buffer.flush_step_buffer()
+
+        self.assertEqual((result['received'], result['applied'], result['requeued']), (0, 1, 0))
+        self.assertEqual(DailySteps.objects.get(user=self.user).step_count, 700)
+        self.assertEqual(step_buffer.flush_step_buffer()['applied'], 0)
+
+    def test_count_not_higher_than_stored_is_dropped(self):
+        now = timezone.now()
+        self._post(500, now)
+        step_buffer.flush_step_buffer()
+        self._post(400, now)
+
+        result = step_buffer.flush_step_buffer()
+
+        self.assertEqual((result['applied'], result['skipped'], result['requeued']), (0, 1, 0))
+        self.assertEqual(step_buffer.flush_step_buffer()['skipped'], 0)
+
+    def test_invalid_update_is_rejected_immediately(self):
+        response = self._post(-10, timezone.now())
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(step_buffer.flush_step_buffer()['received'], 0)
+
+
+@skipUnless(_redis_available(), "Redis is not available")
+class RedisStepBufferTests(TestCase):
+    keys = (step_buffer.PENDING_KEY, step_buffer.STATS_KEY, step_buffer.PROCESSING_KEY, step_buffer.FLUSH_LOCK_KEY)
+
+    def setUp(self):
+        self.buffer = step_buffer.RedisStepBuffer(settings.redis_url)
+        self.buffer.client.delete(*self.keys)
+
+    def tearDown(self):
+        self.buffer.client.delete(*self.keys)
+
+    def _counts(self, entries):
+        return sorted((entry['user_id'], entry['step_count']) for entry in entries)
+
+    def test_keeps_highest_count_per_user_and_day(self):
+        now = timezone.now()
+        self.buffer.add(1, now.date(), 300, now)
+        self.buffer.add(1, now.date(), 200, now)
+        self.buffer.add(2, now.date(), 50, now)
+
+        received, drained, entries = self.buffer.drain('flush')
+
+        self.assertEqual((received, drained), (3, 2))
+        self.assertEqual(self._counts(entries), [(1, 300), (2, 50)])
+
+    def test_entries_stay_until_acknowledged(self):
+        now = timezone.now()
+        self.buffer.add(1, now.date(), 300, now)
+        self.buffer.add(2, now.date(), 50, now)
+        _, _, entries = self.buffer.drain('flush')
+        self.buffer.ack(next(entry for entry in entries if entry['user_id'] == 1))
+        self.buffer.release('flush')
+
+        received, drained, entries = self.buffer.drain('next')
+
+        self.assertEqual((received, drained), (0, 0))
+        self.assertEqual(self._counts(entries), [(2, 50)])
+
+    def test_only_one_flush_holds_the_buffer(self):
+        now = timezone.now()
+        self.buffer.add(1, now.date(), 300, now)
+        self.buffer.drain('flush')
+
+        self.assertIsNone(self.buffer.drain('other'))
+        self.buffer.release('other')
+        self.assertIsNone(self.buffer.drain('other'))
+
+        self.buffer.release('flush')
+        self.assertEqual(self._counts(self.buffer.drain('other')[2]), [(1, 300)])
+
+    def test_entries_of_a_dead_flush_are_merged_keeping_the_higher_count(self):
+        now = timezone.now()
+        self.buffer.add(1, now.date(), 300, now)
+        self.buffer.add(2, now.date(), 80, now)
+        self.buffer.drain('dead')
+        # The dead flush's lease runs out
+        self.buffer.client.delete(step_buffer.FLUSH_LOCK_KEY)
+        self.buffer.add(1, now.date(), 200, now)
+        self.buffer.add(2, now.date(), 90, now)
+
+        received, drained, entries = self.buffer.drain('flush')
+
+        self.assertEqual((received, drained), (2, 2))
+        self.assertEqual(self._counts(entries), [(1, 300), (2, 90)])
+
+    def test_ack_keeps_an_entry_replaced_since_the_drain(self):
+        now = timezone.now()
+        self.buffer.add(1, now.date(), 300, now)
+        _, _, entries = self.buffer.drain('flush')
+        self.buffer.client.hset(step_buffer.PROCESSING_KEY, entries[0]['field'], '{"step_count": 400, "timestamp": "%s"}' % now.isoformat())
+
+        self.buffer.ack(entries[0])
+
+        self.assertTrue(self.buffer.client.hexists(step_buffer.PROCESSING_KEY, entries[0]['field']))
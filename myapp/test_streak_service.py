@@ -0,0 +1,143 @@
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from unittest.mock import patch
+
+from django.db import connection
+from django.db.models.signals import post_save
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from myapp.models import CustomUser, Streak
+from myapp.streak_service import compute_streak_run, recompute_streak, reset_missed_streaks
+
+
+class ComputeStreakRunTests(TestCase):
+    def test_run_continues_previous_streak_until_gap(self):
+        start = date(2024, 5, 10)
+        stored = {start + timedelta(days=1): 1, start + timedelta(days=2): 7, start + timedelta(days=4): 1}
+
+        run = compute_streak_run(start, stored, previous=(start - timedelta(days=1), 4, 6))
+
+        self.assertEqual(run, [
+            (start, 5, 6),
+            (start + timedelta(days=1), 6, 6),
+            (start + timedelta(days=2), 7, 7),
+        ])
+
+    def test_gap_before_start_resets_current_but_keeps_highest(self):
+        start = date(2024, 5, 10)
+        run = compute_streak_run(start, {}, previous=(start - timedelta(days=3), 9, 12))
+        self.assertEqual(run, [(start, 1, 12)])
+
+
+class RecomputeStreakTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='streaks@test.com',
+            email='streaks@test.com',
+            password='testpass123',
+        )
+        self.now = timezone.now()
+        self.today = self.now.date()
+
+    def _add_days(self, first, count):
+        Streak.objects.bulk_create([
+            Streak(user=self.user, date=first + timedelta(days=i), timeStamp=self.now,
+                   currentStreak=i + 1, highestStreak=i + 1)
+            for i in range(count)
+        ])
+
+    def test_backfilled_day_joins_runs_with_constant_queries(self):
+        gap = self.today - timedelta(days=60)
+        self._add_days(gap - timedelta(days=10), 10)
+        self._add_days(gap + timedelta(days=1), 60)
+
+        with CaptureQueriesContext(connection) as queries:
+            current = recompute_streak(self.user, gap, self.now, self.today)
+
+        self.assertEqual(current, 71)
+        # Besides the device lookups of the milestone notifications, one per fifth day
+        self.assertLess(len([q for q in queries if 'fcm_django' not in q['sql']]), 25)
+        latest = Streak.objects.get(user=self.user, date=self.today)
+        self.assertEqual((latest.currentStreak, latest.highestStreak), (71, 71))
+        self.assertEqual(Streak.objects.get(user=self.user, date=gap).currentStreak, 11)
+
+
+    def test_every_renumbered_day_is_signalled(self):
+        gap = self.today - timedelta(days=8)
+        self._add_days(gap - timedelta(days=2), 2)
+        self._add_days(gap + timedelta(days=1), 8)
+        signalled = []
+
+        def receiver(sender, instance, using, **kwargs):
+            signalled.append((instance.date, instance.currentStreak, using))
+
+        post_save.connect(receiver, sender=Streak)
+        self.addCleanup(post_save.disconnect, receiver, sender=Streak)
+        recompute_streak(self.user, gap, self.now, self.today)
+
+        self.assertEqual(signalled, [
+            (gap + timedelta(days=offset), offset + 3, 'default') for offset in range(9)
+        ])
+
+
+class ResetMissedStreaksTests(TestCase):
+    def setUp(self):
+        # 00:10 in London (BST), mid-morning in Tokyo
+        self.now = datetime(2024, 6, 11, 23, 10, tzinfo=dt_timezone.utc)
+        self.yesterday = date(2024, 6, 11)
+
+    def _user(self, name, tz='Europe/London', streak=3, savers=0):
+        return CustomUser.objects.create_user(
+            username=name, email=f'{name}@test.com', password='testpass123',
+            timezone=tz, streak=streak, streak_savers=savers,
+        )
+
+    def test_uses_savers_and_resets_in_bulk(self):
+        missed = self._user('missed')
+        saver = self._user('saver', savers=2)
+        active = self._user('active')
+        elsewhere = self._user('elsewhere', tz='Asia/Tokyo')
+        Streak.objects.create(user=saver, date=self.yesterday - timedelta(days=1), timeStamp=self.now,
+                              currentStreak=3, highestStreak=3)
+        Streak.objects.create(user=active, date=self.yesterday, timeStamp=self.now,
+                              currentStreak=3, highestStreak=3)
+
+        report = reset_missed_streaks(now=self.now)
+
+        self.assertEqual(report['checked'], 3)
+        self.assertEqual(report['saved'], [saver.id])
+        self.assertEqual(report['reset'], [missed.id])
+        saver.refresh_from_db()
+        self.assertEqual((saver.streak, saver.streak_savers), (4, 1))
+        self.assertEqual(Streak.objects.get(user=saver, date=self.yesterday).currentStreak, 4)
+        missed.refresh_from_db()
+        self.assertEqual(missed.streak, 0)
+        active.refresh_from_db()
+        elsewhere.refresh_from_db()
+        self.assertEqual((active.streak, elsewhere.streak), (3, 3))
+
+    def test_saved_streaks_are_announced_after_commit(self):
+        saver = self._user('saver', savers=1)
+        Streak.objects.create(user=saver, date=self.yesterday - timedelta(days=1), timeStamp=self.now,
+                              currentStreak=3, highestStreak=3)
+
+        with patch('myapp.websocket_signals.send_state_update') as send_state_update:
+            with self.captureOnCommitCallbacks() as callbacks:
+                reset_missed_streaks(now=self.now)
+            send_state_update.assert_not_called()
+            for callback in callbacks:
+                callback()
+
+        send_state_update.assert_called_once_with(
+            f'streak_{saver.id}', {'type': 'send_streak_update', 'streak_count': 4}
+        )
+
+    def test_dry_run_reports_without_writing(self):
+        missed = self._user('missed')
+
+        report = reset_missed_streaks(now=self.now, dry_run=True)
+
+        self.assertEqual(report['reset'], [missed.id])
+        missed.refresh_from_db()
+        self.assertEqual(missed.streak, 3)
@@ -0,0 +1,117 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.db import IntegrityError, transaction
+from django.test import TestCase
+from django.utils import timezone
+
+from myapp import ws_coalescer
+from myapp.models import CustomUser, Gem, Streak
+from myapp.ws_coalescer import UpdateCoalescer
+
+
+class FakeChannelLayer:
+    def __init__(self):
+        self.sent = []
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message))
+
+
+class UpdateCoalescerTests(TestCase):
+    def setUp(self):
+        self.layer = FakeChannelLayer()
+        patcher = patch('myapp.ws_coalescer.get_channel_layer', return_value=self.layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_sends_latest_message_per_group_and_type(self):
+        coalescer = UpdateCoalescer(window=60)
+        self.addCleanup(coalescer.flush)
+        for count in (1, 2, 3):
+            coalescer.send('gem_1', {'type': 'send_gem_update', 'gem_count': count})
+        coalescer.send('streak_1', {'type': 'send_streak_update', 'streak_count': 4})
+        coalescer.send('gem_2', {'type': 'send_gem_update', 'gem_count': 9})
+        self.assertEqual(self.layer.sent, [])
+
+        self.assertEqual(coalescer.flush(), 3)
+
+        self.assertEqual(self.layer.sent, [
+            ('gem_1', {'type': 'send_gem_update', 'gem_count': 3}),
+            ('streak_1', {'type': 'send_streak_update', 'streak_count': 4}),
+            ('gem_2', {'type': 'send_gem_update', 'gem_count': 9}),
+        ])
+        self.assertEqual(coalescer.stats(), {'queued': 5, 'sent': 3, 'suppressed': 2, 'failed': 0, 'pending': 0})
+
+    def test_timer_flushes_after_window(self):
+        coalescer = UpdateCoalescer(window=0.01)
+        coalescer.send('gem_1', {'type': 'send_gem_update', 'gem_count': 1})
+        coalescer._timer.join(timeout=5)
+
+        self.assertEqual(self.layer.sent, [('gem_1', {'type': 'send_gem_update', 'gem_count': 1})])
+
+    def test_zero_window_sends_immediately(self):
+        coalescer = UpdateCoalescer(window=0)
+        coalescer.send('gem_1', {'type': 'send_gem_update', 'gem_count': 1})
+        self.assertEqual(len(self.layer.sent), 1)
+
+    def test_failed_send_is_counted_and_does_not_raise(self):
+        async def broken(group, message):
+            raise ConnectionError('redis down')
+        self.layer.group_send = broken
+        coalescer = UpdateCoalescer(window=60)
+        coalescer.send('gem_1', {'type': 'send_gem_update', 'gem_count': 1})
+
+        self.assertEqual(coalescer.flush(), 0)
+        self.assertEqual(coalescer.stats()['failed'], 1)
+
+
+class CoalescedBroadcastTests(TestCase):
+    def setUp(self):
+        self.layer = FakeChannelLayer()
+        patcher = patch('myapp.ws_coalescer.get_channel_layer', return_value=self.layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.coalescer = UpdateCoalescer(window=60)
+        self.addCleanup(self.coalescer.flush)
+        coalescer_patcher = patch.object(ws_coalescer, '_coalescer', self.coalescer)
+        coalescer_patcher.start()
+        self.addCleanup(coalescer_patcher.stop)
+
+        self.user = CustomUser.objects.create_user(
+            username='coalesce@test.com', email='coalesce@test.com', password='testpass123',
+        )
+
+    def test_gem_and_streak_saves_send_one_update_each(self):
+        today = timezone.now().date()
+        with self.captureOnCommitCallbacks(execute=True):
+            gem = Gem.objects.create(user=self.user, date=today)
+            for xp_gem in (1, 2, 3):
+                gem.xp_gem = xp_gem
+                gem.save()
+            for offset in (2, 1, 0):
+                Streak.objects.create(user=self.user, date=today - timedelta(days=offset), timeStamp=timezone.now(),
+                                      currentStreak=3 - offset, highestStreak=3 - offset)
+
+        self.coalescer.flush()
+
+        self.assertEqual([group for group, _ in self.layer.sent], [f'gem_{self.user.id}', f'streak_{self.user.id}'])
+        self.assertEqual(self.layer.sent[0][1]['gem_count'], 3)
+        self.assertEqual(self.layer.sent[1][1]['streak_count'], 3)
+        stats = self.coalescer.stats()
+        self.assertGreaterEqual(stats['suppressed'], 4)
+        self.assertEqual(stats['queued'], stats['sent'] + stats['suppressed'])
+
+    def test_rolled_back_changes_send_nothing(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    Streak.objects.create(user=self.user, date=timezone.now().date(), timeStamp=timezone.now(),
+                                          currentStreak=5, highestStreak=5)
+                    raise IntegrityError('rolled back')
+            except IntegrityError:
+                pass
+
+        self.coalescer.flush()
+        self.assertEqual(self.layer.sent, [])
+        self.assertEqual(self.coalescer.stats()['queued'], 0)
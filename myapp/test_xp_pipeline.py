@@ -0,0 +1,76 @@
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from myapp.models import CustomUser, Company, League, UserLeague, Streak, Gem, Xp
+from myapp.xp_pipeline import PIPELINE_STAGES
+
+stage_timings = []
+
+
+def record_timing(stage_name, seconds, ctx):
+    stage_timings.append(stage_name)
+
+
+class XpPipelineTests(TestCase):
+    def setUp(self):
+        self.owner = CustomUser.objects.create_user(username='owner@test.com', email='owner@test.com', password='x')
+        self.company = Company.objects.create(name='Pipeline Co', owner=self.owner, domain='pipeline.com')
+        self.user = CustomUser.objects.create_user(
+            username='pipeline@test.com',
+            email='pipeline@test.com',
+            password='testpass123',
+            company=self.company,
+        )
+        League.objects.create(name="Pathfinder league", order=1)
+        self.now = timezone.now()
+
+    def _create_xp(self, total_today):
+        return Xp.objects.create(
+            user=self.user, xp_value=total_today, totalXpToday=total_today,
+            totalXpAllTime=total_today, timeStamp=self.now, date=self.now.date(), source='steps'
+        )
+
+    def test_insert_runs_every_stage_once(self):
+        with self.captureOnCommitCallbacks():
+            self._create_xp(520)
+
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.streak, 1)
+        self.assertTrue(Streak.objects.filter(user=self.user, date=self.now.date()).exists())
+        self.assertEqual(Gem.objects.get(user=self.user, date=self.now.date()).xp_gem, 2)
+        self.assertEqual(UserLeague.objects.filter(user=self.user, league_instance__company__isnull=True).count(), 1)
+        self.assertEqual(UserLeague.objects.filter(user=self.user, league_instance__company=self.company).count(), 1)
+
+    def test_broadcasts_wait_for_commit(self):
+        with mock.patch('myapp.xp_pipeline.broadcast_global_league_ranking_update') as global_broadcast, \
+                mock.patch('myapp.xp_pipeline.broadcast_company_league_ranking_update') as company_broadcast:
+            with self.captureOnCommitCallbacks(execute=False) as callbacks:
+                self._create_xp(100)
+            global_broadcast.assert_not_called()
+
+            for callback in callbacks:
+                callback()
+
+        global_broadcast.assert_called_once()
+        company_broadcast.assert_called_once()
+
+    def test_updates_do_not_rerun_pipeline(self):
+        xp = self._create_xp(300)
+        Streak.objects.filter(user=self.user).delete()
+
+        xp.totalXpToday = 300
+        xp.save()
+
+        self.assertFalse(Streak.objects.filter(user=self.user).exists())
+
+    @override_settings(XP_PIPELINE_TIMING_HOOKS=['myapp.test_xp_pipeline.record_timing'])
+    def test_timing_hook_sees_every_stage(self):
+        stage_timings.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self._create_xp(210)
+
+        self.assertEqual(stage_timings[:len(PIPELINE_STAGES)], [name for name, _ in PIPELINE_STAGES])
+        self.assertIn('after_commit:streak_reminder', stage_timings)
+        self.assertIn('after_commit:global_league_broadcast', stage_timings)
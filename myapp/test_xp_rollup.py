@@ -0,0 +1,81 @@
+from datetime import timedelta
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from myapp.models import CustomUser, WorkoutActivity, XpDailyTotal
+
+
+class XpDailyRollupTests(APITestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='rollup@test.com',
+            email='rollup@test.com',
+            password='testpass123',
+        )
+        self.client.force_authenticate(user=self.user)
+        self.now = timezone.now()
+        self.today = self.now.date()
+
+    def _ingest(self):
+        self.client.post(reverse('daily-steps'), {
+            'step_count': 1500,
+            'timestamp': self.now.strftime("%Y-%m-%dT%H:%M:%S"),
+        }, format='json')
+        for minutes, activity_type in ((2, 'movement'), (1, 'mindfulness')):
+            self.client.post(reverse('workout'), {
+                'duration': 20,
+                'activity_type': activity_type,
+                'activity_name': 'Session',
+                'start_datetime': (self.now - timedelta(minutes=minutes)).isoformat(),
+                'end_datetime': self.now.isoformat(),
+            }, format='json')
+
+    def test_ingestion_keeps_rollup_current(self):
+        self._ingest()
+
+        rollup = XpDailyTotal.objects.get(user=self.user, date=self.today)
+        movement = WorkoutActivity.objects.get(user=self.user, activity_type='movement')
+        mindfulness = WorkoutActivity.objects.get(user=self.user, activity_type='mindfulness')
+        self.assertEqual(rollup.step_count, 1500)
+        self.assertEqual(rollup.steps_xp, 150)
+        self.assertEqual(rollup.workout_count, 2)
+        self.assertEqual(rollup.movement_xp, movement.xp)
+        self.assertEqual(rollup.mindfulness_xp, mindfulness.xp)
+
+        response = self.client.get(reverse('xp-records'), {'start_date': str(self.today)})
+        day = response.json()['data']['xp_per_day'][0]
+        self.assertEqual(day['movement_xp'], movement.xp + 150)
+        self.assertEqual(day['mindfulness_xp'], mindfulness.xp)
+
+        response = self.client.get(reverse('daily-steps'), {'start_date': str(self.today)})
+        day = response.json()['data']['steps_per_day'][0]
+        self.assertEqual((day['total_steps'], day['total_xp']), (1500, 150))
+
+    def test_xp_records_query_count_does_not_grow_with_range(self):
+        self._ingest()
+        url = reverse('xp-records')
+
+        with CaptureQueriesContext(connection) as one_day:
+            self.client.get(url, {'start_date': str(self.today)})
+        with CaptureQueriesContext(connection) as ninety_days:
+            self.client.get(url, {'start_date': str(self.today - timedelta(days=90))})
+
+        self.assertEqual(len(one_day), len(ninety_days))
+
+    def test_rebuild_restores_rollup_fields(self):
+        self._ingest()
+        expected = XpDailyTotal.objects.filter(user=self.user).values(
+            'date', 'step_count', 'workout_count', 'movement_xp', 'mindfulness_xp', 'steps_xp', 'total_xp'
+        ).get()
+        XpDailyTotal.objects.filter(user=self.user).delete()
+
+        call_command('rebuild_xp_totals', stdout=StringIO())
+
+        rebuilt = XpDailyTotal.objects.filter(user=self.user).values(*expected.keys()).get()
+        self.assertEqual(rebuilt, expected)
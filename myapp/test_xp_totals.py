@@ -0,0 +1,55 @@
+from datetime import timedelta
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from myapp.models import CustomUser, Xp, XpTotal, XpDailyTotal
+from myapp.xp_service import record_xp, record_xp_batch, get_total_xp_all_time, get_total_xp_for_date
+
+
+class XpTotalsTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='totals@test.com',
+            email='totals@test.com',
+            password='testpass123',
+        )
+        self.now = timezone.now()
+        self.today = self.now.date()
+        self.yesterday = self.today - timedelta(days=1)
+
+    def test_record_xp_maintains_running_totals(self):
+        record_xp(self.user, self.yesterday, 100, self.now - timedelta(days=1), source='steps')
+        record_xp(self.user, self.today, 40, self.now, source='steps')
+        xp = record_xp(self.user, self.today, 60, self.now, source='workout')
+
+        self.assertEqual(xp.totalXpToday, 100)
+        self.assertEqual(xp.totalXpAllTime, 200)
+
+        totals = XpTotal.objects.get(user=self.user)
+        self.assertEqual((totals.total_xp, totals.steps_xp, totals.workout_xp), (200, 140, 60))
+        self.assertEqual(get_total_xp_for_date(self.user, self.today), 100)
+        self.assertEqual(get_total_xp_for_date(self.user, self.yesterday), 100)
+
+    def test_direct_inserts_and_batches_update_totals(self):
+        Xp.objects.create(user=self.user, xp_value=25, timeStamp=self.now, date=self.today, source='steps')
+        record_xp_batch(self.user, [
+            {'date': self.today, 'timestamp': self.now, 'xp': 10, 'source': 'workout'},
+            {'date': self.yesterday, 'timestamp': self.now - timedelta(days=1), 'xp': 5, 'source': 'steps'},
+        ])
+
+        self.assertEqual(get_total_xp_all_time(self.user), 40)
+        daily = XpDailyTotal.objects.get(user=self.user, date=self.today)
+        self.assertEqual((daily.total_xp, daily.steps_xp, daily.workout_xp), (35, 25, 10))
+
+    def test_rebuild_command_repairs_drift(self):
+        record_xp(self.user, self.today, 50, self.now, source='steps')
+        XpTotal.objects.filter(user=self.user).update(total_xp=999)
+        XpDailyTotal.objects.filter(user=self.user).delete()
+
+        call_command('rebuild_xp_totals', stdout=StringIO())
+
+        self.assertEqual(get_total_xp_all_time(self.user), 50)
+        self.assertEqual(get_total_xp_for_date(self.user, self.today), 50)
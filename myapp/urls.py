@@ -38,6 +38,7 @@ urlpatterns = [
     path('transfer-company/', views.TransferOwnershipView.as_view(), name='transfer_company_ownership'),
     path('daily-steps/', views.DailyStepsView.as_view(), name='daily-steps'),
     path('workout/', views.WorkoutActivityView.as_view(), name='workout'),
+    path('health-sync/', views.HealthSyncView.as_view(), name='health-sync'),
     path('xp/', views.XpRecordsView.as_view(), name='xp-records'),
     path('streak/', views.StreakRecordsView.as_view(), name='streak-records'),
     path('convert-gem/', views.ConvertGemView.as_view(), name='convert-gem'),
@@ -61,6 +62,7 @@ urlpatterns = [
     path('user-gem-status/', views.UserGemStatusView.as_view(), name='user-gem-status'),
     path('league/global/status/', views.GlobalLeagueStatusView.as_view(), name='custom-user-league-status'),
     path('league/company/status/', views.CompanyLeagueStatusView.as_view(), name='custom-user-company-league-status'),
+    path('league/history/', views.LeagueHistoryView.as_view(), name='league-history'),
     path('company/dashboard/', views.CompanyDashboardView.as_view(), name='company-dashboard'),
     path('notifications/', views.NotificationsView.as_view(), name='notifications-list'),
     path("company/", views.CompanyListView.as_view(), name='company-list'),
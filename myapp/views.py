@@ -19,18 +19,28 @@ from django_filters import rest_framework
 from myapp.utils import send_user_notification, \
     get_last_day_and_first_day_of_this_month
 from .invitation_service import send_invitation_in_bulk
+from .health_sync_service import sync_health_data
+from .xp_service import get_total_xp_all_time, get_total_xp_for_date
+from .idempotency import idempotent_ingestion
+from .activity_bitmap import ActivityHistory
+from .gem_service import get_gem_balance, spend_gems, InsufficientGems
+from .step_buffer import buffer_step_update, is_buffered_ingest
+from .ws_coalescer import send_state_update
+from .ranking_service import get_ranking_snapshot, league_edges, with_user_rank
+from .league_service import DEMOTION_SHARE, PROMOTION_SHARE
 from .stats_service import get_global_xp_for_stats_by_user, get_global_xp_for_stats, get_daily_steps_and_xp
 from .filters import EmployeeFilterSet, CompanyFilterSet, InvitationFilterSet
 from .serializers import (CompanyOwnerSignupSerializer, NormalUserSignupSerializer,
                           InvitationSerializer, UserProfileSerializer, UpdateProfileSerializer,
                           DailyStepsSerializer, WorkoutActivitySerializer, PurchaseSerializer,
-                          DrawWinnerSerializer, DrawEntrySerializer, DrawSerializer, FeedSerializer,
+                          DrawWinnerSerializer, DrawTicketBlockSerializer, DrawSerializer, FeedSerializer,
                           NotifSerializer, EmployeeSerializer, CompanySerializer, InvitationAsEmployeeSerializer, FileUploadSerializer, BulkInvitationResultSerializer,
-                          ManualDrawCreateSerializer, ManualPrizeCreateSerializer, CombinedDrawPrizeSerializer)
+                          ManualDrawCreateSerializer, ManualPrizeCreateSerializer, CombinedDrawPrizeSerializer, HealthSyncSerializer,
+                          LeagueResultSerializer)
 from .models import (CustomUser, Invitation, Company, Membership, DailySteps, Xp, WorkoutActivity,
-                     Streak, Purchase, DrawWinner, DrawEntry, Draw, UserLeague, LeagueInstance, UserFollowing, Feed,
+                     Streak, Purchase, DrawWinner, DrawTicketBlock, DrawParticipant, Draw, UserLeague, LeagueInstance, UserFollowing, Feed,
                      Clap, ActiveSession,
-                     League, Gem, DrawImage, Notif, Prize)
+                     League, Gem, DrawImage, Notif, Prize, XpDailyTotal, LeagueResult)
 from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
 from django.shortcuts import render, get_object_or_404
 from django.contrib.auth.tokens import default_token_generator
@@ -55,8 +65,6 @@ from rest_framework.exceptions import PermissionDenied, NotFound
 from django.utils.dateparse import parse_date
 from django.contrib.auth.decorators import login_required
 from rest_framework.throttling import UserRateThrottle
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 from django.utils.timezone import localtime, now
 from .tasks import upload_file_task, send_login_successful_email_task
 import tempfile
@@ -802,23 +810,21 @@ class DailyStepsView(APIView):
         if not start_date:
             return Response({"error": "Please provide a start date."}, status=400)
 
-        # Query steps and XP in the date range for the user, aggregate by date
-        steps_in_range = DailySteps.objects.filter(
+        # Steps and step XP per day come from the daily rollup in one range scan
+        steps_in_range = XpDailyTotal.objects.filter(
             user=request.user,
-            date__range=[start_date, end_date]
-        ).values('date', 'timestamp').annotate(
-            total_steps=Sum('step_count'),
-            total_xp=Sum('xp')
-        ).order_by('date')
+            date__range=[start_date, end_date],
+            steps_timestamp__isnull=False
+        ).values('date', 'steps_timestamp', 'step_count', 'steps_xp').order_by('date')
 
         # Prepare the data to include both steps and XP for each day
         steps_data = []
         for step in steps_in_range:
             steps_data.append({
                 'date': step['date'],
-                'timestamp': step['timestamp'],
-                'total_steps': step['total_steps'],
-                'total_xp': int(step['total_xp'])
+                'timestamp': step['steps_timestamp'],
+                'total_steps': step['step_count'],
+                'total_xp': int(step['steps_xp'])
             })
 
         # Query total steps for the user across all time
@@ -830,26 +836,35 @@ class DailyStepsView(APIView):
             'total_steps': total_steps_count
         })
 
+    @idempotent_ingestion('daily_steps')
     def post(self, request, *args, **kwargs):
         # Instantiate the serializer with the request data and user context
         serializer = DailyStepsSerializer(data=request.data, context={'request': request})
 
+        if serializer.is_valid() and is_buffered_ingest():
+            # Coalesced with other updates for the same day and applied on the next flush
+            buffer_step_update(request.user, serializer.validated_data)
+            return Response({
+                'data': {
+                    'step_count': serializer.validated_data['step_count'],
+                    'timestamp': serializer.validated_data['timestamp'],
+                    'date': serializer.validated_data['timestamp'].date(),
+                },
+                'xp': {
+                    'totalXpToday': round(get_total_xp_for_date(request.user, serializer.validated_data['timestamp'].date()), 1),
+                    'totalXpAllTime': round(get_total_xp_all_time(request.user), 1),
+                },
+                'message': 'Update queued'
+            }, status=status.HTTP_202_ACCEPTED)
+
         if serializer.is_valid():
             # Save the serializer, which handles step count and XP logic
             daily_steps = serializer.save()
 
-            # Retrieve the XP for the specified date
-            date = daily_steps.date
-            user_xp = Xp.objects.filter(user=request.user, date=date).last()
-
-            # Calculate total XP across all records for the user
-            total_xp_all_time = Xp.objects.filter(user=request.user).aggregate(Sum('xp_value'))[
-                                    'xp_value__sum'] or 0
-
-            # Prepare the response, handle the case where no XP record exists yet
+            # Read the day's and all-time XP from the materialized totals
             xp_data = {
-                'totalXpToday': round(user_xp.totalXpToday, 1) if user_xp else 0,
-                'totalXpAllTime': round(total_xp_all_time, 1),
+                'totalXpToday': round(get_total_xp_for_date(request.user, daily_steps.date), 1),
+                'totalXpAllTime': round(get_total_xp_all_time(request.user), 1),
             }
 
             return Response({
@@ -868,6 +883,7 @@ class WorkoutActivityView(APIView):
         serializer = WorkoutActivitySerializer(activities, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+    @idempotent_ingestion('workout')
     def post(self, request):
         serializer = WorkoutActivitySerializer(data=request.data, context={'request': request})
         if serializer.is_valid():
@@ -876,6 +892,28 @@ class WorkoutActivityView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class HealthSyncView(APIView):
+    """
+    Batch endpoint for clients replaying health data after being offline.
+    Accepts arrays of daily step totals and workouts and reports a result per item.
+    Send an Idempotency-Key header (or ``sync_key``) so retries replay the first result.
+    """
+    permission_classes = [IsAuthenticated]
+
+    @idempotent_ingestion('health_sync')
+    def post(self, request):
+        serializer = HealthSyncSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        result = sync_health_data(
+            request,
+            serializer.validated_data['steps'],
+            serializer.validated_data['workouts'],
+        )
+        return Response({**result, 'message': 'Sync complete'}, status=status.HTTP_200_OK)
+
+
 # class StreakRecordsView(APIView):
 #     throttle_classes = [StreakRateThrottle]
 #     permission_classes = [IsAuthenticated]
@@ -912,6 +950,7 @@ class StreakRecordsView(APIView):
     The response includes:
     - streak_per_day: A list of streak records per day within the specified date range.
     - overall_current_streak: The user's current streak value.
+    - active_days: The number of streak days within the date range.
 
     The user's local time is used to determine the dates for querying streak records.
     """
@@ -923,24 +962,22 @@ class StreakRecordsView(APIView):
         user_tz = user.timezone
 
         # Get start and end dates from query parameters
-        start_date = request.query_params.get('start_date')
-        end_date = request.query_params.get('end_date', localtime(now(), user_tz).date())
+        start_date_str = request.query_params.get('start_date')
+        end_date_str = request.query_params.get('end_date')
 
-        if not start_date:
+        if not start_date_str:
             return Response({"error": "Please provide a start date."}, status=400)
 
         # Convert dates to user timezone
         today_date = localtime(now(), user_tz).date()
+        start_date = parse_date(start_date_str)
+        end_date = parse_date(end_date_str) if end_date_str else today_date
+        if not start_date or not end_date:
+            return Response({"error": "Invalid date format."}, status=400)
 
-        # Query streak records in the user's local date range
-        streak_in_range = Streak.objects.filter(
-            user=user,
-            date__range=[start_date, end_date]
-        ).values('date').annotate(current_streak=Sum('currentStreak')).order_by('date')
-
-        # Prepare streak data for each day
-        streak_data = [{'date': streak['date'], 'current_streak': streak['current_streak']} for streak in
-                       streak_in_range]
+        # Streak days in the user's local date range, read from the activity bitmap
+        history = ActivityHistory(user.id)
+        streak_data = [{'date': day, 'current_streak': run} for day, run in history.calendar(start_date, end_date)]
 
         # Check if today's streak exists
         today_streak = next((entry['current_streak'] for entry in streak_data if entry['date'] == today_date), None)
@@ -956,6 +993,7 @@ class StreakRecordsView(APIView):
         return Response({
             'streak_per_day': streak_data,
             'overall_current_streak': current_streak,
+            'active_days': history.active_days(start_date, end_date),
         })
 
 
@@ -980,51 +1018,24 @@ class XpRecordsView(APIView):
         if not end_date:
             return Response({"error": "Invalid end date format."}, status=400)
 
-        # Query XP records in the date range for the user
-        xp_in_range = Xp.objects.filter(
+        # One range scan over the daily rollup gives the totals and the breakdown per day
+        xp_in_range = XpDailyTotal.objects.filter(
             user=request.user,
             date__range=[start_date, end_date]
-        ).values('date').annotate(total_xp=Sum('xp_value')).order_by('date')
+        ).values('date', 'total_xp', 'steps_xp', 'movement_xp', 'mindfulness_xp').order_by('date')
 
         xp_data = []
-
-        # Loop over each day and fetch movement and mindfulness XP for that day
         for xp in xp_in_range:
-            current_date = xp['date']
-
-            # Fetch movement XP from WorkoutActivity
-            movement_xp_workout = WorkoutActivity.objects.filter(
-                user=request.user,
-                start_datetime__date=current_date, # Filter based on start_datetime date
-                activity_type="movement"
-            ).aggregate(movement_xp=Sum('xp'))['movement_xp'] or 0
-
-            # Fetch movement XP from DailySteps
-            movement_xp_steps = DailySteps.objects.filter(
-                user=request.user,
-                date=current_date
-            ).aggregate(steps_xp=Sum('xp'))['steps_xp'] or 0
-
-            # Total movement XP for the day
-            total_movement_xp = movement_xp_workout + movement_xp_steps
-
-            # Fetch mindfulness XP for the current date
-            mindfulness_xp = WorkoutActivity.objects.filter(
-                user=request.user,
-                start_datetime__date=current_date,  # Filter based on start_datetime date
-                activity_type="mindfulness"
-            ).aggregate(mindfulness_xp=Sum('xp'))['mindfulness_xp'] or 0
-
-            # Append data for the current date
             xp_data.append({
-                'date': current_date,
+                'date': xp['date'],
                 'total_xp': round(xp['total_xp'], 1),
-                'movement_xp': total_movement_xp,
-                'mindfulness_xp': mindfulness_xp
+                # Movement XP covers both movement workouts and steps
+                'movement_xp': xp['movement_xp'] + xp['steps_xp'],
+                'mindfulness_xp': xp['mindfulness_xp']
             })
 
         # Fetch the actual total XP gained (across all time)
-        total_xp_gained = Xp.objects.filter(user=request.user).aggregate(total_xp=Sum('xp_value'))['total_xp'] or 0
+        total_xp_gained = get_total_xp_all_time(request.user)
 
         # Return response with the breakdown per day and total XP gained
         return Response({
@@ -1058,110 +1069,114 @@ class ConvertGemView(APIView):
         gem_cost_per_item = self.GEM_COSTS[item_type]
         total_gem_cost = gem_cost_per_item * quantity
 
-        total_available_gems = user.get_gem_count()
-        print(total_available_gems)
+        total_available_gems = get_gem_balance(user)
+        not_enough_gems = Response({
+            "error": f"Not enough gems. You need {total_gem_cost} gems for {quantity} {item_type}(s)."
+        }, status=status.HTTP_400_BAD_REQUEST)
 
         # Check if the user has enough available gems
         if total_available_gems < total_gem_cost:
-            return Response({
-                "error": f"Not enough gems. You need {total_gem_cost} gems for {quantity} {item_type}(s)."
-            }, status=status.HTTP_400_BAD_REQUEST)
+            return not_enough_gems
 
         # Use a transaction to ensure atomicity
-        with transaction.atomic():
-            # Deduct the total gem cost
-            user.gems_spent += total_gem_cost
-            print('user_spent gems', user.gems_spent)
+        try:
+            with transaction.atomic():
+                response = self._convert(request, user, item_type, quantity, company_draw_id, total_gem_cost)
+        except InsufficientGems:
+            # The balance dropped between the check and the spend
+            return not_enough_gems
+        return response
 
-            # Update the user's tickets or streak savers
-            if item_type == 'streak_saver':
-                if user.streak_savers + quantity > 3:  # Check the total after adding the quantity
-                    return Response({"error": "You can own 3 streak savers at most."},
-                                    status=status.HTTP_400_BAD_REQUEST)
+    def _convert(self, request, user, item_type, quantity, company_draw_id, total_gem_cost):
+        # Update the user's tickets or streak savers
+        if item_type == 'streak_saver':
+            if user.streak_savers + quantity > 3:  # Check the total after adding the quantity
+                return Response({"error": "You can own 3 streak savers at most."},
+                                status=status.HTTP_400_BAD_REQUEST)
 
-                user.streak_savers += quantity  # Properly increment the streak savers count
+            user.streak_savers += quantity  # Properly increment the streak savers count
 
-                # Create notification for receiving streak savers
-                notif_type = "purchase_streaksaver"
-                content = f"You converted {total_gem_cost} gems into {quantity} streak savers."
+            # Create notification for receiving streak savers
+            notif_type = "purchase_streaksaver"
+            content = f"You converted {total_gem_cost} gems into {quantity} streak savers."
 
 
-            elif item_type == 'ticket_global':
+        elif item_type == 'ticket_global':
 
-                # Ensure there is an active global draw whose end date has not passed
-                global_draw = Draw.objects.filter(is_active=True, draw_type='global', draw_date__gt=now()).first()
-                if not global_draw:
-                    return Response({"error": "No active global draw available or unauthorised."},
-                                    status=status.HTTP_400_BAD_REQUEST)
+            # Ensure there is an active global draw whose end date has not passed
+            global_draw = Draw.objects.filter(is_active=True, draw_type='global', draw_date__gt=now()).first()
+            if not global_draw:
+                return Response({"error": "No active global draw available or unauthorised."},
+                                status=status.HTTP_400_BAD_REQUEST)
 
-                # Add entries to the global draw
-                entries = [DrawEntry(user=user, draw=global_draw) for _ in range(quantity)]
-                DrawEntry.objects.bulk_create(entries)
+            # Add the tickets to the global draw as one block
+            global_draw.add_tickets(user, quantity)
 
-                # Create notification for purchasing global draw tickets
-                notif_type = "purchase_globaldraw"
-                content = f"You converted {total_gem_cost} gems into {quantity} global draw tickets."
+            # Create notification for purchasing global draw tickets
+            notif_type = "purchase_globaldraw"
+            content = f"You converted {total_gem_cost} gems into {quantity} global draw tickets."
 
-            elif item_type == 'ticket_company':
-                if company_draw_id is None:
-                    return Response({"error": "Company draw ID is required."}, status=status.HTTP_400_BAD_REQUEST)
+        elif item_type == 'ticket_company':
+            if company_draw_id is None:
+                return Response({"error": "Company draw ID is required."}, status=status.HTTP_400_BAD_REQUEST)
 
-                # Validate the company draw ID and check if there's an active company draw for the user's company
-                try:
-                    company_draw = Draw.objects.get(pk=company_draw_id, company__membership__user=user, is_active=True,
-                                                    draw_date__gt=now())
-                except Draw.DoesNotExist:
-                    return Response(
-                        {"error": "No active company draw available for the specified ID or not authorized."},
-                        status=status.HTTP_404_NOT_FOUND)
-
-                # Add entries to the specified company draw
-                entries = [DrawEntry(user=user, draw=company_draw) for _ in range(quantity)]
-                DrawEntry.objects.bulk_create(entries)
-
-                # Create notification for purchasing company draw tickets
-                notif_type = "purchase_companydraw"
-                content = f"You converted {total_gem_cost} gems into {quantity} company draw tickets."
-
-            user.save(update_fields=['gems_spent', 'streak_savers'])
-
-            # Record the purchase
-            purchase_data = {
-                'item_name': item_type,
-                'gem_used': total_gem_cost,
-                'quantity': quantity
+            # Validate the company draw ID and check if there's an active company draw for the user's company
+            try:
+                company_draw = Draw.objects.get(pk=company_draw_id, company__membership__user=user, is_active=True,
+                                                draw_date__gt=now())
+            except Draw.DoesNotExist:
+                return Response(
+                    {"error": "No active company draw available for the specified ID or not authorized."},
+                    status=status.HTTP_404_NOT_FOUND)
+
+            # Add the tickets to the specified company draw as one block
+            company_draw.add_tickets(user, quantity)
+
+            # Create notification for purchasing company draw tickets
+            notif_type = "purchase_companydraw"
+            content = f"You converted {total_gem_cost} gems into {quantity} company draw tickets."
+
+        # Deduct the total gem cost through the gem ledger
+        remaining_gems = spend_gems(user, total_gem_cost)
+        user.save(update_fields=['streak_savers'])
+
+        # Record the purchase
+        purchase_data = {
+            'item_name': item_type,
+            'gem_used': total_gem_cost,
+            'quantity': quantity
+        }
+        purchase_serializer = PurchaseSerializer(data=purchase_data)
+
+        if purchase_serializer.is_valid():
+            purchase_serializer.save(user=user)  # Save the purchase with the user
+            # Create the notification
+            notif_data = {
+                'user': user.id,
+                'notif_type': notif_type,  # Or any type you want
+                'content': content
             }
-            purchase_serializer = PurchaseSerializer(data=purchase_data)
-
-            if purchase_serializer.is_valid():
-                purchase_serializer.save(user=user)  # Save the purchase with the user
-                # Create the notification
-                notif_data = {
-                    'user': user.id,
-                    'notif_type': notif_type,  # Or any type you want
-                    'content': content
-                }
-                notification_serializer = NotifSerializer(data=notif_data, context={'request': request})
-                if notification_serializer.is_valid():
-                    notification = notification_serializer.save()  # Save the notification
+            notification_serializer = NotifSerializer(data=notif_data, context={'request': request})
+            if notification_serializer.is_valid():
+                notification = notification_serializer.save()  # Save the notification
 
-                    # Send WebSocket notification using the helper function
-                    send_user_notification(user, notification)
-                else:
-                    return Response(notification_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+                # Send WebSocket notification using the helper function
+                send_user_notification(user, notification)
             else:
-                return Response(purchase_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+                return Response(notification_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            return Response(purchase_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-            # Broadcast the updated gem count
-            self.broadcast_gem_update(user)
+        # Broadcast the updated gem count
+        self.broadcast_gem_update(user)
 
         return Response({
             "message": f"You have successfully converted {total_gem_cost} gems for {quantity} {item_type}(s).",
-            "remaining_gem": total_available_gems - total_gem_cost
+            "remaining_gem": remaining_gems
         }, status=status.HTTP_200_OK)
 
     def broadcast_gem_update(self, user):
-        new_gem_count = user.get_gem_count()  # Use the `get_gem_count` method to get the total gems
+        new_gem_count = get_gem_balance(user, refresh=False)  # spend_gems() keeps user.gem_balance current
         print('new gem count', new_gem_count)
 
         # Calculate the remaining XP gems the user can earn today
@@ -1173,9 +1188,8 @@ class ConvertGemView(APIView):
         gems_earned_today = gem_record.xp_gem if gem_record else 0
         xp_gems_remaining_today = max(0, 5 - gems_earned_today)  # Assuming the daily limit is 5
 
-        # Get the channel layer and send the updated gem count and XP gems remaining to the WebSocket
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
+        # Send the updated gem count and XP gems remaining to the WebSocket, coalesced with other updates
+        send_state_update(
             f'gem_{user.id}',  # Group name based on user_id
             {
                 'type': 'send_gem_update',
@@ -1207,19 +1221,40 @@ class DrawHistoryAndWinnersView(APIView):
         user = request.user
 
         # Draws user participated in
-        participated_draws = DrawEntry.objects.filter(user=user).select_related('draw')
+        participated_draws = DrawTicketBlock.objects.filter(user=user).select_related('draw')
 
         # Draws user won
         won_draws = DrawWinner.objects.filter(user=user).select_related('draw', 'prize')
 
         response_data = {
-            'participated_draws': DrawEntrySerializer(participated_draws, many=True).data,
+            'participated_draws': DrawTicketBlockSerializer(participated_draws, many=True).data,
             'won_draws': DrawWinnerSerializer(won_draws, many=True).data,
         }
 
         return Response(response_data)
 
 
+def serialize_draw_list(draws, request):
+    """
+    Serialize ``draws`` with the user's entry count and ticket ids, in a constant
+    number of queries however many draws there are.
+    """
+    draws = list(draws.prefetch_related('prizes', 'images'))
+    draw_ids = [draw.id for draw in draws]
+    user_entry_counts = dict(
+        DrawParticipant.objects.filter(draw_id__in=draw_ids, user=request.user).values_list('draw_id', 'entry_count')
+    )
+    serialized_draws = DrawSerializer(
+        draws, many=True, context={'request': request, 'user_entry_counts': user_entry_counts}
+    ).data
+
+    # Add user's ticket IDs to each draw
+    ticket_ids = DrawTicketBlock.user_ticket_ids(draw_ids, request.user)
+    for draw_data in serialized_draws:
+        draw_data['user_ticket_ids'] = ticket_ids[draw_data['id']]
+    return serialized_draws
+
+
 class GetAllGlobalView(APIView):
     """
     Returns all active global draws.
@@ -1229,16 +1264,9 @@ class GetAllGlobalView(APIView):
     def get(self, request):
         # Filter only active draws with draw_type as 'global'
         draws = Draw.objects.filter(is_active=True, draw_type='global')
-        print(draws)
-
-        # Serialize the draws
-        serialized_draws = DrawSerializer(draws, many=True, context={'request': request}).data
 
-        # Add user's ticket IDs (draw entries) to each draw
-        for draw_data in serialized_draws:
-            draw_id = draw_data['id']
-            user_entries = DrawEntry.objects.filter(draw_id=draw_id, user=request.user).values_list('id', flat=True)
-            draw_data['user_ticket_ids'] = list(user_entries)
+        # Serialize the draws with the user's tickets
+        serialized_draws = serialize_draw_list(draws, request)
 
         return Response(serialized_draws, status=status.HTTP_200_OK)
 
@@ -1374,14 +1402,8 @@ class CompanyDrawListView(APIView):
                 # draw_date__gte=timezone.now()
             )
 
-            # Serialize the draws
-            serialized_draws = DrawSerializer(draws, many=True, context={'request': request}).data
-
-            # Add user's ticket IDs (draw entries) to each draw
-            for draw_data in serialized_draws:
-                draw_id = draw_data['id']
-                user_entries = DrawEntry.objects.filter(draw_id=draw_id, user=request.user).values_list('id', flat=True)
-                draw_data['user_ticket_ids'] = list(user_entries)
+            # Serialize the draws with the user's tickets
+            serialized_draws = serialize_draw_list(draws, request)
 
             return Response(serialized_draws, status=status.HTTP_200_OK)
 
@@ -1395,102 +1417,21 @@ class GlobalActiveLeagueView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        now = timezone.now()
         user = request.user
 
         # Get the user's active global league instance
         user_league = (
             UserLeague.objects
             .filter(user=user, league_instance__is_active=True, league_instance__company__isnull=True)
-            .select_related('league_instance', 'user')
+            .select_related('league_instance__league')
             .first()
         )
 
         if not user_league:
             return Response({"error": "No active global league found for the user"}, status=404)
 
-        league_instance = user_league.league_instance
-        rankings = UserLeague.objects.filter(league_instance=league_instance).select_related('user').order_by(
-            '-xp_global', '-user__streak', 'id')
-
-        total_users = rankings.count()
-        promotion_threshold = int(total_users * 0.30)  # Top 10%
-        demotion_threshold = int(total_users * 0.80)  # Bottom 10%
-
-        # Check if the league is the highest or lowest
-        is_highest_league = league_instance.league.order == 10
-        is_lowest_league = league_instance.league.order == 1
-
-        rankings_data = []
-        for index, ul in enumerate(rankings, start=1):
-            if is_highest_league:
-                # Highest league: users can only be retained or demoted
-                if index <= demotion_threshold:
-                    advancement = "Retained"
-                    gems_obtained = 10
-                else:
-                    advancement = "Demoted"
-                    gems_obtained = 0  # No gems for demoted users
-            elif is_lowest_league:
-                # Lowest league: users can be promoted based on ranking (top 30%)
-                if index <= promotion_threshold:
-                    advancement = "Promoted"
-                    gems_obtained = 20 - (index - 1) * 2  # Rewards for promotion (adjust as needed)
-                else:
-                    advancement = "Retained"
-                    gems_obtained = 10 if ul.xp_global > 0 else 0  # Retained users get a base reward
-            else:
-                # Normal league logic
-                if total_users <= 3:
-                    if ul.xp_global == 0:
-                        advancement = "Demoted"
-                        gems_obtained = 0
-                    else:
-                        advancement = "Retained"
-                        gems_obtained = 10
-                else:
-                    if index <= promotion_threshold:
-                        gems_obtained = 20 - (index - 1) * 2  # Reward for promotion
-                        advancement = "Promoted"
-                    elif index <= demotion_threshold:
-                        gems_obtained = 10  # Retained users get a base reward
-                        advancement = "Retained"
-                    else:
-                        gems_obtained = 0  # Demoted users receive no gems
-                        advancement = "Demoted"
-
-            # Prefix for S3 bucket URL
-            s3_bucket_url = "https://video-play-api-bucket.s3.amazonaws.com/"
-
-            # User data for each ranking
-            rankings_data.append({
-                "user_id": ul.user.id,
-                "username": ul.user.username,
-                "profile_picture": f"{s3_bucket_url}{ul.user.profile_picture}" if ul.user.profile_picture else None,
-                "xp": ul.xp_global,
-                "streaks": ul.user.streak,  # Assuming `streak` is a field on the user model
-                "gems_obtained": gems_obtained,
-                "rank": index,
-                "advancement": advancement
-            })
-
-        # Find the current user's rank
-        user_rank = next((index for index, r in enumerate(rankings_data, start=1) if r["user_id"] == user.id), None)
-
-        league_start = league_instance.league_start.isoformat(timespec='milliseconds') + 'Z'
-        league_end = league_instance.league_end.isoformat(timespec='milliseconds') + 'Z'
-
-        # Response data
-        data = {
-            "league_id": league_instance.id,
-            "league_name": league_instance.league.name,
-            "league_level": 11 - league_instance.league.order,
-            "league_start": league_start,
-            "league_end": league_end,
-            "user_rank": user_rank,
-            "rankings": rankings_data
-        }
-
+        # Rankings are read from the cached snapshot the last XP change invalidated
+        data = with_user_rank(get_ranking_snapshot(user_league.league_instance), user.id)
         return Response(data, status=status.HTTP_200_OK)
 
 
@@ -1498,119 +1439,20 @@ class CompanyActiveLeagueView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        now = timezone.now()
         user = request.user
 
         # Get the user's active company league instance
         user_league = (
             UserLeague.objects
             .filter(user=user, league_instance__is_active=True, league_instance__company__isnull=False)
-            .select_related('league_instance', 'user')
+            .select_related('league_instance__league')
             .first()
         )
 
         if not user_league:
             return Response({"error": "No active company league found for the user"}, status=404)
 
-        league_instance = user_league.league_instance
-
-        # Retrieve all leagues approved for the company
-        approved_leagues = (
-            LeagueInstance.objects
-            .filter(company=league_instance.company, is_active=True)
-            .select_related('league')
-            .order_by('league__order')
-        )
-
-        # Get the highest and lowest leagues for the company
-        lowest_league_order = approved_leagues.first().league.order
-        highest_league_order = approved_leagues.last().league.order
-        print(lowest_league_order)
-        print(highest_league_order)
-
-        rankings = UserLeague.objects.filter(league_instance=league_instance).select_related('user').order_by(
-            '-xp_company', '-user__streak', 'id')
-        total_users = rankings.count()
-        promotion_threshold = int(total_users * 0.30)
-        demotion_threshold = int(total_users * 0.80)
-
-        is_highest_league = league_instance.league.order == highest_league_order
-        is_lowest_league = league_instance.league.order == lowest_league_order
-
-        rankings_data = []
-        for index, ul in enumerate(rankings, start=1):
-            if is_highest_league and is_lowest_league:
-                # When the highest and lowest leagues are the same, all users are retained 
-                advancement = "Retained"
-                gems_obtained = 10 if ul.xp_global > 0 else 0
-            elif is_highest_league:
-                # Highest league: users can only be retained or demoted
-                if index <= demotion_threshold:
-                    advancement = "Retained"
-                    gems_obtained = 10
-                else:
-                    advancement = "Demoted"
-                    gems_obtained = 0  # No gems for demoted users
-            elif is_lowest_league:
-                # Lowest league: users can be promoted based on ranking (top 30%)
-                if index <= promotion_threshold:
-                    advancement = "Promoted"
-                    gems_obtained = 20 - (index - 1) * 2  # Rewards for promotion (adjust as needed)
-                else:
-                    advancement = "Retained"
-                    gems_obtained = 10 if ul.xp_global > 0 else 0  # Retained users get a base reward
-            else:
-                # Normal league logic
-                if total_users <= 3:
-                    if ul.xp_global == 0:
-                        advancement = "Demoted"
-                        gems_obtained = 0
-                    else:
-                        advancement = "Retained"
-                        gems_obtained = 10
-                else:
-                    if index <= promotion_threshold:
-                        gems_obtained = 20 - (index - 1) * 2  # Reward for promotion
-                        advancement = "Promoted"
-                    elif index <= demotion_threshold:
-                        gems_obtained = 10  # Retained users get a base reward
-                        advancement = "Retained"
-                    else:
-                        gems_obtained = 0  # Demoted users receive no gems
-                        advancement = "Demoted"
-
-            # Prefix for S3 bucket URL
-            s3_bucket_url = "https://video-play-api-bucket.s3.amazonaws.com/"
-
-            # Add user data
-            rankings_data.append({
-                "user_id": ul.user.id,
-                "username": ul.user.username,
-                "profile_picture": f"{s3_bucket_url}{ul.user.profile_picture}" if ul.user.profile_picture else None,
-                "xp": ul.xp_company,
-                "streaks": ul.user.streak,  # Assuming `streak` is a field on the user model
-                "gems_obtained": gems_obtained,
-                "rank": index,
-                "advancement": advancement
-            })
-
-        # Find the current user's rank
-        user_rank = next((index for index, r in enumerate(rankings_data, start=1) if r["user_id"] == user.id), None)
-
-        league_start = league_instance.league_start.isoformat(timespec='milliseconds') + 'Z'
-        league_end = league_instance.league_end.isoformat(timespec='milliseconds') + 'Z'
-
-        # Response data
-        data = {
-            "league_id": league_instance.id,
-            "league_name": league_instance.league.name,
-            "league_level": 11 - league_instance.league.order,  # Reverse order for league level
-            "league_start": league_start,
-            "league_end": league_end,
-            "user_rank": user_rank,
-            "rankings": rankings_data
-        }
-
+        data = with_user_rank(get_ranking_snapshot(user_league.league_instance), user.id)
         return Response(data, status=status.HTTP_200_OK)
 
 
@@ -2042,137 +1884,120 @@ class UserGemStatusView(APIView):
         }, status=status.HTTP_200_OK)
 
 
+def _league_status_from_memberships(user, company):
+    """
+    The league status as computed before settlement recorded LeagueResult rows: the
+    user's rank and outcome in their second-to-last league instance of the kind.
+    Serves users whose last settled league predates the results.
+
+    Returns:
+        dict: The status, or None when the user has no previous league.
+    """
+    memberships = list(
+        UserLeague.objects.filter(user=user, league_instance__company__isnull=not company)
+        .select_related('league_instance__league').order_by('-league_instance__league_end')[:2]
+    )
+    if len(memberships) < 2:
+        return None
+    league_instance = memberships[1].league_instance
+
+    xp_field = 'xp_company' if company else 'xp_global'
+    ranked = list(
+        UserLeague.objects.filter(league_instance=league_instance).order_by(f'-{xp_field}', 'id')
+        .values_list('user_id', flat=True)
+    )
+    rank = ranked.index(user.id) + 1
+    promotion_threshold = int(len(ranked) * PROMOTION_SHARE)
+    demotion_threshold = int(len(ranked) * DEMOTION_SHARE)
+    is_highest_league, is_lowest_league = league_edges(league_instance)
+
+    if is_highest_league:
+        # Highest league: users can only be retained or demoted
+        league_status = "Retained" if rank <= demotion_threshold else "Demoted"
+    elif is_lowest_league:
+        league_status = "Promoted" if rank <= promotion_threshold else "Retained"
+    elif rank <= promotion_threshold:
+        league_status = "Promoted"
+    elif rank <= demotion_threshold:
+        league_status = "Retained"
+    else:
+        league_status = "Demoted"
+
+    return {
+        "league_id": league_instance.id,
+        "league_name": league_instance.league.name,
+        "league_level": 11 - league_instance.league.order,
+        "league_end": league_instance.league_end.isoformat(timespec='milliseconds') + 'Z',
+        "status": league_status,
+        "rank": rank
+    }
+
+
 class GlobalLeagueStatusView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        user = request.user
-        # Get the last global league instance for the user, sorted by league_end date
-        global_leagues = UserLeague.objects.filter(
-            user=user, league_instance__company__isnull=True
-        ).select_related('league_instance').order_by('-league_instance__league_end')
-        print(global_leagues)
+        # Results are written once when settlement ranks an instance
+        result = LeagueResult.objects.filter(
+            user=request.user, company__isnull=True
+        ).select_related('league').order_by('-league_end').first()
 
-        if global_leagues.count() < 2:
-            return Response({"error": "No previous global league found for the user"}, status=404)
-
-        global_league = global_leagues[1]  # Get the second-to-last league instance
+        if result is not None:
+            return Response(LeagueResultSerializer(result).data, status=status.HTTP_200_OK)
 
-        data = self.get_league_status(global_league, user)
+        # Last settled before results were recorded
+        data = _league_status_from_memberships(request.user, company=False)
+        if data is None:
+            return Response({"error": "No previous global league found for the user"}, status=404)
         return Response(data, status=status.HTTP_200_OK)
 
-    def get_league_status(self, league, user):
-        league_instance = league.league_instance
-        rankings = UserLeague.objects.filter(league_instance=league_instance).select_related('user').order_by(
-            '-xp_global', 'id')
-
-        total_users = rankings.count()
-        promotion_threshold = int(total_users * 0.30)
-        demotion_threshold = int(total_users * 0.80)
-
-        is_highest_league = league_instance.league.order == 10
-        is_lowest_league = league_instance.league.order == 1
-
-        for index, ul in enumerate(rankings, start=1):
-            if ul.user == user:
-                # Highest league logic
-                if is_highest_league:
-                    # Highest league: users can only be retained or demoted
-                    if index <= demotion_threshold:
-                        status = "Retained"
-                    else:
-                        status = "Demoted"
-                elif is_lowest_league:
-                    if index <= promotion_threshold:
-                        status = "Promoted"
-                    else:
-                        status = "Retained"
-                else:
-                    if index <= promotion_threshold:
-                        status = "Promoted"
-                    elif index <= demotion_threshold:
-                        status = "Retained"
-                    else:
-                        status = "Demoted"
-
-                return {
-                    "league_id": league_instance.id,
-                    "league_name": league_instance.league.name,
-                    "league_level": 11 - league_instance.league.order,
-                    "league_end": league_instance.league_end.isoformat(timespec='milliseconds') + 'Z',
-                    "status": status,
-                    "rank": index
-                }
-        return {"error": "User not found in the league"}
-
 
 class CompanyLeagueStatusView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        user = request.user
-        # Get the last global league instance for the user, sorted by league_end date
-        company_leagues = UserLeague.objects.filter(
-            user=user, league_instance__company__isnull=False
-        ).select_related('league_instance').order_by('-league_instance__league_end')
+        result = LeagueResult.objects.filter(
+            user=request.user, company__isnull=False
+        ).select_related('league').order_by('-league_end').first()
 
-        if company_leagues.count() < 2:
+        if result is not None:
+            return Response(LeagueResultSerializer(result).data, status=status.HTTP_200_OK)
+
+        data = _league_status_from_memberships(request.user, company=True)
+        if data is None:
             return Response({"error": "No previous company league found for the user"}, status=404)
+        return Response(data, status=status.HTTP_200_OK)
 
-        company_league = company_leagues[1]  # Get the second-to-last league instance
 
-        data = self.get_league_status(company_league, user)
-        return Response(data, status=status.HTTP_200_OK)
+class LeagueHistoryPagination(PageNumberPagination):
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 50
 
-    def get_league_status(self, league, user):
-
-        league_instance = league.league_instance
-        rankings = UserLeague.objects.filter(league_instance=league_instance).select_related('user').order_by(
-            '-xp_company', 'id')
-
-        total_users = rankings.count()
-        promotion_threshold = int(total_users * 0.30)
-        demotion_threshold = int(total_users * 0.80)
-
-        # Get the highest and lowest league orders for the company
-        approved_leagues = LeagueInstance.objects.filter(company=league_instance.company, is_active=True)
-        lowest_league_order = approved_leagues.first().league.order
-        highest_league_order = approved_leagues.last().league.order
-
-        is_highest_league = league_instance.league.order == highest_league_order
-        is_lowest_league = league_instance.league.order == lowest_league_order
-
-        for index, ul in enumerate(rankings, start=1):
-            if ul.user == user:
-                # Highest league logic
-                if is_highest_league:
-                    # Highest league: users can only be retained or demoted
-                    if index <= demotion_threshold:
-                        status = "Retained"
-                    else:
-                        status = "Demoted"
-                elif is_lowest_league:
-                    if index <= promotion_threshold:
-                        status = "Promoted"
-                    else:
-                        status = "Retained"
-                else:
-                    if index <= promotion_threshold:
-                        status = "Promoted"
-                    elif index <= demotion_threshold:
-                        status = "Retained"
-                    else:
-                        status = "Demoted"
-
-                return {
-                    "league_id": league_instance.id,
-                    "league_name": league_instance.league.name,
-                    "league_level": 11 - league_instance.league.order,
-                    "league_end": league_instance.league_end.isoformat(timespec='milliseconds') + 'Z',
-                    "status": status,
-                    "rank": index
-                }
-        return {"error": "User not found in the league"}
+
+class LeagueHistoryView(APIView):
+    """
+    The requesting user's settled league results, newest first.
+    ``?league_type=global`` or ``company`` limits them to one kind of league.
+    """
+    permission_classes = [IsAuthenticated]
+    pagination_class = LeagueHistoryPagination
+
+    def get(self, request):
+        results = LeagueResult.objects.filter(user=request.user).select_related('league')
+
+        league_type = request.query_params.get('league_type')
+        if league_type == 'global':
+            results = results.filter(company__isnull=True)
+        elif league_type == 'company':
+            results = results.filter(company__isnull=False)
+        elif league_type is not None:
+            return Response({"error": "league_type must be 'global' or 'company'"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        paginator = self.pagination_class()
+        result_page = paginator.paginate_queryset(results.order_by('-league_end', '-id'), request)
+        return paginator.get_paginated_response(LeagueResultSerializer(result_page, many=True).data)
 
 
 class CompanyDashboardView(APIView):
@@ -0,0 +1,117 @@
+"""
+Debounced outbound websocket updates.
+
+A single sync can save several Gem and Streak rows and rebroadcast the same
+league rankings, each of which used to be its own channel-layer group_send
+inside the request. State updates are instead parked here, keyed by (group,
+message type), and a background timer sends only the latest message of each key
+once WS_COALESCE_WINDOW_SECONDS have passed since the first one arrived. Every
+message replaced before it was sent is counted as suppressed.
+
+Only use this for messages that carry a full state (gem count, streak count,
+rankings). Messages that must all be delivered, such as notifications or feed
+items, still go through the channel layer directly. Updates sent from inside a
+transaction wait for it to commit and are dropped if it rolls back.
+"""
+import atexit
+import logging
+import threading
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateCoalescer:
+    """Per-process buffer that keeps the latest message of every (group, type) until the window closes."""
+
+    def __init__(self, window):
+        self.window = window
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._timer = None
+        self._stats = {'queued': 0, 'sent': 0, 'suppressed': 0, 'failed': 0}
+
+    def send(self, group, message):
+        """Queue ``message`` for ``group``, replacing any queued message of the same type."""
+        if self.window <= 0:
+            with self._lock:
+                self._stats['queued'] += 1
+            self._deliver([(group, message)])
+            return
+
+        with self._lock:
+            self._stats['queued'] += 1
+            key = (group, message['type'])
+            if key in self._pending:
+                self._stats['suppressed'] += 1
+            self._pending[key] = message
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Send every queued message now. Returns the number of messages sent."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        return self._deliver([(group, message) for (group, _), message in pending.items()])
+
+    def _deliver(self, messages):
+        if not messages:
+            return 0
+        channel_layer = get_channel_layer()
+        sent = failed = 0
+        for group, message in messages:
+            try:
+                async_to_sync(channel_layer.group_send)(group, message)
+                sent += 1
+            except Exception as e:
+                # A lost state update is superseded by the next one; never break the caller
+                logger.error(f"Websocket update to {group} failed: {e}")
+                failed += 1
+        with self._lock:
+            self._stats['sent'] += sent
+            self._stats['failed'] += failed
+        return sent
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, pending=len(self._pending))
+
+
+_coalescer = None
+_coalescer_lock = threading.Lock()
+
+
+def get_update_coalescer():
+    """Return the process-wide coalescer, configured from WS_COALESCE_WINDOW_SECONDS."""
+    global _coalescer
+    if _coalescer is None:
+        with _coalescer_lock:
+            if _coalescer is None:
+                _coalescer = UpdateCoalescer(settings.WS_COALESCE_WINDOW_SECONDS)
+                # Do not drop the last window's updates when the process exits cleanly
+                atexit.register(_coalescer.flush)
+    return _coalescer
+
+
+def send_state_update(group, message):
+    """
+    Queue a state update for ``group``; only the latest message of its type within the window is sent.
+
+    Inside a transaction the update is only queued once it commits, so a rolled back
+    change is never pushed to clients.
+    """
+    transaction.on_commit(lambda: get_update_coalescer().send(group, message))
+
+
+def coalescer_stats():
+    """Counters for this process: ``queued``, ``sent``, ``suppressed`` and ``failed`` messages, and ``pending``."""
+    return get_update_coalescer().stats()
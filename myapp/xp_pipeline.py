@@ -0,0 +1,288 @@
+"""
+The "XP applied" pipeline.
+
+Every inserted Xp record runs through the ordered stages below exactly once,
+sharing one XpContext so the user, timezone, active league memberships, the
+day's gem row and the latest streak are loaded a single time. Stages run inside
+one transaction; websocket broadcasts and push notifications are deferred with
+transaction.on_commit so they never fire for rolled-back work.
+
+Stage durations are reported to the callables listed in XP_PIPELINE_TIMING_HOOKS
+(dotted paths), each called as hook(stage_name, seconds, context).
+"""
+import logging
+import re
+import time
+from datetime import datetime, timedelta
+from functools import cached_property, partial
+
+import pytz
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from notifications.utils import send_notification
+from .models import Streak, League, UserLeague, Feed, Gem, Notif
+from .league_service import place_users
+from .streak_service import STREAK_XP_THRESHOLD, recompute_streak
+from .websocket_signals import broadcast_global_league_ranking_update, broadcast_company_league_ranking_update
+
+logger = logging.getLogger(__name__)
+
+STREAK_REMINDER_XP = 200  # From this much XP the user is nudged to finish the day
+XP_PER_GEM = 250
+MAX_XP_GEMS_PER_DAY = 5
+
+
+def is_milestone_streak(streak):
+    # Define milestones dynamically
+    if streak < 10:
+        return False
+    elif streak % 10 == 0 and streak < 100:
+        return True
+    elif streak % 100 == 0 and streak < 1000:
+        return True
+    elif streak % 1000 == 0 and streak < 1000000:
+        return True
+    elif streak % 1000000 == 0:
+        return True
+    return False
+
+
+class XpContext:
+    """State shared by the pipeline stages for one Xp record."""
+
+    def __init__(self, xp):
+        self.xp = xp
+        self.user = xp.user
+        self.deferred = []
+
+    @cached_property
+    def user_timezone(self):
+        return pytz.timezone(self.user.timezone.key)
+
+    @cached_property
+    def local_now(self):
+        return datetime.now(self.user_timezone)
+
+    @cached_property
+    def pathfinder_league(self):
+        return League.objects.filter(name="Pathfinder league", order=1).first()
+
+    @cached_property
+    def active_leagues(self):
+        return list(
+            UserLeague.objects
+            .filter(user=self.user, league_instance__is_active=True)
+            .select_related('league_instance__league', 'league_instance__company', 'user')
+        )
+
+    def refresh_active_leagues(self):
+        self.__dict__.pop('active_leagues', None)
+
+    @property
+    def global_league(self):
+        return next((ul for ul in self.active_leagues if ul.league_instance.company_id is None), None)
+
+    @property
+    def company_league(self):
+        return next((ul for ul in self.active_leagues if ul.league_instance.company_id is not None), None)
+
+    @cached_property
+    def latest_streak(self):
+        """The most recent streak record before the XP date."""
+        return Streak.objects.filter(user=self.user, date__lt=self.xp.date).order_by('-date').first()
+
+    @cached_property
+    def gem(self):
+        """The gem row for the XP date."""
+        gem, _ = Gem.objects.get_or_create(user=self.user, date=self.xp.date)
+        return gem
+
+    def defer(self, name, effect):
+        """Run ``effect`` after the surrounding transaction commits."""
+        self.deferred.append((name, effect))
+
+
+def update_streak(ctx):
+    xp = ctx.xp
+    user = ctx.user
+    if xp.totalXpToday < STREAK_XP_THRESHOLD:
+        return
+
+    # Renumber the XP day and the consecutive days after it in one pass
+    current_streak = recompute_streak(
+        user, xp.date, xp.timeStamp, ctx.local_now.date(), previous_streak=ctx.latest_streak
+    )
+
+    user.streak = current_streak
+    user.save(update_fields=['streak'])
+
+    if is_milestone_streak(current_streak):
+        # Only create a feed if the streak exceeds the last recorded milestone
+        last_milestone_feed = Feed.objects.filter(user=user, feed_type=Feed.STREAK).order_by('-created_at').first()
+        last_milestone = 0
+        if last_milestone_feed:
+            match = re.search(r'has reached a (\d+)-day streak', last_milestone_feed.content)
+            if match:
+                last_milestone = int(match.group(1))
+
+        if current_streak > last_milestone:
+            Feed.objects.create(
+                user=user,
+                feed_type=Feed.STREAK,
+                content=f"{user.username} has reached a {current_streak}-day streak!",
+            )
+
+
+def update_gems(ctx):
+    xp = ctx.xp
+    user = ctx.user
+    xp_today = xp.totalXpToday
+
+    # Only XP gained within the user's current week earns gems
+    today = ctx.local_now.date()
+    current_week_monday = today - timedelta(days=today.weekday())
+    if xp.date < current_week_monday:
+        return
+
+    # 1 gem per 250 XP, capped per day
+    total_xp_gem_today = min(int(xp_today // XP_PER_GEM), MAX_XP_GEMS_PER_DAY)
+
+    gem = ctx.gem
+    gem.xp_gem = total_xp_gem_today
+    gem.copy_xp_gem = total_xp_gem_today
+    gem.save()
+
+    # Keep a single "received_gem" notification per day up to date
+    xp_utc_time = xp.timeStamp.astimezone(pytz.utc)
+    existing_notification = Notif.objects.filter(
+        user=user,
+        notif_type="received_gem",
+        created_at__date=xp_utc_time
+    ).first()
+
+    content = f"You earned {xp_today} XP and therefore, claimed {total_xp_gem_today} gems."
+    if existing_notification:
+        existing_notification.content = content
+        existing_notification.created_at = timezone.now()
+        existing_notification.save()
+    elif total_xp_gem_today > 0:
+        Notif.objects.create(user=user, notif_type="received_gem", content=content)
+
+
+def _place_in_pathfinder(ctx, company):
+    """Add the user to an open Pathfinder instance (global or for ``company``), creating one if all are full."""
+    pathfinder_league = ctx.pathfinder_league
+    if not pathfinder_league:
+        logger.error("Pathfinder league not found.")
+        return
+
+    if UserLeague.objects.filter(
+        user=ctx.user,
+        league_instance__league=pathfinder_league,
+        league_instance__company=company
+    ).exists():
+        return
+
+    place_users({(pathfinder_league.id, company.id if company else None): [ctx.user.id]})
+    ctx.refresh_active_leagues()
+
+
+def place_in_global_league(ctx):
+    # An active global membership means the user has already been placed
+    if ctx.global_league is None:
+        _place_in_pathfinder(ctx, company=None)
+
+
+def place_in_company_league(ctx):
+    if ctx.user.company_id is None or ctx.company_league is not None:
+        return
+    _place_in_pathfinder(ctx, company=ctx.user.company)
+
+
+def queue_streak_reminder(ctx):
+    total_xp_today = ctx.xp.totalXpToday
+    if not STREAK_REMINDER_XP <= total_xp_today < STREAK_XP_THRESHOLD:
+        return
+
+    xp_needed = STREAK_XP_THRESHOLD - total_xp_today
+    ctx.defer('streak_reminder', partial(
+        send_notification,
+        ctx.user,
+        'Keep Your Streak!',
+        f'To keep your streak of {ctx.user.streak} going, you need to earn {xp_needed} more XP - keep going!',
+        'streak',
+    ))
+
+
+def queue_league_broadcasts(ctx):
+    if ctx.global_league:
+        ctx.defer('global_league_broadcast',
+                  partial(broadcast_global_league_ranking_update, ctx.user, ctx.global_league.league_instance))
+    if ctx.company_league:
+        ctx.defer('company_league_broadcast',
+                  partial(broadcast_company_league_ranking_update, ctx.user, ctx.company_league.league_instance))
+
+
+PIPELINE_STAGES = [
+    ('streak', update_streak),
+    ('gems', update_gems),
+    ('global_league', place_in_global_league),
+    ('company_league', place_in_company_league),
+    ('streak_reminder', queue_streak_reminder),
+    ('league_broadcast', queue_league_broadcasts),
+]
+
+
+def log_stage_timing(stage_name, seconds, ctx):
+    """Default timing hook: debug-log every stage duration."""
+    logger.debug(f"XP pipeline stage {stage_name} took {seconds * 1000:.1f}ms for user {ctx.user.id}")
+
+
+def _timing_hooks():
+    return [import_string(path) for path in getattr(settings, 'XP_PIPELINE_TIMING_HOOKS', [])]
+
+
+def _timed(stage_name, stage, ctx, hooks):
+    started = time.perf_counter()
+    try:
+        return stage()
+    finally:
+        elapsed = time.perf_counter() - started
+        for hook in hooks:
+            hook(stage_name, elapsed, ctx)
+
+
+def _run_deferred(stage_name, effect, ctx, hooks):
+    # After commit nothing can roll back any more; a failing side effect must not break the request
+    try:
+        _timed(stage_name, effect, ctx, hooks)
+    except Exception as e:
+        logger.error(f"XP pipeline side effect {stage_name} failed for user {ctx.user.id}: {str(e)}")
+
+
+def run_xp_pipeline(xp, stages=None):
+    """
+    Apply every consequence of an inserted Xp record.
+
+    Args:
+        xp (Xp): The inserted record.
+        stages (iterable, optional): Names of the stages to run. Defaults to all of them;
+            batch ingestion runs only 'streak' and 'gems' for all but the latest day.
+
+    Returns:
+        XpContext: The context the stages ran with.
+    """
+    hooks = _timing_hooks()
+    ctx = XpContext(xp)
+    with transaction.atomic():
+        for stage_name, stage in PIPELINE_STAGES:
+            if stages is not None and stage_name not in stages:
+                continue
+            _timed(stage_name, partial(stage, ctx), ctx, hooks)
+
+        for stage_name, effect in ctx.deferred:
+            transaction.on_commit(partial(_run_deferred, f'after_commit:{stage_name}', effect, ctx, hooks))
+    return ctx
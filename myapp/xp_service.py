@@ -0,0 +1,234 @@
+import logging
+from collections import defaultdict
+
+from django.db import transaction, IntegrityError
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import Xp, XpTotal, XpDailyTotal, DailySteps, WorkoutActivity
+
+logger = logging.getLogger(__name__)
+
+# Xp.source -> per-source column on the totals tables
+SOURCE_FIELDS = {
+    'steps': 'steps_xp',
+    'workout': 'workout_xp',
+}
+
+
+def _deltas(xp_records):
+    """Sum XP of the given records into all-time and per-day column deltas."""
+    all_time = defaultdict(float)
+    per_day = defaultdict(lambda: defaultdict(float))
+    for xp in xp_records:
+        all_time['total_xp'] += xp.xp_value
+        per_day[xp.date]['total_xp'] += xp.xp_value
+        source_field = SOURCE_FIELDS.get(xp.source)
+        if source_field:
+            all_time[source_field] += xp.xp_value
+            per_day[xp.date][source_field] += xp.xp_value
+    return all_time, per_day
+
+
+def _upsert(model, lookup, updates, create_values):
+    """Apply ``updates`` to the row matching ``lookup``, or create it with ``create_values``."""
+    if model.objects.filter(**lookup).update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **create_values)
+    except IntegrityError:
+        # Created concurrently; fall back to updating it
+        model.objects.filter(**lookup).update(**updates)
+
+
+def _increment(model, lookup, deltas):
+    """Add ``deltas`` to the row matching ``lookup``, creating it if needed."""
+    updates = {field: F(field) + value for field, value in deltas.items()}
+    _upsert(model, lookup, updates, deltas)
+
+
+def apply_xp_to_totals(user_id, xp_records):
+    """
+    Add freshly inserted Xp records to the user's materialized totals.
+
+    Called by Xp.save() for single inserts and by record_xp_batch() after a bulk insert,
+    always inside the transaction that inserted the records.
+    """
+    all_time, per_day = _deltas(xp_records)
+    if not all_time:
+        return
+    _increment(XpTotal, {'user_id': user_id}, all_time)
+    for date, deltas in per_day.items():
+        _increment(XpDailyTotal, {'user_id': user_id, 'date': date}, deltas)
+
+
+def apply_steps_to_rollup(user_id, daily_steps_records):
+    """Copy the day's step count and timestamp of saved DailySteps records into the daily rollup."""
+    for daily_steps in daily_steps_records:
+        values = {'step_count': daily_steps.step_count, 'steps_timestamp': daily_steps.timestamp}
+        _upsert(XpDailyTotal, {'user_id': user_id, 'date': daily_steps.date}, values, values)
+
+
+def _workout_deltas(workouts):
+    # Bucket by the start date in the server timezone, as start_datetime__date filters did
+    per_day = defaultdict(lambda: {'workout_count': 0, 'movement_xp': 0.0, 'mindfulness_xp': 0.0})
+    for workout in workouts:
+        deltas = per_day[timezone.localtime(workout.start_datetime).date()]
+        deltas['workout_count'] += 1
+        if workout.activity_type == 'movement':
+            deltas['movement_xp'] += workout.xp
+        elif workout.activity_type == 'mindfulness':
+            deltas['mindfulness_xp'] += workout.xp
+    return per_day
+
+
+def apply_workouts_to_rollup(user_id, workouts):
+    """Add newly inserted WorkoutActivity records to the daily rollup."""
+    for date, deltas in _workout_deltas(workouts).items():
+        _increment(XpDailyTotal, {'user_id': user_id, 'date': date}, deltas)
+
+
+def _lock_totals(user):
+    """Fetch the user's XpTotal row locked for update, so concurrent ingests apply one at a time."""
+    XpTotal.objects.get_or_create(user=user)
+    return XpTotal.objects.select_for_update().get(user=user)
+
+
+def record_xp(user, date, new_xp, timestamp, source):
+    """
+    Create an Xp record with its running daily and all-time totals taken
+    from the materialized totals instead of scanning the user's history.
+
+    Returns:
+        Xp: The created record.
+    """
+    with transaction.atomic():
+        totals = _lock_totals(user)
+        daily_total = XpDailyTotal.objects.filter(user=user, date=date).values_list('total_xp', flat=True).first()
+
+        return Xp.objects.create(
+            user=user,
+            xp_value=new_xp,
+            totalXpToday=(daily_total or 0.0) + new_xp,
+            totalXpAllTime=totals.total_xp + new_xp,
+            timeStamp=timestamp,
+            date=date,
+            source=source
+        )
+
+
+def record_xp_batch(user, entries):
+    """
+    Bulk insert Xp records for a batch of entries, each a dict with
+    ``date``, ``timestamp``, ``xp`` and ``source``. Entries are applied in
+    timestamp order so running totals match one-at-a-time ingestion.
+
+    Returns:
+        dict: The last Xp record written for each affected date.
+    """
+    with transaction.atomic():
+        totals = _lock_totals(user)
+        dates = {entry['date'] for entry in entries}
+        totals_today = dict(
+            XpDailyTotal.objects.filter(user=user, date__in=dates).values_list('date', 'total_xp')
+        )
+        total_all_time = totals.total_xp
+
+        xp_records = []
+        last_per_date = {}
+        for entry in sorted(entries, key=lambda e: e['timestamp']):
+            date = entry['date']
+            totals_today[date] = totals_today.get(date, 0.0) + entry['xp']
+            total_all_time += entry['xp']
+            xp = Xp(
+                user=user,
+                xp_value=entry['xp'],
+                totalXpToday=totals_today[date],
+                totalXpAllTime=total_all_time,
+                timeStamp=entry['timestamp'],
+                date=date,
+                source=entry['source'],
+            )
+            xp_records.append(xp)
+            last_per_date[date] = xp
+
+        Xp.objects.bulk_create(xp_records)
+        apply_xp_to_totals(user.id, xp_records)
+    return last_per_date
+
+
+def get_total_xp_all_time(user):
+    """Return the user's all-time XP from the materialized totals."""
+    return XpTotal.objects.filter(user=user).values_list('total_xp', flat=True).first() or 0.0
+
+
+def get_total_xp_for_date(user, date):
+    """Return the user's XP for a single day from the materialized totals."""
+    return XpDailyTotal.objects.filter(user=user, date=date).values_list('total_xp', flat=True).first() or 0.0
+
+
+def rebuild_xp_totals(user_ids=None, batch_size=500):
+    """
+    Recompute XpTotal and XpDailyTotal from the Xp, DailySteps and WorkoutActivity tables.
+
+    Args:
+        user_ids (list, optional): Restrict the rebuild to these users. Defaults to every user with activity.
+        batch_size (int): Number of users rebuilt per transaction.
+
+    Returns:
+        int: Number of users rebuilt.
+    """
+    if user_ids is None:
+        user_ids = set(Xp.objects.order_by().values_list('user_id', flat=True).distinct())
+        user_ids |= set(DailySteps.objects.order_by().values_list('user_id', flat=True).distinct())
+        user_ids |= set(WorkoutActivity.objects.order_by().values_list('user_id', flat=True).distinct())
+    user_ids = sorted(set(user_ids))
+
+    for start in range(0, len(user_ids), batch_size):
+        chunk = user_ids[start:start + batch_size]
+        rows = (
+            Xp.objects.filter(user_id__in=chunk)
+            .values('user_id', 'date', 'source')
+            .annotate(total=Sum('xp_value'))
+            .order_by()
+        )
+
+        all_time = defaultdict(lambda: defaultdict(float))
+        per_day = defaultdict(lambda: defaultdict(float))
+        for row in rows:
+            for bucket in (all_time[row['user_id']], per_day[(row['user_id'], row['date'])]):
+                bucket['total_xp'] += row['total']
+                source_field = SOURCE_FIELDS.get(row['source'])
+                if source_field:
+                    bucket[source_field] += row['total']
+
+        for daily_steps in DailySteps.objects.filter(user_id__in=chunk):
+            day = per_day[(daily_steps.user_id, daily_steps.date)]
+            day['step_count'] = daily_steps.step_count
+            day['steps_timestamp'] = daily_steps.timestamp
+
+        workouts_by_user = defaultdict(list)
+        for workout in WorkoutActivity.objects.filter(user_id__in=chunk).only(
+                'user_id', 'start_datetime', 'activity_type', 'xp'):
+            workouts_by_user[workout.user_id].append(workout)
+        for user_id, workouts in workouts_by_user.items():
+            for date, deltas in _workout_deltas(workouts).items():
+                day = per_day[(user_id, date)]
+                for field, value in deltas.items():
+                    day[field] += value
+
+        with transaction.atomic():
+            XpTotal.objects.filter(user_id__in=chunk).delete()
+            XpDailyTotal.objects.filter(user_id__in=chunk).delete()
+            XpTotal.objects.bulk_create([
+                XpTotal(user_id=user_id, **all_time[user_id]) for user_id in chunk
+            ])
+            XpDailyTotal.objects.bulk_create([
+                XpDailyTotal(user_id=user_id, date=date, **deltas)
+                for (user_id, date), deltas in per_day.items()
+            ], batch_size=1000)
+
+        logger.info(f"Rebuilt XP totals for {len(chunk)} users")
+
+    return len(user_ids)
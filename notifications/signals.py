@@ -41,31 +41,3 @@ def notify_streak(sender, instance, **kwargs):
                 logger.info(f'Successfully sent message: {response}')
     except Exception as e:
         logger.error(f'Error sending notification: {str(e)}')
-
-
-@receiver(post_save, sender=Xp)
-def notify_streak_maintenance(sender, instance, **kwargs):
-    """ THis signal sends notification to the user to inform them of their streak maintenance"""
-    try:
-        if instance.totalXpToday >= 200 and instance.totalXpToday < 250:
-            
-            xp_needed = 250 - instance.totalXpToday
-            notification, created = PushNotificationStatus.objects.get_or_create(user=instance.user, notification_type='streak')
-            
-            if not notification.sent:
-                user_devices = FCMDevice.objects.filter(user=instance.user)
-                for device in user_devices:
-                    message = messaging.Message(
-                        notification=messaging.Notification(
-                            title='Keep Your Streak!',
-                            body=f'To keep your streak of {instance.user.streak} going, you need to earn {xp_needed} more XP - keep going!',
-                        ),
-                        token=device.registration_id
-                    )
-                    response = messaging.send(message)
-                    logger.info(f'Successfully sent message to {device.registration_id}: {response}')
-                
-                notification.sent = True
-                notification.save()
-    except Exception as e:
-        logger.error(f'Error sending notification: {str(e)}')
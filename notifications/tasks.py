@@ -2,6 +2,7 @@ from celery import shared_task
 from django.utils.timezone import now
 from datetime import timedelta
 from myapp.models import CustomUser, Xp, Draw, UserLeague, LeagueInstance
+from myapp.gem_service import get_gem_balance
 from fcm_django.models import FCMDevice
 from .models import PushNotificationStatus
 import logging
@@ -73,7 +74,7 @@ def notify_gem_reset():
                 
                 # Check if it's Sunday 6 PM in the user's local timezone
                 if user_local_time.weekday() == 6 and user_local_time.hour == 18:
-                    gem_count = user.get_gem_count()
+                    gem_count = get_gem_balance(user, refresh=False)
                     # logger.info(f"Gem count for {user.email}: {gem_count}")
                     if gem_count > 0:
                         # Get or create the notification status
@@ -111,7 +112,7 @@ def notify_draw_one_day_before():
     draws = Draw.objects.filter(draw_date__date=draw_time.date(), draw_date__hour=draw_time.hour, draw_date__minute=0, is_active=True)
 
     for draw in draws:
-        users = CustomUser.objects.filter(entries__draw=draw).distinct()
+        users = CustomUser.objects.filter(draw_ticket_blocks__draw=draw).distinct()
         send_draw_notification(users, 'Global Draw Reminder', 'Global draw happens tomorrow! Get your final tickets now.', 'draw_one_day_before')
 
 @shared_task
@@ -121,7 +122,7 @@ def notify_draw_one_hour_before():
     draws = Draw.objects.filter(draw_date__date=draw_time.date(), draw_date__hour=draw_time.hour, draw_date__minute=0, is_active=True)
 
     for draw in draws:
-        users = CustomUser.objects.filter(entries__draw=draw).distinct()
+        users = CustomUser.objects.filter(draw_ticket_blocks__draw=draw).distinct()
         send_draw_notification(users, 'Global Draw Reminder', 'Global draw happens in one hour! Join us live.', 'draw_one_hour_before')
 
 @shared_task
@@ -130,7 +131,7 @@ def notify_draw_live():
     draws = Draw.objects.filter(draw_date__lte=now, draw_date__hour=now.hour, draw_date__minute=0, is_active=True)
 
     for draw in draws:
-        users = CustomUser.objects.filter(entries__draw=draw).distinct()
+        users = CustomUser.objects.filter(draw_ticket_blocks__draw=draw).distinct()
         send_draw_notification(users, 'Global Draw Live', 'Global draw is now live, click here to watch along.', 'draw_live')
 
         # Mark the draw as notified for live
@@ -182,6 +182,46 @@ CHANNEL_LAYERS = {
     },
 }
 
+# League ranking snapshots are shared through Redis when it is configured and kept
+# in-process otherwise (dev/tests). The default cache is unchanged.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "rankings": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": redis_url,
+    } if REDIS_URL else {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "rankings",
+    },
+}
+LEAGUE_RANKING_CACHE = 'rankings'
+LEAGUE_RANKING_CACHE_SECONDS = int(os.getenv('LEAGUE_RANKING_CACHE_SECONDS', 300))
+
+# Step ingestion: 'direct' applies every step update immediately, 'buffered' coalesces
+# updates per user/day and only applies the latest value once per flush window.
+STEP_INGEST_MODE = os.getenv('STEP_INGEST_MODE', 'direct')
+# 'redis' shares the buffer across processes; 'local' keeps it in-process (dev/tests)
+STEP_BUFFER_BACKEND = os.getenv('STEP_BUFFER_BACKEND', 'redis' if REDIS_URL else 'local')
+STEP_BUFFER_REDIS_URL = redis_url
+STEP_BUFFER_FLUSH_SECONDS = int(os.getenv('STEP_BUFFER_FLUSH_SECONDS', 60))
+
+# League XP: 'direct' saves every XP event to UserLeague; 'live' adds it to the instance's
+# sorted-set leaderboard and checkpoints it to UserLeague every LEADERBOARD_CHECKPOINT_SECONDS.
+LEAGUE_XP_MODE = os.getenv('LEAGUE_XP_MODE', 'direct')
+# 'redis' shares the leaderboards across processes; 'local' keeps them in-process (dev/tests)
+LEADERBOARD_BACKEND = os.getenv('LEADERBOARD_BACKEND', 'redis' if REDIS_URL else 'local')
+LEADERBOARD_REDIS_URL = redis_url
+LEADERBOARD_CHECKPOINT_SECONDS = int(os.getenv('LEADERBOARD_CHECKPOINT_SECONDS', 30))
+
+# Gem, streak and league ranking websocket updates are held this long and only the latest
+# message per group and type is sent. 0 sends every update immediately.
+WS_COALESCE_WINDOW_SECONDS = float(os.getenv('WS_COALESCE_WINDOW_SECONDS', 0.5))
+
+# Callables (dotted paths) receiving (stage_name, seconds, context) for every XP pipeline stage
+XP_PIPELINE_TIMING_HOOKS = ['myapp.xp_pipeline.log_stage_timing']
+
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
@@ -380,6 +420,7 @@ CELERY_DEFAULT_QUEUE = 'default'
 CELERY_TASK_ROUTES = {
     'myapp.tasks.process_league_promotions': {'queue': 'priority_high'},
     'myapp.tasks.process_company_league_promotions': {'queue': 'priority_high'},
+    'myapp.tasks.settle_league_instances_task': {'queue': 'priority_high'},
     'myapp.tasks.reset_gems_for_local_timezones': {'queue': 'default'},
     'myapp.tasks.send_gem_update': {'queue': 'default'},
     'myapp.tasks.send_status_update': {'queue': 'default'},
@@ -391,9 +432,14 @@ CELERY_TASK_ROUTES = {
     'myapp.tasks.send_login_successful_email_task': {'queue': 'default'},
     'myapp.tasks.send_invitation_email_task': {'queue': 'default'},
     'missions.tasks.assign_daily_tasks': {'queue': 'default'},
+    'myapp.tasks.flush_step_buffer_task': {'queue': 'default'},
+    'myapp.tasks.checkpoint_leaderboards_task': {'queue': 'default'},
 }
 
 
+# How long results of ingestion requests made with a sync key are kept for replay
+INGESTION_RECEIPT_RETENTION_DAYS = 7
+
 CELERY_BEAT_SCHEDULE = {
     'reset-daily-streaks-every-midnight': {
         'task': 'myapp.tasks.reset_daily_streaks',
@@ -448,10 +494,26 @@ CELERY_BEAT_SCHEDULE = {
     'assign_daily_tasks': {
         'task': 'missions.tasks.assign_daily_tasks',
         'schedule': crontab(minute='*/10'),  # Every 5 minute
+    },
+    'checkpoint_leaderboards': {
+        'task': 'myapp.tasks.checkpoint_leaderboards_task',
+        'schedule': timedelta(seconds=LEADERBOARD_CHECKPOINT_SECONDS),
+    },
+    'purge_ingestion_receipts': {
+        'task': 'myapp.tasks.purge_ingestion_receipts_task',
+        'schedule': crontab(hour=2, minute=30),  # Daily at 2:30 AM UTC
     }
 
 }
 
+# Only buffered step ingestion has anything to flush; after switching back to 'direct',
+# apply what is left with `manage.py flush_step_buffer`
+if STEP_INGEST_MODE == 'buffered':
+    CELERY_BEAT_SCHEDULE['flush_step_buffer'] = {
+        'task': 'myapp.tasks.flush_step_buffer_task',
+        'schedule': timedelta(seconds=STEP_BUFFER_FLUSH_SECONDS),
+    }
+
 
 sentry_sdk.init(
     dsn="https://ddfd780df73f55423570f6550b5d57fa@o4508177221091328.ingest.de.sentry.io/4508256174080080",